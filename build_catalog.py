@@ -0,0 +1,124 @@
+#!/usr/bin/env python3 -u
+"""Populate an entity catalog offline, e.g. with a whole proteome.
+
+Encodes the proteins of a FASTA file (``--fasta``) or the compounds of a
+SMILES file (``--smiles``, one ``SMILES [id]`` per line) once and appends
+their [CLS] embeddings to the catalog at ``--catalog``, which ``serve.py``,
+``screen.py`` and the model (``set_entity_catalogs``) then read instead of
+running the encoder. Entities already in the catalog are skipped, so an
+interrupted run can be started again.
+"""
+
+import logging
+import multiprocessing
+import os
+import sys
+import time
+from os import path
+
+import torch
+
+sys.path.append(path.join(path.dirname(path.abspath(__file__)), "fairseq"))
+sys.path.append(path.join(path.dirname(path.abspath(__file__)), "preprocess"))
+
+from fairseq import options, utils
+from fairseq.dataclass.utils import convert_namespace_to_omegaconf
+from fairseq.modules.entity_catalog import open_entity_catalogs
+from fairseq.utils import reset_logging
+
+import build_bin
+import streaming
+from evaluate_kNN import encode_entities
+from screen import buckets, encode_molecule, init_worker, load_model, model_input, read_fasta
+
+logger = logging.getLogger("knn_dta.build_catalog")
+
+
+def add_catalog_arguments(parser):
+    group = parser.add_argument_group('Entity catalog')
+    group.add_argument('--catalog', type=str, required=True, help='Prefix of the catalog, created if missing')
+    group.add_argument('--fasta', type=str, default=None, help='FASTA file of the proteins to add')
+    group.add_argument('--smiles', type=str, default=None,
+                       help='Compounds to add, one SMILES per line optionally followed by whitespace and an id')
+    group.add_argument('--entity-batch-size', type=int, default=32, help='Entities encoded per batch')
+    group.add_argument('--bucket-size', type=int, default=4096,
+                       help='Entities sorted by length together before being cut into --entity-batch-size batches')
+    group.add_argument('--workers', type=int, default=4, help='Processes that canonicalize and tokenize the SMILES')
+    group.add_argument('--chunk-size', type=int, default=100000, help='SMILES lines read ahead by the workers')
+    group.add_argument('--no-canonicalize', action='store_true', default=False,
+                       help='The SMILES are already canonical, only tokenize them')
+    group.add_argument('--keep-atommapnum', action='store_true', default=False)
+    return parser
+
+
+def main(cfg, args, override_args=None):
+    utils.import_user_module(cfg.common)
+    reset_logging()
+
+    if (args.fasta is None) == (args.smiles is None):
+        raise ValueError('Populate the catalog either from --fasta or from --smiles')
+    side = 1 if args.fasta is not None else 0
+
+    # the SMILES are tokenized in workers forked before CUDA is initialized
+    initargs = (os.path.join(args.data, 'input0', 'dict.txt'), os.path.join(args.data, 'input1', 'dict.txt'),
+                args.keep_atommapnum, args.no_canonicalize)
+    init_worker(*initargs)
+    pool = None if side == 1 else multiprocessing.Pool(args.workers, initializer=init_worker, initargs=initargs)
+
+    use_cuda = torch.cuda.is_available() and not cfg.common.cpu
+    if use_cuda:
+        torch.cuda.set_device(cfg.distributed_training.device_id)
+    model, saved_cfg, task = load_model(cfg, override_args, use_cuda)
+    init_token = getattr(saved_cfg.task, 'init_token', None)
+    encoder = model.encoder_0 if side == 0 else model.encoder_1
+    pad = (task.source_dictionary_0 if side == 0 else task.source_dictionary_1).pad()
+    prefixes = (args.catalog, None) if side == 0 else (None, args.catalog)
+    catalog = open_entity_catalogs(*prefixes, cfg.common_eval.path, model.args.encoder_embed_dim)[side]
+    initial = len(catalog)
+    logger.info("{} entities in {}".format(initial, args.catalog))
+
+    if side == 1:
+        entities = ((record, build_bin.pro_binarizer.encode(record[1]) if record[1] else None)
+                    for record in read_fasta(args.fasta))
+    else:
+        entities = streaming.imap_ordered(pool, encode_molecule, streaming.read_lines(args.smiles), args.workers,
+                                          args.chunk_size)
+
+    def encode(sequences):
+        return encode_entities(encoder, sequences, pad, args.entity_batch_size, use_cuda)
+
+    name = 'proteins' if side == 1 else 'compounds'
+    total, failed = 0, 0
+    start = last_log = time.time()
+    for bucket, bucket_failed in buckets(entities, args.bucket_size):
+        failed += bucket_failed
+        total += len(bucket) + bucket_failed
+        if not bucket:
+            continue
+        catalog.get_or_encode([model_input(ids, init_token, encoder.max_positions()) for _, _, ids in bucket], encode)
+        if time.time() - last_log > 60:
+            last_log = time.time()
+            logger.info("{} {} read, {} added, {:.0f}/s".format(
+                total, name, len(catalog) - initial, total / (last_log - start)))
+    if pool is not None:
+        pool.close()
+        pool.join()
+    logger.info("{} {} ({} failed) read in {:.1f}s, {} added to {}, which holds {}".format(
+        total, name, failed, time.time() - start, len(catalog) - initial, args.catalog, len(catalog)))
+
+
+def cli_main():
+    parser = options.get_validation_parser()
+    parser = add_catalog_arguments(parser)
+    args = options.parse_args_and_arch(parser)
+
+    # only override args that are explicitly given on the command line
+    override_parser = options.get_validation_parser()
+    override_parser = add_catalog_arguments(override_parser)
+    override_args = options.parse_args_and_arch(override_parser, suppress_defaults=True)
+
+    main(convert_namespace_to_omegaconf(args), args, override_args=override_args)
+
+
+if __name__ == "__main__":
+    cli_main()
@@ -8,7 +8,6 @@ import logging
 import os
 import sys
 from argparse import Namespace
-from itertools import chain
 
 import torch
 from omegaconf import DictConfig
@@ -21,6 +20,12 @@ sys.path.append(path.join(path.dirname( path.abspath(__file__) ), "fairseq"))
 from fairseq import checkpoint_utils, distributed_utils, options, utils
 from fairseq.dataclass.utils import convert_namespace_to_omegaconf
 from fairseq.logging import metrics, progress_bar
+from fairseq.modules.dti_eval_utils import (
+    all_gather_logging_outputs,
+    bootstrap_confidence_intervals,
+    cat_logging_outputs,
+)
+from fairseq.modules.prediction_spill import PredictionSpillWriter, merge_prediction_spills
 from fairseq.utils import reset_logging
 
 logging.basicConfig(
@@ -34,6 +39,10 @@ logger = logging.getLogger("evaluate_adaptive_kNN")
 def add_custom_arguments(parser):
     parser.add_argument('--output-fn', type=str, default='/protein/users/v-qizhipei/tmp.tsv',
                         help='Outpuf file path')
+    parser.add_argument('--bootstrap', type=int, metavar='N', default=0,
+                        help='Report percentile confidence intervals over N bootstrap replicates (0 disables)')
+    parser.add_argument('--bootstrap-seed', type=int, default=1,
+                        help='Seed of the bootstrap resampling')
     return parser
 
 def main(cfg: DictConfig, override_args=None):
@@ -124,26 +133,60 @@ def main(cfg: DictConfig, override_args=None):
         )
 
         log_outputs = []
+        # predictions are streamed to one spill file per rank and merged in id order at the end
+        output_fn = cfg.criterion.output_fn
+        spill_writer = PredictionSpillWriter(f"{output_fn}.rank{data_parallel_rank}.spill")
         for i, sample in enumerate(progress):
+            # shards are padded with empty batches when distributed
+            if sample is None or len(sample) == 0:
+                continue
             sample = utils.move_to_cuda(sample) if use_cuda else sample
             _loss, _sample_size, log_output = task.valid_step(sample, model, criterion)
             progress.log(log_output, step=i)
             log_outputs.append(log_output)
+            spill_writer.append(log_output["id"], log_output["prediction"], log_output["target"])
+
+        # closed before the collective below, so every spill is complete once rank 0 merges
+        spill_writer.close()
 
         if data_parallel_world_size > 1:
-            log_outputs = distributed_utils.all_gather_list(
-                log_outputs,
-                max_size=cfg.common.all_gather_list_size,
-                group=distributed_utils.get_data_parallel_group(),
-            )
-            log_outputs = list(chain.from_iterable(log_outputs))
+            log_outputs = [
+                all_gather_logging_outputs(
+                    log_outputs,
+                    tensor_keys={"prediction": torch.float, "target": torch.float},
+                    group=distributed_utils.get_data_parallel_group(),
+                )
+            ]
+
+        # every rank holds the merged outputs, only the first one writes them
+        if data_parallel_rank != 0:
+            continue
 
         with metrics.aggregate() as agg:
-            task.reduce_metrics(log_outputs, criterion, cfg.criterion)
+            task.reduce_metrics(log_outputs, criterion)
             log_output = agg.get_smoothed_values()
 
         progress.print(log_output, tag=subset, step=i)
 
+        if cfg.criterion.bootstrap > 0:
+            intervals = bootstrap_confidence_intervals(
+                cat_logging_outputs(log_outputs, "prediction"),
+                cat_logging_outputs(log_outputs, "target"),
+                cfg.criterion.bootstrap,
+                seed=cfg.criterion.bootstrap_seed,
+            )
+            for name, (low, high) in intervals.items():
+                logger.info(
+                    f"{subset} {name} 95% CI over {cfg.criterion.bootstrap} "
+                    f"bootstrap replicates: [{low:.5f}, {high:.5f}]"
+                )
+
+        merge_prediction_spills(
+            [f"{output_fn}.rank{rank}.spill" for rank in range(data_parallel_world_size)],
+            output_fn,
+            columns=("Pred", "Gold"),
+        )
+
 
 def cli_main():
     parser = options.get_validation_parser()
@@ -8,24 +8,27 @@ import logging
 import os
 import sys
 from argparse import Namespace
-from itertools import chain
 from typing import final
 
 import torch
 from omegaconf import DictConfig
 
-import faiss
-import numpy as np
-import pandas as pd
-
 import sys
 from os import path
 
 sys.path.append(path.join(path.dirname( path.abspath(__file__) ), "fairseq"))
 
 from fairseq import checkpoint_utils, distributed_utils, options, utils
+from fairseq.data import data_utils
 from fairseq.dataclass.utils import convert_namespace_to_omegaconf
 from fairseq.logging import metrics, progress_bar
+from fairseq.modules.dti_eval_utils import (
+    all_gather_logging_outputs,
+    bootstrap_confidence_intervals,
+    cat_logging_outputs,
+)
+from fairseq.modules.knn_dta_retriever import KNNDTARetriever
+from fairseq.modules.prediction_spill import PredictionSpillWriter, merge_prediction_spills
 from fairseq.utils import reset_logging
 
 logging.basicConfig(
@@ -101,8 +104,216 @@ def add_custom_arguments(parser):
     parser.add_argument('--result-file-path', type=str, default='tmp.tsv',
                         help='Where to save the result tsv file')
 
+    parser.add_argument('--dedup-entities', action='store_true',
+                        help='Encode and search every unique molecule and protein of the subset once, '
+                             'then assemble the pair predictions from the entity tables')
+
+    parser.add_argument('--entity-batch-size', type=int, default=256,
+                        help='Batch size of the entity encoding and of the pair assembly in --dedup-entities mode')
+
+    parser.add_argument('--bootstrap', type=int, metavar='N', default=0,
+                        help='Report percentile confidence intervals over N bootstrap replicates (0 disables)')
+
+    parser.add_argument('--bootstrap-seed', type=int, default=1,
+                        help='Seed of the bootstrap resampling')
+
     return parser
 
+def combine_predictions(cfg, model, retriever, prediction, cls_0, cls_1, concat, knn_cls_0=None, knn_cls_1=None,
+                        return_neighbours=False):
+    """Final prediction of a batch of pairs from their [CLS] embeddings.
+
+    *prediction* is the plain model prediction and *concat* the paired query
+    of ``retriever.make_query``; *knn_cls_0*/*knn_cls_1* are searched from
+    *concat* unless given.
+
+    With *return_neighbours*, also returns a dict of the datastore rows
+    searched for every pair: ``pairs`` for the label-wise search and
+    ``molecules``/``proteins`` for the embedding-wise one.
+    """
+    c = cfg.criterion
+    neighbours = {}
+    if retriever.use_embedding:
+        if knn_cls_0 is None and return_neighbours:
+            knn_cls_0, knn_cls_1, neighbours['molecules'], neighbours['proteins'] = retriever.search_entities(
+                concat, return_neighbours=True
+            )
+        elif knn_cls_0 is None:
+            knn_cls_0, knn_cls_1 = retriever.search_entities(concat)
+        with torch.no_grad():
+            logits_regress, _, _ = model(
+                src_tokens_0=None,
+                src_tokens_1=None,
+                knn_cls_0=knn_cls_0,
+                knn_cls_1=knn_cls_1,
+                use_which_embedding='mol_pro',
+                knn_embedding_weight_0=c.knn_embedding_weight_0,
+                knn_embedding_weight_1=c.knn_embedding_weight_1,
+                alpha=c.alpha,
+                features_only=True,
+                classification_head_name='sentence_classification_head',
+                use_only_mlp=True,
+                cls_0=cls_0,
+                cls_1=cls_1,
+            )
+        # update origin prediction
+        prediction = c.l_update * logits_regress + (1 - c.l_update) * prediction
+
+    if retriever.use_label:
+        if return_neighbours:
+            knn_prediction, neighbours['pairs'] = retriever.search_labels(concat, return_neighbours=True)
+        else:
+            knn_prediction = retriever.search_labels(concat)
+        prediction = c.l * prediction.squeeze() + (1 - c.l) * knn_prediction
+    else:
+        prediction = prediction.squeeze()
+    return (prediction, neighbours) if return_neighbours else prediction
+
+
+def evaluate_pairs(cfg, model, criterion, retriever, progress, use_cuda):
+    """Encode, search and predict every pair of every batch independently.
+
+    Yields ``(ids, log_output)`` per batch.
+    """
+    for sample in progress:
+        # shards are padded with empty batches when distributed
+        if sample is None or len(sample) == 0:
+            continue
+        sample = utils.move_to_cuda(sample) if use_cuda else sample
+        model.eval()
+        with torch.no_grad():
+            _sample_size, log_output = criterion(model, sample)
+        # get the query paired [CLS]
+        concat_tmp = retriever.make_query(log_output['cls_0'], log_output['cls_1'])
+        final_prediction = combine_predictions(
+            cfg, model, retriever, log_output['prediction'], log_output['cls_0'], log_output['cls_1'], concat_tmp
+        )
+        yield sample['id'], {
+            'final_prediction': final_prediction,
+            'target': log_output['target'],
+            'sample_size': log_output['sample_size'],
+            'ntokens': log_output['ntokens'],
+            'nsentences': log_output['nsentences'],
+        }
+
+
+def collect_unique_entities(progress):
+    """Phase 1: the unique molecule and protein token sequences of the subset.
+
+    Returns the unique sequences of each side, the index of every pair into
+    them, and the ids and targets of the pairs.
+    """
+    entities = ({}, {})
+    pair_index = ([], [])
+    ids, targets = [], []
+    for sample in progress:
+        if sample is None or len(sample) == 0:
+            continue
+        for side in range(2):
+            tokens = sample['net_input'][f'src_tokens_{side}']
+            lengths = sample['net_input'][f'src_lengths_{side}'].tolist()
+            for row, length in zip(tokens, lengths):
+                key = tuple(row[:length].tolist())
+                pair_index[side].append(entities[side].setdefault(key, len(entities[side])))
+        ids.append(sample['id'])
+        targets.append(sample['target'].view(-1))
+    return (
+        [list(entities[side].keys()) for side in range(2)],
+        [torch.tensor(pair_index[side], dtype=torch.long) for side in range(2)],
+        torch.cat(ids) if len(ids) > 0 else torch.zeros(0, dtype=torch.long),
+        torch.cat(targets).float() if len(targets) > 0 else torch.zeros(0),
+    )
+
+
+def encode_entities(encoder, sequences, pad_idx, batch_size, use_cuda, catalog=None):
+    """[CLS] embedding of every token sequence, encoded in length sorted batches.
+
+    With an entity *catalog*, the embeddings of known sequences are read from
+    it and only the others are encoded.
+    """
+    if catalog is not None:
+        param = next(encoder.parameters())
+        return catalog.get_or_encode(
+            sequences,
+            lambda missing: encode_entities(encoder, missing, pad_idx, batch_size, use_cuda),
+            device=param.device,
+            dtype=param.dtype,
+        )
+    order = sorted(range(len(sequences)), key=lambda j: len(sequences[j]))
+    cls = [None] * len(sequences)
+    for start in range(0, len(order), batch_size):
+        batch = order[start:start + batch_size]
+        tokens = data_utils.collate_tokens(
+            [torch.tensor(sequences[j], dtype=torch.long) for j in batch], pad_idx
+        )
+        tokens = utils.move_to_cuda(tokens) if use_cuda else tokens
+        with torch.no_grad():
+            x, _ = encoder(tokens, features_only=True)
+        for j, row in zip(batch, x[:, 0, :]):
+            cls[j] = row
+    return torch.stack(cls)
+
+
+def evaluate_unique_entities(cfg, task, model, retriever, progress, use_cuda):
+    """Two-phase evaluation that visits every entity of the subset once.
+
+    Phase 1 encodes every unique molecule and protein and, unless the paired
+    query couples both sides (``--sim cosine``), runs their embedding-wise
+    search. Phase 2 assembles the pair predictions from the entity tables by
+    index, leaving only the paired label search and the head per pair.
+
+    Yields ``(ids, log_output)`` per chunk of ``--entity-batch-size`` pairs.
+    """
+    batch_size = cfg.criterion.entity_batch_size
+    model.eval()
+    sequences, pair_index, ids, targets = collect_unique_entities(progress)
+    logger.info(f"{len(ids)} pairs over {len(sequences[0])} unique molecules and {len(sequences[1])} unique proteins")
+    if len(ids) == 0:
+        return
+
+    encoders = (model.encoder_0, model.encoder_1)
+    dictionaries = (task.source_dictionary_0, task.source_dictionary_1)
+    cls = [
+        encode_entities(encoders[side], sequences[side], dictionaries[side].pad(), batch_size, use_cuda)
+        for side in range(2)
+    ]
+
+    knn_cls = None
+    if retriever.use_embedding and retriever.entity_queries_are_independent:
+        searches = (retriever.search_molecules, retriever.search_proteins)
+        knn_cls = [
+            torch.cat([
+                searches[side](cls[side][start:start + batch_size].detach().float().cpu().numpy())
+                for start in range(0, len(cls[side]), batch_size)
+            ])
+            for side in range(2)
+        ]
+
+    lengths = [torch.tensor([len(seq) for seq in sequences[side]]) for side in range(2)]
+    head = model.classification_heads['sentence_classification_head']
+    for start in range(0, len(ids), batch_size):
+        index_0 = pair_index[0][start:start + batch_size]
+        index_1 = pair_index[1][start:start + batch_size]
+        cls_0, cls_1 = cls[0][index_0.to(cls[0].device)], cls[1][index_1.to(cls[1].device)]
+        with torch.no_grad():
+            prediction = head(torch.cat((cls_0, cls_1), 1).unsqueeze(1))
+        concat_tmp = retriever.make_query(cls_0, cls_1)
+        knn_cls_0 = knn_cls_1 = None
+        if knn_cls is not None:
+            knn_cls_0, knn_cls_1 = knn_cls[0][index_0.to(knn_cls[0].device)], knn_cls[1][index_1.to(knn_cls[1].device)]
+        final_prediction = combine_predictions(
+            cfg, model, retriever, prediction, cls_0, cls_1, concat_tmp, knn_cls_0, knn_cls_1
+        )
+        target = targets[start:start + batch_size]
+        yield ids[start:start + batch_size], {
+            'final_prediction': final_prediction,
+            'target': target.to(final_prediction.device),
+            'sample_size': len(target),
+            'ntokens': int(lengths[0][index_0].sum() + lengths[1][index_1].sum()),
+            'nsentences': len(target),
+        }
+
+
 def main(cfg: DictConfig, override_args=None):
     if isinstance(cfg, Namespace):
         cfg = convert_namespace_to_omegaconf(cfg)
@@ -118,41 +329,7 @@ def main(cfg: DictConfig, override_args=None):
     k_0 = cfg.criterion.k_0
     k_1 = cfg.criterion.k_1
     alpha = cfg.criterion.alpha
-    d = 768 * 2       # dimension
-    res = faiss.StandardGpuResources()  # use a single GPU
-    if cfg.criterion.prediction_mode == 'label' or cfg.criterion.prediction_mode == 'combine':
-        cls_0_np = np.load(f"{cfg.criterion.datastore_path}/cls_0.npy")
-        cls_1_np = np.load(f"{cfg.criterion.datastore_path}/cls_1.npy")
-          
-        train_label_list = [float(i.strip()) for i in open(f'{cfg.task.data}/label/train.label').readlines()]
-        cls_datastore = np.c_[cls_0_np, cls_1_np]
-
-        
-        # build a flat (CPU) index
-        if cfg.criterion.sim == "L2":
-            index_flat = faiss.IndexFlatL2(d)
-        elif cfg.criterion.sim == "cosine" or cfg.criterion.sim == "attn" or cfg.criterion.sim == "dot":
-            index_flat = faiss.IndexFlatIP(d)
-
-        # make it into a gpu index
-        gpu_index_flat = faiss.index_cpu_to_gpu(res, 0, index_flat)
-        if cfg.criterion.sim == "cosine":
-            faiss.normalize_L2(cls_datastore)
-
-        gpu_index_flat.add(cls_datastore)         # add vectors to the index
-    #############################################################################
-    if cfg.criterion.prediction_mode == 'embedding' or cfg.criterion.prediction_mode == 'combine':   
-        cls_tmp_0 = np.load(f"{cfg.criterion.datastore_path}/cls_0_unique_mol.npy")
-        cls_tmp_1 = np.load(f"{cfg.criterion.datastore_path}/cls_1_unique_pro.npy")
-        # res = faiss.StandardGpuResources()  # use a single GPU
-        # build a flat (CPU) index
-        index_flat_0 = faiss.IndexFlatL2(int(d/2))
-        index_flat_1 = faiss.IndexFlatL2(int(d/2))
-        # make it into a gpu index
-        gpu_index_flat_0 = faiss.index_cpu_to_gpu(res, 0, index_flat_0)
-        gpu_index_flat_0.add(cls_tmp_0)         # add vectors to the index
-        gpu_index_flat_1 = faiss.index_cpu_to_gpu(res, 0, index_flat_1)
-        gpu_index_flat_1.add(cls_tmp_1)         # add vectors to the index
+    retriever = KNNDTARetriever(cfg.criterion, cfg.task.data)
     #############################################################################
     utils.import_user_module(cfg.common)
 
@@ -238,125 +415,35 @@ def main(cfg: DictConfig, override_args=None):
         )
 
         log_outputs = []
+        # predictions are streamed to one spill file per rank and merged in id order at the end
+        result_file_path = f'{cfg.criterion.result_file_path}'
+        spill_writer = PredictionSpillWriter(f'{result_file_path}.rank{data_parallel_rank}.spill')
 
-        id_tensor_list = []
-        prediction_tensor_list = []
-        target_tensor_list = []
-
-        # Iterate over the 'subset' dataset
-        for i, sample in enumerate(progress):
-            sample = utils.move_to_cuda(sample) if use_cuda else sample
-            # _loss, _sample_size, log_output = task.valid_step(sample, model, criterion)
-            model.eval()
-            with torch.no_grad():
-                _sample_size, log_output = criterion(model, sample)
-            # get the query paired [CLS]
-            # if _sample_size > 1:
-            #     concat_tmp = np.c_[log_output['cls_0'].detach().cpu().numpy(), log_output['cls_1'].detach().cpu().numpy()]
-            # else:
-            #     concat_tmp = np.r_[log_output['cls_0'].detach().cpu().numpy(), log_output['cls_1'].detach().cpu().numpy()][np.newaxis, :]
-            concat_tmp = np.c_[log_output['cls_0'].detach().cpu().numpy(), log_output['cls_1'].detach().cpu().numpy()]
-            if cfg.criterion.sim == "cosine":
-                faiss.normalize_L2(concat_tmp)
-
-             
-            if cfg.criterion.prediction_mode == 'embedding' or cfg.criterion.prediction_mode == 'combine':
-                D_0, I_0 = gpu_index_flat_0.search(np.ascontiguousarray(concat_tmp[..., :int(d/2)]), k_0)
-                D_1, I_1 = gpu_index_flat_1.search(np.ascontiguousarray(concat_tmp[..., int(d/2):]), k_1)
-                V_cls_0 = np.array([cls_tmp_0[j] for i in range(_sample_size) for j in I_0[i]]).reshape(_sample_size, k_0, int(d/2))
-                V_cls_1 = np.array([cls_tmp_1[j] for i in range(_sample_size) for j in I_1[i]]).reshape(_sample_size, k_1, int(d/2))
-                               
-                V_cls_0 = torch.from_numpy(V_cls_0).cuda()
-                V_cls_1 = torch.from_numpy(V_cls_1).cuda()
-
-                D_0 = torch.tensor(D_0).cuda()
-                D_1 = torch.tensor(D_1).cuda()
-
-                if cfg.criterion.embedding_use_attn_cal:
-                    W_0 = torch.softmax(D_0 / torch.sqrt(torch.tensor(int(d/2))) , dim=1)  
-                    W_1 = torch.softmax(D_1 / torch.sqrt(torch.tensor(int(d/2))) , dim=1) 
-         
-                else:
-                    if cfg.criterion.sim == 'L2' or cfg.criterion.sim == 'dot':
-                        W_0 = torch.softmax(- D_0 / T_0, dim=1)
-                        W_1 = torch.softmax(- D_1 / T_1, dim=1)
-                    elif cfg.criterion.sim == 'cosine':
-                        W_0 = torch.softmax(D_0 / T_0, dim=1)
-                        W_1 = torch.softmax(D_1 / T_1, dim=1)
-                if cfg.criterion.embedding_use_mean_cal:
-                    knn_cls_0 = torch.mean(V_cls_0, dim=1)
-                    knn_cls_1 = torch.mean(V_cls_1, dim=1)
-                else:
-                # Weighted sum
-                    knn_cls_0 = torch.sum(W_0[:, :, None] * V_cls_0, dim=1)
-                    knn_cls_1 = torch.sum(W_1[:, :, None] * V_cls_1, dim=1)
-                
-                with torch.no_grad():
-                    # _, log_output_new_cls = criterion(model, sample, knn_cls_0=knn_cls_0, knn_cls_1=knn_cls_1, use_which_embedding='mol_pro', knn_embedding_weight_0=knn_embedding_weight_0, knn_embedding_weight_1=knn_embedding_weight_1, alpha=alpha)
-                    logits_regress, _, _ = model(
-                        src_tokens_0 = sample["net_input"]["src_tokens_0"],
-                        src_tokens_1 = sample["net_input"]["src_tokens_1"],
-                        knn_cls_0 = knn_cls_0,
-                        knn_cls_1 = knn_cls_1,
-                        use_which_embedding = 'mol_pro',
-                        knn_embedding_weight_0= knn_embedding_weight_0,
-                        knn_embedding_weight_1= knn_embedding_weight_1,
-                        alpha=alpha,
-                        features_only=True,
-                        classification_head_name='sentence_classification_head',
-                        use_only_mlp=True,
-                        cls_0=log_output['cls_0'],
-                        cls_1=log_output['cls_1'],
-                    ) 
-
-                # update origin log output
-                # log_output['prediction'] = log_output_new_cls['prediction']
-                log_output['prediction'] = l_update * logits_regress + (1 - l_update) * log_output['prediction']
-
-            if cfg.criterion.prediction_mode == 'label' or cfg.criterion.prediction_mode == 'combine':
-                D, I = gpu_index_flat.search(concat_tmp, k)
-                # _sample_size may be different in last batch
-                V = torch.tensor([train_label_list[j] for i in range(_sample_size) for j in I[i]]).reshape(_sample_size, k).cuda()
-                # W = softmax(- D / T, axis=1)
-                D = torch.tensor(D).cuda()
-                if cfg.criterion.label_use_attn_cal:
-                    W = torch.softmax(D / torch.sqrt(torch.tensor(d)) , dim=1)
-                    
-                else:
-                    if cfg.criterion.sim == 'L2' or cfg.criterion.sim == 'dot':
-                        W = torch.softmax(- D / T, dim=1)
-                    elif cfg.criterion.sim == 'cosine':
-                        W = torch.softmax(D / T, dim=1)
-                if cfg.criterion.label_use_mean_cal:
-                    knn_prediction = torch.mean(V, dim=1)
-                else:
-                    # knn_prediction = np.sum(W * V, axis=1)
-                    knn_prediction = torch.sum(W * V, dim=1)
-
-                final_prediction = l * log_output['prediction'].squeeze() + (1 - l) * knn_prediction
-
-            if cfg.criterion.prediction_mode == 'embedding':
-                final_prediction = log_output['prediction'].squeeze()
-
-            target = log_output['target']
-            log_output_tmp = {'final_prediction': final_prediction, 'target': target, 'sample_size': log_output['sample_size'], 'ntokens': log_output['ntokens'], 'nsentences': log_output['nsentences']}
+        if cfg.criterion.dedup_entities:
+            batches = evaluate_unique_entities(cfg, task, model, retriever, progress, use_cuda)
+        else:
+            batches = evaluate_pairs(cfg, model, criterion, retriever, progress, use_cuda)
+
+        for i, (ids, log_output_tmp) in enumerate(batches):
             progress.log(log_output_tmp, step=i)
             log_outputs.append(log_output_tmp)
+            spill_writer.append(ids, log_output_tmp['final_prediction'], log_output_tmp['target'])
 
-            id_tensor_list.append(sample['id'].detach().cpu().numpy())
-            prediction_tensor_list.append(final_prediction.detach().cpu().numpy())
-            target_tensor_list.append(target.detach().cpu().numpy())
-
-            
-
+        # closed before the collective below, so every spill is complete once rank 0 merges
+        spill_writer.close()
 
         if data_parallel_world_size > 1:
-            log_outputs = distributed_utils.all_gather_list(
-                log_outputs,
-                max_size=cfg.common.all_gather_list_size,
-                group=distributed_utils.get_data_parallel_group(),
-            )
-            log_outputs = list(chain.from_iterable(log_outputs))
+            log_outputs = [
+                all_gather_logging_outputs(
+                    log_outputs,
+                    tensor_keys={"final_prediction": torch.float, "target": torch.float},
+                    group=distributed_utils.get_data_parallel_group(),
+                )
+            ]
+
+        # every rank holds the merged outputs, only the first one writes them
+        if data_parallel_rank != 0:
+            continue
 
         with metrics.aggregate() as agg:
             task.reduce_metrics(log_outputs, criterion)
@@ -364,36 +451,25 @@ def main(cfg: DictConfig, override_args=None):
 
         progress.print(log_output, tag=subset, step=i)
 
-        id_list, prediction_list, target_list = [], [], []
-        for i in id_tensor_list:
-            if i.ndim == 1:
-                for j in i:
-                    id_list.append(j)
-            else: # i.ndim == 0
-                id_list.append(i)
-
-        for i in prediction_tensor_list:
-            if i.ndim == 1:
-                for j in i:
-                    prediction_list.append(j)
-            else: # i.ndim == 0
-                prediction_list.append(i)
-
-        for i in target_tensor_list:
-            if i.ndim == 1:
-                for j in i:
-                    target_list.append(j)
-            else: # i.ndim == 0
-                target_list.append(i)
-
-        df = pd.DataFrame({'prediction': prediction_list, 'target': target_list}, index=np.array(id_list))
         # 调整 training set 本身的顺序（原本为 fairseq 随机循环 batch 随机的顺序）
-        df.sort_index(inplace=True)
-        
-        df.to_csv(f'{cfg.criterion.result_file_path}', index=False, sep='\t')
+        merge_prediction_spills(
+            [f'{result_file_path}.rank{rank}.spill' for rank in range(data_parallel_world_size)],
+            result_file_path,
+            columns=('prediction', 'target'),
+        )
 
         logger.info(f"{cfg.dataset.valid_subset} on {cfg.criterion.dataset}, input size is {log_output['bsz']}\nT={T}, T_0={T_0}, T_1={T_1}, k={k}, k_0={k_0}, k_1={k_1}, l={l}, knn_embedding_weight_0={knn_embedding_weight_0}, knn_embedding_weight_1={knn_embedding_weight_1}, alpha={alpha}, prediction mode={cfg.criterion.prediction_mode}\nMSE={log_output['MSE']}\nRMSE={log_output['RMSE']}\nPC={log_output['Pearson']}\nC-index={log_output['C-index']}")
 
+        if cfg.criterion.bootstrap > 0:
+            intervals = bootstrap_confidence_intervals(
+                cat_logging_outputs(log_outputs, 'final_prediction'),
+                cat_logging_outputs(log_outputs, 'target'),
+                cfg.criterion.bootstrap,
+                seed=cfg.criterion.bootstrap_seed,
+            )
+            for name, (low, high) in intervals.items():
+                logger.info(f"{name} 95% CI over {cfg.criterion.bootstrap} bootstrap replicates: [{low:.5f}, {high:.5f}]")
+
 def cli_main():
     parser = options.get_validation_parser()
     parser = add_custom_arguments(parser)
@@ -3,16 +3,13 @@
 # This source code is licensed under the MIT license found in the
 # LICENSE file in the root directory of this source tree.
 
-import math
-
+import numpy as np
 import torch
 import torch.nn.functional as F
-from fairseq import metrics, utils
+from fairseq import utils
 from fairseq.criterions import FairseqCriterion, register_criterion
+from fairseq.modules.dti_eval_utils import cat_logging_outputs, log_regression_metrics
 
-from scipy.stats import pearsonr
-from sklearn.metrics import mean_squared_error
-from lifelines.utils import concordance_index
 from pandas import DataFrame
 
 @register_criterion("dti_separate_eval")
@@ -83,62 +80,20 @@ class DTISeparateEvalCriterion(FairseqCriterion):
     @staticmethod
     def reduce_metrics(logging_outputs, append_args=None) -> None:
         """Aggregate logging outputs from data parallel training."""
-        prediction_tensor_list = [log.get("prediction", 0) for log in logging_outputs]
-        target_tensor_list = [log.get("target", 0) for log in logging_outputs]
-        id_tensor_list = [log.get("id", 0) for log in logging_outputs]
-        sample_size = sum(log.get("sample_size", 0) for log in logging_outputs)
-        prediction_list, target_list, id_list = [], [], []
-
-        # for i in prediction_tensor_list:
-        #     if i.dim() == 1:
-        #         for j in i:
-        #             prediction_list.append(j.detach().cpu().data)
-        #     else: # i.dim() == 0
-        #         prediction_list.append(i.detach().cpu().data)
-        # for i in target_tensor_list:
-        #     if i.dim() == 1:
-        #         for j in i:
-        #             target_list.append(j.detach().cpu().data)
-        #     else: # i.dim() == 0
-        #         target_list.append(i.detach().cpu().data)
-
-        for i in prediction_tensor_list:
-            if i.dim() == 1:
-                for j in i:
-                    prediction_list.append(j.detach().cpu().numpy())
-            else: # i.dim() == 0
-                prediction_list.append(i.detach().cpu().numpy())
-        for i in target_tensor_list:
-            if i.dim() == 1:
-                for j in i:
-                    target_list.append(j.detach().cpu().numpy())
-            else: # i.dim() == 0
-                target_list.append(i.detach().cpu().numpy())
-        for i in id_tensor_list:
-            if i.dim() == 1:
-                for j in i:
-                    id_list.append(j.detach().cpu().numpy())
-            else: # i.dim() == 0
-                id_list.append(i.detach().cpu().numpy())
-
-        # round控制四舍五入的位数
-        metrics.log_scalar(
-            "MSE", mean_squared_error(prediction_list, target_list), round=5
-        )
-        metrics.log_scalar(
-            "RMSE", math.sqrt(mean_squared_error(prediction_list, target_list)), round=5
-        )
-        metrics.log_scalar(
-            "Pearson", pearsonr(prediction_list, target_list)[0], round=5
-        )
-        metrics.log_scalar(
-            "C-index", concordance_index(target_list, prediction_list), round=5
-        )
+        id_np = cat_logging_outputs(logging_outputs, "id")
+        prediction_np = cat_logging_outputs(logging_outputs, "prediction")
+        target_np = cat_logging_outputs(logging_outputs, "target")
+
+        log_regression_metrics(prediction_np, target_np)
 
-        df = DataFrame({'id': id_list, "Pred": prediction_list, "Gold": target_list})
-        df.sort_values(by=['id'], ascending=(True), inplace=True)
-        df.to_csv(append_args.output_fn, sep='\t', index=False, columns=['Pred', 'Gold'])
+        # evaluate.py streams the predictions to its own ordered spill instead
+        if getattr(append_args, "output_fn", None) is None:
+            return
 
+        # restore the dataset order, batches are visited in a shuffled order
+        order = np.argsort(id_np, kind="stable")
+        df = DataFrame({"Pred": prediction_np[order], "Gold": target_np[order]})
+        df.to_csv(append_args.output_fn, sep='\t', index=False)
 
     @staticmethod
     def logging_outputs_can_be_summed() -> bool:
@@ -3,16 +3,11 @@
 # This source code is licensed under the MIT license found in the
 # LICENSE file in the root directory of this source tree.
 
-import math
-
 import torch
 import torch.nn.functional as F
-from fairseq import metrics, modules, utils
+from fairseq import modules, utils
 from fairseq.criterions import FairseqCriterion, register_criterion
-
-from scipy.stats import pearsonr
-from sklearn.metrics import mean_squared_error
-from lifelines.utils import concordance_index
+from fairseq.modules.dti_eval_utils import cat_logging_outputs, log_regression_metrics
 
 @register_criterion("dti_separate_knn_cls_eval_no_cross_attn")
 class DTIRegressKNNCLSEvalNoCrossAttnLoss(FairseqCriterion):
@@ -92,38 +87,10 @@ class DTIRegressKNNCLSEvalNoCrossAttnLoss(FairseqCriterion):
     @staticmethod
     def reduce_metrics(logging_outputs, append_args=None) -> None:
         """Aggregate logging outputs from data parallel training."""
-        final_prediction_tensor_list = [log.get("final_prediction", 0) for log in logging_outputs]
-        target_tensor_list = [log.get("target", 0) for log in logging_outputs]
-        sample_size = sum(log.get("sample_size", 0) for log in logging_outputs)
-        final_prediction_list, target_list = [], []
-        for i in final_prediction_tensor_list:
-            if i.dim() == 1:
-                for j in i:
-                    final_prediction_list.append(j.detach().cpu().data)
-            else: # i.dim() == 0
-                final_prediction_list.append(i.detach().cpu().data)
-        for i in target_tensor_list:
-            if i.dim() == 1:
-                for j in i:
-                    target_list.append(j.detach().cpu().data)
-            else: # i.dim() == 0
-                target_list.append(i.detach().cpu().data)
-        # round控制四舍五入的位数
-        metrics.log_scalar(
-            "MSE", mean_squared_error(final_prediction_list, target_list), round=5
-        )
-        metrics.log_scalar(
-            "RMSE", math.sqrt(mean_squared_error(final_prediction_list, target_list)), round=5
-        )
-
-        metrics.log_scalar(
-            "Pearson", pearsonr(final_prediction_list, target_list)[0], round=5
-        )
-
-        # print('C-index:', concordance_index(gold, pred))
-        metrics.log_scalar(
-            "C-index", concordance_index(target_list, final_prediction_list), round=5
-        )
+        final_prediction_np = cat_logging_outputs(logging_outputs, "final_prediction")
+        target_np = cat_logging_outputs(logging_outputs, "target")
+
+        log_regression_metrics(final_prediction_np, target_np)
 
     @staticmethod
     def logging_outputs_can_be_summed() -> bool:
@@ -0,0 +1,42 @@
+import numpy as np
+
+from fairseq.data import BaseWrapperDataset
+
+
+class PairIndexedDataset(BaseWrapperDataset):
+    """Serve one item of a dataset of unique entities per pair.
+
+    Item ``i`` is ``dataset[index[i]]``, so a protein measured against many
+    compounds is stored once and looked up through the pair index.
+
+    Args:
+        dataset (FairseqDataset): dataset of unique molecules or proteins
+        index (np.ndarray): entity index of every pair
+    """
+
+    def __init__(self, dataset, index):
+        super().__init__(dataset)
+        self.index = np.asarray(index, dtype=np.int64)
+        self._sizes = np.asarray(dataset.sizes)[self.index]
+
+    def __getitem__(self, idx):
+        return self.dataset[self.index[idx]]
+
+    def __len__(self):
+        return len(self.index)
+
+    @property
+    def sizes(self):
+        return self._sizes
+
+    def num_tokens(self, index):
+        return self._sizes[index]
+
+    def size(self, index):
+        return self._sizes[index]
+
+    def ordered_indices(self):
+        return np.arange(len(self), dtype=np.int64)
+
+    def prefetch(self, indices):
+        self.dataset.prefetch(np.unique(self.index[indices]))
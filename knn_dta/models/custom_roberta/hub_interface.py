@@ -9,6 +9,7 @@ import torch.nn as nn
 import torch.nn.functional as F
 from fairseq import utils
 from fairseq.data import encoders
+from fairseq.modules.smiles_tokenizer import SmilesTokenizer
 
 
 class RobertaHubInterface(nn.Module):
@@ -80,9 +81,23 @@ class RobertaHubInterface(nn.Module):
 
         return tokens_0.long(), tokens_1.long()
     
+    @property
+    def smiles_tokenizer(self):
+        if not hasattr(self, "_smiles_tokenizer"):
+            d = self.task.source_dictionary_0
+            self._smiles_tokenizer = SmilesTokenizer(d.indices, bos=d.bos(), eos=d.eos(), unk=d.unk())
+        return self._smiles_tokenizer
+
     def myencode_mol(
-        self, sentence_0: str
+        self, sentence_0: str, tokenize: bool = False
     ) -> torch.LongTensor:
+        """Encode a tokenized (space separated) SMILES, or a raw one with
+        ``tokenize=True``."""
+        if tokenize:
+            tokens_0 = self.smiles_tokenizer.encode(sentence_0, prepend_bos=True, append_eos=True)
+            if tokens_0 is None:
+                raise ValueError("Cannot tokenize SMILES: {}".format(sentence_0))
+            return torch.from_numpy(tokens_0).long()
 
         sentence_0 = "<s> " + sentence_0 + " </s>"
         
@@ -92,6 +107,22 @@ class RobertaHubInterface(nn.Module):
 
         return tokens_0.long()
 
+    def myencode_mol_batch(
+        self, smiles: list
+    ) -> list:
+        """Encode a batch of raw SMILES with a single tokenizer pass."""
+        ids, offsets, failures = self.smiles_tokenizer.encode_batch(
+            smiles, prepend_bos=True, append_eos=True
+        )
+        if len(failures) > 0:
+            raise ValueError(
+                "Cannot tokenize SMILES at positions {}: {}".format(
+                    failures, [smiles[i] for i in failures]
+                )
+            )
+        ids = torch.from_numpy(ids).long()
+        return [ids[offsets[i]:offsets[i + 1]] for i in range(len(smiles))]
+
     def myencode_pro(
         self, sentence_1: str
     ) -> torch.LongTensor:
@@ -489,6 +520,26 @@ class RobertaHubInterface(nn.Module):
         #     )
         return features, cls_0, cls_1, cls_1_attn_0, cls_0_attn_1  # just the last layer's features
 
+    def set_entity_catalogs(self, catalog_0=None, catalog_1=None):
+        """Read the [CLS] embeddings of known molecules and proteins from
+        entity catalogs (see ``fairseq.modules.entity_catalog``), so that
+        ``myextract_features_separate*`` only encode the others."""
+        self.model.set_entity_catalogs(catalog_0, catalog_1)
+
+    def myextract_cls(self, tokens: torch.LongTensor, side: int) -> torch.Tensor:
+        """[CLS] embeddings of a batch of molecules (`side` 0) or proteins (1),
+        read from the entity catalog of that side when one is set."""
+        if tokens.dim() == 1:
+            tokens = tokens.unsqueeze(0)
+        encoder = self.model.encoder_0 if side == 0 else self.model.encoder_1
+        if tokens.size(-1) > encoder.max_positions():
+            raise ValueError(
+                "tokens_{} exceeds maximum length: {} > {}".format(
+                    side, tokens.size(-1), encoder.max_positions()
+                )
+            )
+        return self.model.extract_cls(side, tokens.to(device=self.device))
+
     def register_classification_head(
         self, name: str, num_classes: int = None, embedding_size: int = None, **kwargs
     ):
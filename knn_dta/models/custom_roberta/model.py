@@ -388,6 +388,29 @@ class RobertaClassificationHead(nn.Module):
         x = self.out_proj(x)
         return x
 
+    def project_part(self, x, part, num_parts=2):
+        """`dense` applied to one part of a concatenated input, e.g. the
+        molecule (part 0) or protein (part 1) [CLS] of a pair.
+
+        `dense` is linear, so its output on a concatenation is the sum of the
+        projections of the parts; the bias is added to part 0. Projecting
+        every entity once lets :meth:`forward_cross` score all pairs of two
+        sets of entities.
+        """
+        size = self.dense.in_features // num_parts
+        weight = self.dense.weight[:, part * size:(part + 1) * size]
+        return F.linear(x, weight, self.dense.bias if part == 0 else None)
+
+    def forward_cross(self, proj_0, proj_1):
+        """Output [M, P, num_classes] of every pair of rows of projections
+        [M, inner_dim] and [P, inner_dim] from :meth:`project_part`, the same as
+        :meth:`forward` on the M x P concatenations in eval mode."""
+        x = proj_0.unsqueeze(1) + proj_1.unsqueeze(0)
+        x = self.activation_fn(x)
+        x = self.dropout(x)
+        x = self.out_proj(x)
+        return x
+
 
 class RobertaEncoder(FairseqEncoder):
     """RoBERTa encoder."""
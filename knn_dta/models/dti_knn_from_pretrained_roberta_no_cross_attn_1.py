@@ -9,6 +9,7 @@ import torch.nn.functional as F
 from torch.functional import Tensor
 
 from fairseq import utils
+from fairseq.data import data_utils
 from fairseq.modules import MultiheadAttention
 from fairseq import checkpoint_utils
 from fairseq.models.custom_roberta.model import (
@@ -44,6 +45,8 @@ class RobertaDTIKNNFromPretrainedRobertaNoCrossAttn1(BaseFairseqModel):
         # We follow BERT's random weight initialization
         # self.apply(init_bert_params)
         self.classification_heads = nn.ModuleDict()
+        # catalogs of the [CLS] embeddings of known molecules and proteins, see set_entity_catalogs
+        self.entity_catalogs = (None, None)
         # delete this module, which is never used
         # self.cross_attn = MultiheadAttention(
         #     args.encoder_embed_dim,
@@ -312,29 +315,27 @@ class RobertaDTIKNNFromPretrainedRobertaNoCrossAttn1(BaseFairseqModel):
             if classification_head_name is not None:
                 features_only = True
 
-            x_0, extra_0 = self.encoder_0(src_tokens_0, features_only, return_all_hiddens, **kwargs)
-            
-            return x_0[:, 0, :]
+            return self.extract_cls(0, src_tokens_0, features_only, return_all_hiddens, **kwargs)
 
         else:
             if not use_only_mlp:
                 if classification_head_name is not None:
                     features_only = True
 
-                x_0, extra_0 = self.encoder_0(src_tokens_0, features_only, return_all_hiddens, **kwargs)
-                x_1, extra_1 = self.encoder_1(src_tokens_1, features_only, return_all_hiddens, **kwargs)
+                x_0 = self.extract_cls(0, src_tokens_0, features_only, return_all_hiddens, **kwargs)
+                x_1 = self.extract_cls(1, src_tokens_1, features_only, return_all_hiddens, **kwargs)
                 if classification_head_name is not None:              
                     if use_which_embedding == 'mol_pro':
-                        x = torch.cat((alpha * (knn_embedding_weight_0 * x_0[:, 0, :] + (1 - knn_embedding_weight_0) * knn_cls_0), alpha * (knn_embedding_weight_1 * x_1[:, 0, :] + (1 - knn_embedding_weight_1) * knn_cls_1)), 1).unsqueeze(1)
+                        x = torch.cat((alpha * (knn_embedding_weight_0 * x_0 + (1 - knn_embedding_weight_0) * knn_cls_0), alpha * (knn_embedding_weight_1 * x_1 + (1 - knn_embedding_weight_1) * knn_cls_1)), 1).unsqueeze(1)
                         # x = torch.cat(((knn_embedding_weight_0 * x_0[:, 0, :] + (1 - knn_embedding_weight_0) * knn_cls_0), (knn_embedding_weight_1 * x_1[:, 0, :] + (1 - knn_embedding_weight_1) * knn_cls_1)), 1).unsqueeze(1)
                     else:
-                        x = torch.cat((x_0[:, 0, :], x_1[:, 0, :]), 1).unsqueeze(1)
+                        x = torch.cat((x_0, x_1), 1).unsqueeze(1)
                     if isinstance(x, Tensor):
                         x = GradMultiply.apply(x, self.args.grad_multiply)
                     x = self.classification_heads[classification_head_name](x)
 
                 # return x, x_0[:, 0, :].squeeze(), x_1[:, 0, :].squeeze()
-                return x, x_0[:, 0, :], x_1[:, 0, :]
+                return x, x_0, x_1
                 # return x, x_0[:, 0, :], x_1[:, 0, :], x_0[:, 0, :], x_1[:, 0, :]
             else:
                 if classification_head_name is not None:              
@@ -352,6 +353,70 @@ class RobertaDTIKNNFromPretrainedRobertaNoCrossAttn1(BaseFairseqModel):
   
     
 
+    def set_entity_catalogs(self, catalog_0=None, catalog_1=None):
+        """Read the [CLS] embeddings of known molecules (`catalog_0`) and
+        proteins (`catalog_1`) from :class:`~fairseq.modules.entity_catalog.EntityCatalog`
+        instances in eval mode, so that the encoders only run on the others."""
+        self.entity_catalogs = (catalog_0, catalog_1)
+
+    def extract_cls(self, side, src_tokens, features_only=True, return_all_hiddens=False, **kwargs):
+        """[CLS] features [B, D] of the molecule (`side` 0) or protein (1)
+        encoder, read from its entity catalog for the known entities when one
+        is set and only the features are asked for in eval mode."""
+        encoder = self.encoder_0 if side == 0 else self.encoder_1
+        catalog = self.entity_catalogs[side]
+        if catalog is None or self.training or not features_only or return_all_hiddens:
+            x, _ = encoder(src_tokens, features_only, return_all_hiddens, **kwargs)
+            return x[:, 0, :]
+
+        pad = encoder.dictionary.pad()
+        sequences = [row[row.ne(pad)] for row in src_tokens.cpu()]
+
+        def encode(missing):
+            tokens = data_utils.collate_tokens(missing, pad).to(src_tokens.device)
+            x, _ = encoder(tokens, features_only, return_all_hiddens, **kwargs)
+            return x[:, 0, :]
+
+        param = next(encoder.parameters())
+        return catalog.get_or_encode(sequences, encode, device=src_tokens.device, dtype=param.dtype)
+
+    def iter_cross_product_scores(
+        self,
+        cls_0,
+        cls_1,
+        knn_cls_0=None,
+        knn_cls_1=None,
+        knn_embedding_weight_0=0.8,
+        knn_embedding_weight_1=0.8,
+        alpha=0.707,
+        classification_head_name='sentence_classification_head',
+        max_tile_elements=1 << 26,
+    ):
+        """Scores of every molecule of `cls_0` [M, D] with every protein of
+        `cls_1` [P, D], yielded as `(start, scores)` tiles of the rows
+        start:start + len(scores), scores being [rows, P, num_classes].
+
+        Equal to the head on the M x P concatenated [CLS] pairs, blended with
+        `knn_cls_0`/`knn_cls_1` as ``use_which_embedding='mol_pro'`` does when
+        they are given, but `dense` runs once per entity and the pairs only
+        cost a broadcast add, the activation and `out_proj`. A tile holds at
+        most `max_tile_elements` pre-activations.
+        """
+        if knn_cls_0 is not None or knn_cls_1 is not None:
+            assert knn_cls_0 is not None and knn_cls_1 is not None, "the kNN embeddings of both sides are blended"
+            cls_0 = alpha * (knn_embedding_weight_0 * cls_0 + (1 - knn_embedding_weight_0) * knn_cls_0)
+            cls_1 = alpha * (knn_embedding_weight_1 * cls_1 + (1 - knn_embedding_weight_1) * knn_cls_1)
+        head = self.classification_heads[classification_head_name]
+        proj_1 = head.project_part(cls_1, 1)
+        rows = max(1, max_tile_elements // max(1, proj_1.size(0) * proj_1.size(1)))
+        for start in range(0, cls_0.size(0), rows):
+            proj_0 = head.project_part(cls_0[start:start + rows], 0)
+            yield start, head.forward_cross(proj_0, proj_1)
+
+    def cross_product_scores(self, cls_0, cls_1, **kwargs):
+        """[M, P, num_classes] scores of :meth:`iter_cross_product_scores`."""
+        return torch.cat([scores for _, scores in self.iter_cross_product_scores(cls_0, cls_1, **kwargs)])
+
     def my_register_classification_head(
         self, name, num_classes=None, inner_dim=None, **kwargs
     ):
@@ -0,0 +1,204 @@
+import fcntl
+import hashlib
+import json
+import os
+
+import numpy as np
+import torch
+
+
+CATALOG_VERSION = 1
+ENTITIES = ("molecule", "protein")
+# keys are 128 bits: the first word is sorted and searched, the second one verified
+KEY_DTYPE = np.dtype("<u8")
+
+
+def checkpoint_hash(checkpoint_fn, block=1 << 24):
+    sha = hashlib.sha1()
+    with open(checkpoint_fn, "rb") as f:
+        for chunk in iter(lambda: f.read(block), b""):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+
+def sequence_keys(sequences):
+    """uint64[N, 2] key of every token sequence (list, array or tensor of ids), a 128 bit hash of its ids."""
+    keys = np.empty((len(sequences), 2), dtype=KEY_DTYPE)
+    for i, ids in enumerate(sequences):
+        if torch.is_tensor(ids):
+            ids = ids.cpu().numpy()
+        digest = hashlib.blake2b(np.asarray(ids, dtype=np.int64).tobytes(), digest_size=16).digest()
+        keys[i] = np.frombuffer(digest, dtype=KEY_DTYPE)
+    return keys
+
+
+class EntityCatalog(object):
+    """[CLS] embeddings of the entities of one encoder, keyed by the hash of their token ids.
+
+    Stored as ``{prefix}.json`` (checkpoint hash, entity, embedding size),
+    ``{prefix}.keys`` (two uint64 per row) and ``{prefix}.f32`` (the rows as
+    raw float32). Both files are append-only and memory mapped, so a catalog
+    of a whole proteome can be populated offline and read by any number of
+    processes; :meth:`refresh` picks up the rows appended by others. Writers
+    lock the key file, rows are written before their keys. A catalog only
+    serves the checkpoint it was built with.
+    """
+
+    def __init__(self, prefix, checkpoint, dim, entity, readonly=False):
+        self.prefix = prefix
+        self.dim = dim
+        self.readonly = readonly
+        meta = {"version": CATALOG_VERSION, "checkpoint": checkpoint, "entity": entity, "dim": dim}
+        if os.path.exists(prefix + ".json"):
+            with open(prefix + ".json") as f:
+                found = json.load(f)
+            if found.get("version") != CATALOG_VERSION:
+                raise ValueError("{} was written by another version of the catalog, rebuild it".format(prefix))
+            if found != meta:
+                raise ValueError("{} holds the {} embeddings of another checkpoint".format(prefix, found["entity"]))
+        elif readonly:
+            raise FileNotFoundError("No entity catalog at {}".format(prefix))
+        else:
+            with open(prefix + ".keys", "ab"), open(prefix + ".f32", "ab"):
+                pass
+            with open(prefix + ".json", "w") as f:
+                json.dump(meta, f)
+        if not readonly:
+            with self._locked():
+                # rows without a key are left over from an interrupted writer
+                count = os.path.getsize(prefix + ".keys") // (2 * KEY_DTYPE.itemsize)
+                if os.path.getsize(prefix + ".f32") > count * dim * 4:
+                    os.truncate(prefix + ".f32", count * dim * 4)
+        self.count = 0
+        self.keys = np.empty((0, 2), dtype=KEY_DTYPE)
+        self.table = np.empty((0, dim), dtype=np.float32)
+        self._sorted_rows = np.empty(0, dtype=np.int64)
+        self._sorted_keys = np.empty(0, dtype=KEY_DTYPE)
+        self._recent = {}
+        self.refresh()
+
+    def __len__(self):
+        return self.count
+
+    def _locked(self):
+        return _FileLock(self.prefix + ".keys")
+
+    def refresh(self):
+        """Map the rows appended since the last refresh, by this or another process."""
+        count = os.path.getsize(self.prefix + ".keys") // (2 * KEY_DTYPE.itemsize)
+        if count == self.count:
+            return
+        self.keys = np.memmap(self.prefix + ".keys", dtype=KEY_DTYPE, mode="r", shape=(count, 2))
+        self.table = np.memmap(self.prefix + ".f32", dtype=np.float32, mode="r", shape=(count, self.dim))
+        # new rows are looked up in a dict until there are enough of them to sort the index again
+        if count - len(self._sorted_rows) > max(1 << 16, len(self._sorted_rows) // 8):
+            self._sorted_rows = np.argsort(self.keys[:, 0], kind="stable")
+            self._sorted_keys = np.asarray(self.keys[self._sorted_rows, 0])
+            self._recent = {}
+        else:
+            for row in range(self.count, count):
+                self._recent[tuple(self.keys[row])] = row
+        self.count = count
+
+    def find(self, keys):
+        """Row of every key of `keys` (uint64[N, 2]), -1 for those not in the catalog."""
+        keys = np.asarray(keys, dtype=KEY_DTYPE).reshape(-1, 2)
+        rows = np.full(len(keys), -1, dtype=np.int64)
+        n = len(self._sorted_rows)
+        if n:
+            pos = np.searchsorted(self._sorted_keys, keys[:, 0])
+            at = np.minimum(pos, n - 1)
+            candidates = self._sorted_rows[at]
+            same_first = (pos < n) & (self._sorted_keys[at] == keys[:, 0])
+            hit = same_first & (self.keys[candidates, 1] == keys[:, 1])
+            rows[hit] = candidates[hit]
+            # the first words of distinct keys are almost never equal, the rest of their run is scanned
+            for i in np.flatnonzero(same_first & ~hit):
+                for p in range(pos[i] + 1, n):
+                    if self._sorted_keys[p] != keys[i, 0]:
+                        break
+                    if self.keys[self._sorted_rows[p], 1] == keys[i, 1]:
+                        rows[i] = self._sorted_rows[p]
+                        break
+        if self._recent:
+            for i in np.flatnonzero(rows < 0):
+                rows[i] = self._recent.get(tuple(keys[i]), -1)
+        return rows
+
+    def add(self, keys, cls):
+        """Append the embeddings `cls` [N, dim] of `keys`, skipping those already in the catalog."""
+        if self.readonly:
+            raise ValueError("{} is opened read-only".format(self.prefix))
+        keys = np.asarray(keys, dtype=KEY_DTYPE).reshape(-1, 2)
+        cls = np.asarray(cls, dtype=np.float32).reshape(-1, self.dim)
+        with self._locked():
+            self.refresh()
+            _, first = np.unique(keys, axis=0, return_index=True)
+            new = np.sort(first)
+            new = new[self.find(keys[new]) < 0]
+            if len(new) == 0:
+                return
+            with open(self.prefix + ".f32", "ab") as f:
+                f.write(np.ascontiguousarray(cls[new]).tobytes())
+            with open(self.prefix + ".keys", "ab") as f:
+                f.write(np.ascontiguousarray(keys[new]).tobytes())
+            self.refresh()
+
+    def get_or_encode(self, sequences, encode, device=None, dtype=None):
+        """[CLS] embeddings of token sequences, read from the catalog.
+
+        Only the sequences not in the catalog are passed to `encode`, which
+        returns their embeddings as a tensor; they are added to the catalog
+        unless it is read-only. The result is on the device and of the dtype
+        of `encode`'s output, or of `device` and `dtype` when given.
+        """
+        self.refresh()
+        keys = sequence_keys(sequences)
+        rows = self.find(keys)
+        missing = np.flatnonzero(rows < 0)
+        # duplicated misses are encoded once
+        _, first, inverse = np.unique(keys[missing], axis=0, return_index=True, return_inverse=True)
+        encoded = None
+        if len(missing):
+            encoded = encode([sequences[i] for i in missing[first]])
+            device = encoded.device if device is None else device
+            dtype = encoded.dtype if dtype is None else dtype
+            if not self.readonly:
+                self.add(keys[missing[first]], encoded.detach().float().cpu().numpy())
+        found = np.flatnonzero(rows >= 0)
+        cls = torch.empty(len(sequences), self.dim, device=device, dtype=dtype or torch.float32)
+        if len(found):
+            cls[torch.from_numpy(found).to(cls.device)] = torch.from_numpy(
+                np.asarray(self.table[rows[found]])
+            ).to(device=cls.device, dtype=cls.dtype)
+        if encoded is not None:
+            cls[torch.from_numpy(missing).to(cls.device)] = encoded.to(cls.dtype)[
+                torch.from_numpy(inverse.reshape(-1)).to(encoded.device)
+            ].to(cls.device)
+        return cls
+
+
+def open_entity_catalogs(prefix_0, prefix_1, checkpoint_fn, dim, readonly=False):
+    """Catalogs of the molecule (`prefix_0`) and protein (`prefix_1`) encoders of a checkpoint, None for a side
+    without a prefix."""
+    checkpoint = checkpoint_hash(checkpoint_fn) if prefix_0 or prefix_1 else None
+    return tuple(
+        EntityCatalog(prefix, checkpoint, dim, entity, readonly=readonly) if prefix else None
+        for prefix, entity in zip((prefix_0, prefix_1), ENTITIES)
+    )
+
+
+class _FileLock(object):
+    """Exclusive lock on a file, held by one writer across processes."""
+
+    def __init__(self, path):
+        self.path = path
+
+    def __enter__(self):
+        self.file = open(self.path, "ab")
+        fcntl.flock(self.file, fcntl.LOCK_EX)
+        return self
+
+    def __exit__(self, *exc):
+        fcntl.flock(self.file, fcntl.LOCK_UN)
+        self.file.close()
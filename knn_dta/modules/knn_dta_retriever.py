@@ -0,0 +1,146 @@
+import faiss
+import numpy as np
+import torch
+
+
+class KNNDTARetriever(object):
+    """Inference-time kNN retrieval of ``evaluate_kNN.py``.
+
+    Holds the flat GPU indexes built from a datastore and turns [CLS]
+    embeddings into the label-wise kNN prediction (paired search over
+    ``cls_0.npy``/``cls_1.npy``) and the embedding-wise neighbour embeddings
+    ``knn_cls_0``/``knn_cls_1`` (search over ``cls_0_unique_mol.npy`` and
+    ``cls_1_unique_pro.npy``), depending on ``args.prediction_mode``.
+    """
+
+    def __init__(self, args, data, embed_dim=768):
+        self.args = args
+        self.d = embed_dim * 2
+        self.res = faiss.StandardGpuResources()  # use a single GPU
+
+        if args.prediction_mode == 'label' or args.prediction_mode == 'combine':
+            cls_0_np = np.load(f"{args.datastore_path}/cls_0.npy")
+            cls_1_np = np.load(f"{args.datastore_path}/cls_1.npy")
+            self.train_labels = np.array(
+                [float(i.strip()) for i in open(f'{data}/label/train.label').readlines()],
+                dtype=np.float32,
+            )
+            cls_datastore = np.c_[cls_0_np, cls_1_np]
+
+            # build a flat (CPU) index
+            if args.sim == "L2":
+                index_flat = faiss.IndexFlatL2(self.d)
+            elif args.sim == "cosine" or args.sim == "attn" or args.sim == "dot":
+                index_flat = faiss.IndexFlatIP(self.d)
+
+            # make it into a gpu index
+            self.gpu_index_flat = faiss.index_cpu_to_gpu(self.res, 0, index_flat)
+            if args.sim == "cosine":
+                faiss.normalize_L2(cls_datastore)
+            self.gpu_index_flat.add(cls_datastore)
+
+        if args.prediction_mode == 'embedding' or args.prediction_mode == 'combine':
+            self.cls_tmp_0 = np.load(f"{args.datastore_path}/cls_0_unique_mol.npy")
+            self.cls_tmp_1 = np.load(f"{args.datastore_path}/cls_1_unique_pro.npy")
+            self.gpu_index_flat_0 = faiss.index_cpu_to_gpu(self.res, 0, faiss.IndexFlatL2(embed_dim))
+            self.gpu_index_flat_0.add(self.cls_tmp_0)
+            self.gpu_index_flat_1 = faiss.index_cpu_to_gpu(self.res, 0, faiss.IndexFlatL2(embed_dim))
+            self.gpu_index_flat_1.add(self.cls_tmp_1)
+
+    @property
+    def use_label(self):
+        return self.args.prediction_mode == 'label' or self.args.prediction_mode == 'combine'
+
+    @property
+    def use_embedding(self):
+        return self.args.prediction_mode == 'embedding' or self.args.prediction_mode == 'combine'
+
+    @property
+    def entity_queries_are_independent(self):
+        """Whether the molecule query does not depend on the paired protein.
+
+        With ``--sim cosine`` the paired [CLS] vector is normalised as a whole
+        before its halves are searched, which couples both entities.
+        """
+        return self.args.sim != 'cosine'
+
+    def make_query(self, cls_0, cls_1):
+        """Paired float32 query of [CLS] tensors, normalised for ``--sim cosine``."""
+        concat = np.c_[cls_0.detach().float().cpu().numpy(), cls_1.detach().float().cpu().numpy()]
+        if self.args.sim == "cosine":
+            faiss.normalize_L2(concat)
+        return concat
+
+    def _neighbour_embedding(self, index, table, query, k, T, return_neighbours=False):
+        D, I = index.search(np.ascontiguousarray(query), k)
+        V = torch.from_numpy(table[I]).cuda()
+        D = torch.tensor(D).cuda()
+
+        if self.args.embedding_use_attn_cal:
+            W = torch.softmax(D / torch.sqrt(torch.tensor(int(self.d / 2))), dim=1)
+        else:
+            if self.args.sim == 'L2' or self.args.sim == 'dot':
+                W = torch.softmax(- D / T, dim=1)
+            elif self.args.sim == 'cosine':
+                W = torch.softmax(D / T, dim=1)
+        if self.args.embedding_use_mean_cal:
+            knn_cls = torch.mean(V, dim=1)
+        else:
+            # Weighted sum
+            knn_cls = torch.sum(W[:, :, None] * V, dim=1)
+        return (knn_cls, I) if return_neighbours else knn_cls
+
+    def search_molecules(self, query_0, return_neighbours=False):
+        """kNN molecule embedding of each row of a molecule query.
+
+        With *return_neighbours*, also returns the rows of
+        ``cls_0_unique_mol.npy`` it is made of.
+        """
+        return self._neighbour_embedding(
+            self.gpu_index_flat_0, self.cls_tmp_0, query_0, self.args.k_0, self.args.T_0, return_neighbours
+        )
+
+    def search_proteins(self, query_1, return_neighbours=False):
+        """kNN protein embedding of each row of a protein query.
+
+        With *return_neighbours*, also returns the rows of
+        ``cls_1_unique_pro.npy`` it is made of.
+        """
+        return self._neighbour_embedding(
+            self.gpu_index_flat_1, self.cls_tmp_1, query_1, self.args.k_1, self.args.T_1, return_neighbours
+        )
+
+    def search_entities(self, concat, return_neighbours=False):
+        """``knn_cls_0`` and ``knn_cls_1`` of a paired query from :meth:`make_query`.
+
+        With *return_neighbours*, returns ``(knn_cls_0, knn_cls_1, rows_0, rows_1)``.
+        """
+        half = int(self.d / 2)
+        if return_neighbours:
+            knn_cls_0, rows_0 = self.search_molecules(concat[..., :half], return_neighbours=True)
+            knn_cls_1, rows_1 = self.search_proteins(concat[..., half:], return_neighbours=True)
+            return knn_cls_0, knn_cls_1, rows_0, rows_1
+        return self.search_molecules(concat[..., :half]), self.search_proteins(concat[..., half:])
+
+    def search_labels(self, concat, return_neighbours=False):
+        """Label-wise kNN prediction of a paired query from :meth:`make_query`.
+
+        With *return_neighbours*, also returns the train pairs (rows of
+        ``cls_0.npy``/``cls_1.npy`` and lines of ``train.label``) it is made of.
+        """
+        k = self.args.k
+        D, I = self.gpu_index_flat.search(concat, k)
+        V = torch.from_numpy(self.train_labels[I]).cuda()
+        D = torch.tensor(D).cuda()
+        if self.args.label_use_attn_cal:
+            W = torch.softmax(D / torch.sqrt(torch.tensor(self.d)), dim=1)
+        else:
+            if self.args.sim == 'L2' or self.args.sim == 'dot':
+                W = torch.softmax(- D / self.args.T, dim=1)
+            elif self.args.sim == 'cosine':
+                W = torch.softmax(D / self.args.T, dim=1)
+        if self.args.label_use_mean_cal:
+            knn_prediction = torch.mean(V, dim=1)
+        else:
+            knn_prediction = torch.sum(W * V, dim=1)
+        return (knn_prediction, I) if return_neighbours else knn_prediction
@@ -0,0 +1,133 @@
+import os
+
+import numpy as np
+import torch
+from pandas import DataFrame
+
+
+SPILL_DTYPE = np.dtype([("id", "<i8"), ("prediction", "<f4"), ("target", "<f4")])
+
+
+def _to_numpy(x, dtype):
+    if torch.is_tensor(x):
+        x = x.detach().cpu().numpy()
+    return np.asarray(x, dtype=dtype).reshape(-1)
+
+
+class PredictionSpillWriter(object):
+    """Append ``(id, prediction, target)`` rows to a binary spill file.
+
+    Rows are buffered in memory and written as runs sorted by id once
+    *run_size* rows are pending, so memory stays bounded by one run whatever
+    the size of the evaluated subset. The length of every run is kept in a
+    ``<path>.runs.npy`` sidecar, which :func:`merge_prediction_spills` uses to
+    produce the id-ordered TSV.
+    """
+
+    def __init__(self, path, run_size=1 << 20):
+        self.path = path
+        self.run_size = run_size
+        self._file = open(path, "wb")
+        self._pending = []
+        self._num_pending = 0
+        self._run_lengths = []
+
+    def append(self, ids, predictions, targets):
+        ids = _to_numpy(ids, np.int64)
+        records = np.empty(len(ids), dtype=SPILL_DTYPE)
+        records["id"] = ids
+        records["prediction"] = _to_numpy(predictions, np.float32)
+        records["target"] = _to_numpy(targets, np.float32)
+
+        self._pending.append(records)
+        self._num_pending += len(records)
+        if self._num_pending >= self.run_size:
+            self._flush_run()
+
+    def _flush_run(self):
+        if self._num_pending == 0:
+            return
+        run = np.concatenate(self._pending)
+        run = run[np.argsort(run["id"], kind="stable")]
+        run.tofile(self._file)
+        self._run_lengths.append(len(run))
+        self._pending = []
+        self._num_pending = 0
+
+    def close(self):
+        if self._file is None:
+            return
+        self._flush_run()
+        self._file.close()
+        self._file = None
+        np.save(self.path + ".runs.npy", np.asarray(self._run_lengths, dtype=np.int64))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def _open_runs(path):
+    lengths = np.load(path + ".runs.npy")
+    if lengths.sum() == 0:
+        return []
+    records = np.memmap(path, dtype=SPILL_DTYPE, mode="r")
+    bounds = np.concatenate([[0], np.cumsum(lengths)])
+    return [records[s:e] for s, e in zip(bounds[:-1], bounds[1:]) if e > s]
+
+
+def merge_prediction_spills(
+    paths,
+    output_fn,
+    columns=("prediction", "target"),
+    block_size=1 << 16,
+    remove=True,
+):
+    """K-way merge the sorted runs of one or more spill files into a TSV.
+
+    Every run keeps a buffer of at most *block_size* rows, refilled from the
+    file only once it is used up. Each step writes out the buffered rows whose
+    id does not exceed the smallest buffer maximum, which no unread row can
+    precede, so memory stays at about one block per run. Per-shard spills of
+    parallel workers are merged the same way. Only the prediction and target
+    columns are written, with the names given by *columns*, matching the
+    in-memory ``DataFrame.to_csv`` output.
+    """
+    runs = [run for path in paths for run in _open_runs(path)]
+    cursors = [0] * len(runs)
+    buffers = [np.empty(0, dtype=SPILL_DTYPE) for _ in runs]
+    header = True
+    with open(output_fn, "w") as f:
+        while True:
+            for i, run in enumerate(runs):
+                if len(buffers[i]) == 0 and cursors[i] < len(run):
+                    buffers[i] = np.asarray(run[cursors[i]: cursors[i] + block_size])
+                    cursors[i] += len(buffers[i])
+            active = [i for i in range(len(runs)) if len(buffers[i]) > 0]
+            if not active:
+                break
+
+            # the buffer holding the smallest maximum is used up in this step
+            limit = min(buffers[i]["id"][-1] for i in active)
+            blocks = []
+            for i in active:
+                split = np.searchsorted(buffers[i]["id"], limit, side="right")
+                blocks.append(buffers[i][:split])
+                buffers[i] = buffers[i][split:]
+            ready = np.concatenate(blocks)
+            ready = ready[np.argsort(ready["id"], kind="stable")]
+
+            DataFrame(
+                {columns[0]: ready["prediction"], columns[1]: ready["target"]}
+            ).to_csv(f, sep="\t", index=False, header=header)
+            header = False
+        if header:
+            DataFrame({columns[0]: [], columns[1]: []}).to_csv(f, sep="\t", index=False)
+
+    if remove:
+        del runs
+        for path in paths:
+            os.remove(path)
+            os.remove(path + ".runs.npy")
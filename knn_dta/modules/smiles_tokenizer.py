@@ -0,0 +1,81 @@
+import io
+import re
+
+import numpy as np
+
+
+SMILES_PATTERN = r"(\[[^\]]+]|Br?|Cl?|N|O|S|P|F|I|b|c|n|o|s|p|\(|\)|\.|=|#|-|\+|\\|\/|:|~|@|\?|>|\*|\$|\%[0-9]{2}|[0-9])"
+
+# compiled once per process, i.e. once per preprocessing worker
+SMILES_REGEX = re.compile(SMILES_PATTERN)
+WHITESPACE_REGEX = re.compile(r"\s+")
+
+
+class SmilesTokenizer(object):
+    """Regex SMILES tokenizer that maps tokens straight to dictionary ids.
+
+    Uses the same pattern as ``preprocess/tokenize_re.py``. A SMILES is
+    untokenizable when the tokens do not cover every non-whitespace
+    character. Tokens missing from the dictionary map to ``unk`` as in
+    ``Dictionary.encode_line``.
+    """
+
+    def __init__(self, indices, bos=0, eos=2, unk=3):
+        self.indices = indices
+        self.bos = bos
+        self.eos = eos
+        self.unk = unk
+
+    @classmethod
+    def from_dict_file(cls, dict_fn):
+        """Load a fairseq ``dict.txt``, whose symbols follow <s>, <pad>, </s> and <unk>."""
+        with io.open(dict_fn, 'r', encoding='utf8') as f:
+            symbols = [line.rstrip().rsplit(' ', 1)[0] for line in f if line.strip()]
+        return cls({symbol: 4 + i for i, symbol in enumerate(symbols)})
+
+    @staticmethod
+    def tokenize(smi):
+        """Tokens of `smi`, or None if some characters are not covered."""
+        tokens = SMILES_REGEX.findall(smi)
+        if ''.join(tokens) != WHITESPACE_REGEX.sub('', smi):
+            return None
+        return tokens
+
+    def encode(self, smi, prepend_bos=False, append_eos=True):
+        """int32 ids of one SMILES, or None if it is untokenizable."""
+        tokens = self.tokenize(smi)
+        if tokens is None:
+            return None
+        get, unk = self.indices.get, self.unk
+        ids = [get(token, unk) for token in tokens]
+        if prepend_bos:
+            ids.insert(0, self.bos)
+        if append_eos:
+            ids.append(self.eos)
+        return np.array(ids, dtype=np.int32)
+
+    def encode_batch(self, smiles, prepend_bos=False, append_eos=True):
+        """Encode a batch of SMILES into one flat id array.
+
+        Returns:
+            tuple: ``(ids, offsets, failures)`` where the ids of ``smiles[i]``
+            are ``ids[offsets[i]:offsets[i + 1]]`` and ``failures`` lists the
+            positions of the untokenizable inputs, which get no ids.
+        """
+        get, unk = self.indices.get, self.unk
+        ids, lengths, failures = [], [], []
+        for i, smi in enumerate(smiles):
+            tokens = self.tokenize(smi)
+            if tokens is None:
+                failures.append(i)
+                lengths.append(0)
+                continue
+            if prepend_bos:
+                ids.append(self.bos)
+            ids.extend([get(token, unk) for token in tokens])
+            if append_eos:
+                ids.append(self.eos)
+            lengths.append(len(tokens) + int(prepend_bos) + int(append_eos))
+        offsets = np.zeros(len(smiles) + 1, dtype=np.int64)
+        np.cumsum(lengths, out=offsets[1:])
+        return np.array(ids, dtype=np.int32), offsets, failures
@@ -41,6 +41,9 @@ class DTISeparateAddMaskTokenTask(LegacyFairseqTask):
         dictionary (Dictionary): the dictionary for the input of the task
     """
 
+    # directories of the molecule and protein datasets and their dictionaries
+    entity_dirs = ("input0", "input1")
+
     @staticmethod
     def add_args(parser):
         """Add task-specific arguments to the parser."""
@@ -106,14 +109,14 @@ class DTISeparateAddMaskTokenTask(LegacyFairseqTask):
         # load data dictionary
         data_dict_0 = cls.load_dictionary(
             args,
-            os.path.join(args.data, "input0", "dict.txt"),
+            os.path.join(args.data, cls.entity_dirs[0], "dict.txt"),
             source=True,
         )
         logger.info("[input] dictionary: {} types".format(len(data_dict_0)))
 
         data_dict_1 = cls.load_dictionary(
             args,
-            os.path.join(args.data, "input1", "dict.txt"),
+            os.path.join(args.data, cls.entity_dirs[1], "dict.txt"),
             source=True,
         )
         logger.info("[input] dictionary: {} types".format(len(data_dict_1)))
@@ -132,14 +135,11 @@ class DTISeparateAddMaskTokenTask(LegacyFairseqTask):
 
         return cls(args, data_dict_0, data_dict_1, label_dict)
 
-    def load_dataset(self, split, combine=False, **kwargs):
-        """Load a given dataset split (e.g., train, valid, test)."""
-
-        def get_path(type, split):
-            return os.path.join(self.args.data, type, split)
+    def load_entity_datasets(self, split, combine=False):
+        """Load the per-pair molecule and protein token datasets of a split."""
 
         def make_dataset(type, dictionary):
-            split_path = get_path(type, split)
+            split_path = os.path.join(self.args.data, type, split)
 
             dataset = data_utils.load_indexed_dataset(
                 split_path,
@@ -147,16 +147,20 @@ class DTISeparateAddMaskTokenTask(LegacyFairseqTask):
                 self.args.dataset_impl,
                 combine=combine,
             )
+            assert dataset is not None, "could not find dataset: {}".format(split_path)
             return dataset
 
-        input0 = make_dataset("input0", self.source_dictionary_0)
-        assert input0 is not None, "could not find dataset: {}".format(
-            get_path(type, split)
-        )
-        input1 = make_dataset("input1", self.source_dictionary_1)
-        assert input1 is not None, "could not find dataset: {}".format(
-            get_path(type, split)
-        )
+        input0 = make_dataset(self.entity_dirs[0], self.source_dictionary_0)
+        input1 = make_dataset(self.entity_dirs[1], self.source_dictionary_1)
+        return input0, input1
+
+    def load_dataset(self, split, combine=False, **kwargs):
+        """Load a given dataset split (e.g., train, valid, test)."""
+
+        def get_path(type, split):
+            return os.path.join(self.args.data, type, split)
+
+        input0, input1 = self.load_entity_datasets(split, combine=combine)
 
         if self.args.init_token is not None:
             input0 = PrependTokenDataset(input0, self.args.init_token)
@@ -0,0 +1,50 @@
+import logging
+import os
+
+import numpy as np
+from fairseq.data import data_utils
+from fairseq.data.pair_indexed_dataset import PairIndexedDataset
+from fairseq.tasks import register_task
+from fairseq.tasks.dti_separate_add_mask_token import DTISeparateAddMaskTokenTask
+
+
+logger = logging.getLogger(__name__)
+
+
+@register_task("dti_separate_add_mask_token_unique_entity")
+class DTISeparateAddMaskTokenUniqueEntityTask(DTISeparateAddMaskTokenTask):
+    """
+    Same task as ``dti_separate_add_mask_token`` on the unique-entity layout:
+    every distinct molecule and protein of a split is stored once in
+    ``input0_unique`` / ``input1_unique`` and ``pairs/{split}.npy`` holds the
+    ``(mol_idx, pro_idx)`` of every pair, in the order of ``label/{split}.label``.
+    Build it from a regular binarized dataset with
+    ``preprocess/build_unique_bin.py``.
+    """
+
+    entity_dirs = ("input0_unique", "input1_unique")
+
+    def load_entity_datasets(self, split, combine=False):
+        pairs_path = os.path.join(self.args.data, "pairs", "{}.npy".format(split))
+        assert os.path.exists(pairs_path), "could not find pair index: {}".format(pairs_path)
+        pairs = np.load(pairs_path, mmap_mode="r")
+
+        datasets = []
+        for side, (type, dictionary) in enumerate(
+            zip(self.entity_dirs, [self.source_dictionary_0, self.source_dictionary_1])
+        ):
+            split_path = os.path.join(self.args.data, type, split)
+            dataset = data_utils.load_indexed_dataset(
+                split_path,
+                dictionary,
+                self.args.dataset_impl,
+                combine=combine,
+            )
+            assert dataset is not None, "could not find dataset: {}".format(split_path)
+            logger.info(
+                "loaded {} unique entities for {} pairs from {}".format(
+                    len(dataset), len(pairs), split_path
+                )
+            )
+            datasets.append(PairIndexedDataset(dataset, pairs[:, side]))
+        return datasets[0], datasets[1]
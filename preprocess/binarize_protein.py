@@ -0,0 +1,59 @@
+import os
+import sys
+import time
+import shutil
+import argparse
+import itertools
+import torch
+from tqdm import tqdm
+
+import streaming
+from protein_binarizer import ProteinBinarizer
+
+sys.path.append(os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "fairseq"))
+
+from fairseq.data import indexed_dataset
+
+
+def main(args):
+    binarizer = ProteinBinarizer(args.dict, prepend_bos=args.prepend_bos)
+    os.makedirs(args.destdir, exist_ok=True)
+    shutil.copyfile(args.dict, os.path.join(args.destdir, 'dict.txt'))
+
+    prefix = os.path.join(args.destdir, args.split)
+    builder = indexed_dataset.make_builder(
+        indexed_dataset.data_file_path(prefix), impl='mmap', vocab_size=binarizer.vocab_size)
+    total, tokens, unks = 0, 0, 0
+    start = time.time()
+    lines = streaming.read_lines(args.fn)
+    with tqdm(unit=' seqs') as bar:
+        while True:
+            chunk = list(itertools.islice(lines, args.chunk_size))
+            if not chunk:
+                break
+            for ids in binarizer.encode_batch(chunk):
+                builder.add_item(torch.from_numpy(ids))
+                unks += int((ids == binarizer.unk).sum())
+                tokens += len(ids)
+            total += len(chunk)
+            bar.update(len(chunk))
+    builder.finalize(indexed_dataset.index_file_path(prefix))
+
+    elapsed = time.time() - start
+    print('{} sequences, {} tokens ({} <unk>) in {:.1f}s ({:.0f} seqs/s)'.format(
+        total, tokens, unks, elapsed, total / max(elapsed, 1e-9)))
+
+
+if __name__ == "__main__":
+    # writes {destdir}/{split}.bin/.idx like fairseq-preprocess --only-source --srcdict dict.pro.txt
+    parser = argparse.ArgumentParser()
+    parser.add_argument('fn', type=str, help='one raw protein sequence per line')
+    parser.add_argument('--destdir', type=str, required=True)
+    parser.add_argument('--split', type=str, default='train')
+    parser.add_argument('--dict', type=str,
+                        default=os.path.join(os.path.dirname(os.path.abspath(__file__)), 'dict.pro.txt'))
+    parser.add_argument('--prepend-bos', action='store_true', default=False,
+                        help='also prepend <s> (the tasks add it at load time with --init-token 0)')
+    parser.add_argument('--chunk-size', type=int, default=100000)
+    args = parser.parse_args()
+    main(args)
@@ -0,0 +1,125 @@
+import io
+import os
+import sys
+import time
+import shutil
+import argparse
+import itertools
+import multiprocessing
+import torch
+from tqdm import tqdm
+
+import streaming
+from canonicalize import canonicalize
+from protein_binarizer import ProteinBinarizer
+
+sys.path.append(os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "fairseq"))
+
+from fairseq.data import Dictionary, indexed_dataset
+from fairseq.modules.smiles_tokenizer import SmilesTokenizer
+
+
+# set in every worker by init_worker
+mol_tokenizer = None
+pro_binarizer = None
+keep_atommap = False
+
+
+def init_worker(mol_dict_fn, pro_dict_fn, keep_atommapnum):
+    global mol_tokenizer, pro_binarizer, keep_atommap
+    mol_tokenizer = SmilesTokenizer.from_dict_file(mol_dict_fn)
+    pro_binarizer = ProteinBinarizer(pro_dict_fn)
+    keep_atommap = keep_atommapnum
+
+
+def encode_pair(row):
+    """Canonicalize, tokenize and map one (smiles, protein, label) row to ids.
+
+    Returns None when either side fails, so the pair is dropped as a whole.
+    """
+    smiles, protein, label = row
+    can = canonicalize(smiles, keep_atommap=keep_atommap)
+    if not can:
+        return None
+    mol_ids = mol_tokenizer.encode(can)
+    if mol_ids is None or not protein:
+        return None
+    mol_ids = torch.from_numpy(mol_ids)
+    pro_ids = torch.from_numpy(pro_binarizer.encode(protein))
+    return mol_ids, pro_ids, label
+
+
+def read_rows(pref):
+    with io.open('{}.mol'.format(pref), 'r', encoding='utf8', newline='\n') as molf, \
+            io.open('{}.pro'.format(pref), 'r', encoding='utf8', newline='\n') as prof, \
+            io.open('{}.label'.format(pref), 'r', encoding='utf8', newline='\n') as labelf:
+        for i, (mol, pro, label) in enumerate(itertools.zip_longest(molf, prof, labelf)):
+            assert mol is not None and pro is not None and label is not None, \
+                'the .mol, .pro and .label files of {} are not aligned, one of them ends before line {}'.format(pref, i + 1)
+            yield mol.strip(), pro.strip(), label.strip()
+
+
+def build_split(args, pool, split, pref):
+    dicts = [Dictionary.load(args.mol_dict), Dictionary.load(args.pro_dict)]
+    prefixes = [os.path.join(args.destdir, 'input0', split), os.path.join(args.destdir, 'input1', split)]
+    builders = [
+        indexed_dataset.make_builder(indexed_dataset.data_file_path(prefix), impl='mmap', vocab_size=len(d))
+        for prefix, d in zip(prefixes, dicts)
+    ]
+    unks = [d.unk() for d in dicts]
+    num_unk = [0, 0]
+    total, kept = 0, 0
+    start = time.time()
+    dropped_fn = os.path.join(args.destdir, '{}.dropped'.format(split))
+    label_fn = os.path.join(args.destdir, 'label', '{}.label'.format(split))
+    with io.open(label_fn, 'w', encoding='utf8', newline='\n') as labelf, \
+            io.open(dropped_fn, 'w', encoding='utf8', newline='\n') as dropf:
+        results = streaming.imap_ordered(pool, encode_pair, read_rows(pref), args.workers, args.chunk_size)
+        for res in tqdm(results, desc=split, unit=' pairs'):
+            if res is None:
+                dropf.write('{}\n'.format(total))
+            else:
+                for side, ids in enumerate(res[:2]):
+                    builders[side].add_item(ids)
+                    num_unk[side] += int((ids == unks[side]).sum())
+                labelf.write('{}\n'.format(res[2]))
+                kept += 1
+            total += 1
+
+    for builder, prefix in zip(builders, prefixes):
+        builder.finalize(indexed_dataset.index_file_path(prefix))
+    streaming.report(total, kept, time.time() - start, dropped_fn)
+    print('{}: {} molecule and {} protein tokens replaced by <unk>'.format(split, num_unk[0], num_unk[1]))
+
+
+def main(args):
+    for name in ['input0', 'input1', 'label']:
+        os.makedirs(os.path.join(args.destdir, name), exist_ok=True)
+    shutil.copyfile(args.mol_dict, os.path.join(args.destdir, 'input0', 'dict.txt'))
+    shutil.copyfile(args.pro_dict, os.path.join(args.destdir, 'input1', 'dict.txt'))
+
+    pool = multiprocessing.Pool(
+        args.workers, initializer=init_worker,
+        initargs=(args.mol_dict, args.pro_dict, args.keep_atommapnum))
+    for split, pref in [('train', args.trainpref), ('valid', args.validpref), ('test', args.testpref)]:
+        if pref is not None:
+            build_split(args, pool, split, pref)
+    pool.close()
+    pool.join()
+
+
+if __name__ == "__main__":
+    # reads {pref}.mol, {pref}.pro and {pref}.label of every given split
+    here = os.path.dirname(os.path.abspath(__file__))
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--trainpref', type=str, default=None)
+    parser.add_argument('--validpref', type=str, default=None)
+    parser.add_argument('--testpref', type=str, default=None)
+    parser.add_argument('--destdir', type=str, required=True)
+    parser.add_argument('--mol-dict', type=str, default=os.path.join(here, 'dict.mol.txt'))
+    parser.add_argument('--pro-dict', type=str, default=os.path.join(here, 'dict.pro.txt'))
+    parser.add_argument('--workers', type=int, default=1)
+    parser.add_argument('--chunk-size', type=int, default=100000)
+    parser.add_argument('--keep-atommapnum', action='store_true', default=False)
+    args = parser.parse_args()
+    main(args)
@@ -0,0 +1,78 @@
+import os
+import sys
+import shutil
+import argparse
+import numpy as np
+from tqdm import tqdm
+
+sys.path.append(os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "fairseq"))
+
+from fairseq.data import Dictionary, indexed_dataset
+
+
+def dedup_side(src_prefix, dst_prefix, vocab_size):
+    """Write the distinct sequences of `src_prefix` once and return the entity index of every item."""
+    dataset = indexed_dataset.MMapIndexedDataset(src_prefix)
+    builder = indexed_dataset.make_builder(
+        indexed_dataset.data_file_path(dst_prefix), impl='mmap', vocab_size=vocab_size)
+    seen = {}
+    index = np.empty(len(dataset), dtype=np.int64)
+    for i in tqdm(range(len(dataset)), desc=src_prefix, unit=' items'):
+        ids = dataset[i]
+        key = ids.numpy().tobytes()
+        j = seen.get(key)
+        if j is None:
+            j = seen[key] = len(seen)
+            builder.add_item(ids)
+        index[i] = j
+    builder.finalize(indexed_dataset.index_file_path(dst_prefix))
+    return index, len(seen)
+
+
+def build_split(args, split, vocab_sizes):
+    columns = []
+    for side, vocab_size in enumerate(vocab_sizes):
+        src_prefix = os.path.join(args.datadir, 'input{}'.format(side), split)
+        dst_prefix = os.path.join(args.destdir, 'input{}_unique'.format(side), split)
+        index, num_unique = dedup_side(src_prefix, dst_prefix, vocab_size)
+        columns.append(index)
+        size = os.path.getsize(indexed_dataset.data_file_path(src_prefix))
+        unique_size = os.path.getsize(indexed_dataset.data_file_path(dst_prefix))
+        print('{} input{}: {} items, {} unique ({:.1f} per entity), {} -> {} bytes'.format(
+            split, side, len(index), num_unique, len(index) / max(num_unique, 1), size, unique_size))
+    assert len(columns[0]) == len(columns[1]), 'input0 and input1 of {} are not aligned'.format(split)
+    # int32 halves the index whenever both sides fit
+    dtype = np.int32 if max(len(c) for c in columns) < 2 ** 31 else np.int64
+    np.save(os.path.join(args.destdir, 'pairs', '{}.npy'.format(split)), np.stack(columns, axis=1).astype(dtype))
+
+
+def main(args):
+    for name in ['input0_unique', 'input1_unique', 'pairs', 'label']:
+        os.makedirs(os.path.join(args.destdir, name), exist_ok=True)
+    vocab_sizes = []
+    for side in range(2):
+        dict_fn = os.path.join(args.datadir, 'input{}'.format(side), 'dict.txt')
+        shutil.copyfile(dict_fn, os.path.join(args.destdir, 'input{}_unique'.format(side), 'dict.txt'))
+        vocab_sizes.append(len(Dictionary.load(dict_fn)))
+
+    for split in args.splits:
+        if not os.path.exists(indexed_dataset.index_file_path(os.path.join(args.datadir, 'input0', split))):
+            print('{}: not found in {}, skipped'.format(split, args.datadir))
+            continue
+        build_split(args, split, vocab_sizes)
+        label_fn = os.path.join(args.datadir, 'label', '{}.label'.format(split))
+        dst_label_fn = os.path.join(args.destdir, 'label', '{}.label'.format(split))
+        if os.path.abspath(label_fn) != os.path.abspath(dst_label_fn):
+            shutil.copyfile(label_fn, dst_label_fn)
+
+
+if __name__ == "__main__":
+    # converts a binarized dataset (input0, input1, label) to the layout of dti_separate_add_mask_token_unique_entity
+    parser = argparse.ArgumentParser()
+    parser.add_argument('datadir', type=str)
+    parser.add_argument('--destdir', type=str, default=None, help='defaults to datadir')
+    parser.add_argument('--splits', type=str, nargs='+', default=['train', 'valid', 'test'])
+    args = parser.parse_args()
+    if args.destdir is None:
+        args.destdir = args.datadir
+    main(args)
@@ -1,19 +1,21 @@
+import os
 import re
-import io
 import argparse
-from tqdm import tqdm
-import multiprocessing
+import functools
+import rdkit
 from rdkit import Chem
 
+import streaming
+from smiles_cache import SmilesCache, CachedChunkMapper
+
 
 def rm_map_number(smiles):
     t = re.sub(':\d*', '', smiles)
     return t
 
 
-def canonicalize(smiles):
+def canonicalize(smiles, keep_atommap=False):
     try:
-        smiles, keep_atommap = smiles
         if not keep_atommap:
             smiles = rm_map_number(smiles)
         mol = Chem.MolFromSmiles(smiles)
@@ -27,25 +29,22 @@ def canonicalize(smiles):
 
 def main(args):
     input_fn = args.fn
-    def lines():
-        with io.open(input_fn, 'r', encoding='utf8', newline='\n') as srcf:
-            for line in srcf.readlines():
-                yield line.strip(), args.keep_atommapnum
-
-    results = []
-    total = len(io.open(input_fn, 'r', encoding='utf8', newline='\n').readlines())
-
-    pool = multiprocessing.Pool(args.workers)
-    for res in tqdm(pool.imap(canonicalize, lines(), chunksize=100000), total=total):
-        if res is not None:
-            results.append('{}\n'.format(res))
-
     if args.output_fn is None:
         output_fn = '{}.can'.format(input_fn)
     else:
         output_fn = args.output_fn
-    io.open(output_fn, 'w', encoding='utf8', newline='\n').writelines(results)
-    print('{}/{}'.format(len(results), total))
+    func = functools.partial(canonicalize, keep_atommap=args.keep_atommapnum)
+    if args.no_cache:
+        streaming.run(func, input_fn, output_fn, workers=args.workers, chunk_size=args.chunk_size)
+        return
+
+    version = 'rdkit-{}{}'.format(rdkit.__version__, '-atommap' if args.keep_atommapnum else '')
+    cache = SmilesCache(args.cache, version)
+    mapper = CachedChunkMapper(func, cache, chunksize=max(1, args.chunk_size // (args.workers * 4)))
+    streaming.run(func, input_fn, output_fn, workers=args.workers, chunk_size=args.chunk_size,
+                  map_chunk=mapper)
+    print('cache {}: {} hits, {} misses'.format(args.cache, cache.hits, cache.misses))
+    cache.close()
 
 
 if __name__ == "__main__":
@@ -54,5 +53,10 @@ if __name__ == "__main__":
     parser.add_argument('--workers', type=int, default=1)
     parser.add_argument('--output-fn', type=str, default=None)
     parser.add_argument('--keep-atommapnum', action='store_true', default=False)
+    parser.add_argument('--chunk-size', type=int, default=100000)
+    parser.add_argument('--cache', type=str,
+                        default=os.path.expanduser('~/.cache/knn_dta/canonical_smiles.sqlite'),
+                        help='SQLite cache of canonical SMILES shared across datasets and runs')
+    parser.add_argument('--no-cache', action='store_true', default=False)
     args = parser.parse_args()
     main(args)
@@ -0,0 +1,215 @@
+import io
+import os
+import sys
+import time
+import argparse
+import numpy as np
+
+import minhash
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'pubchem'))
+
+from fingerprints import FP_BITS, pack
+from tanimoto import popcount, to_words
+
+SPLITS = ['train', 'valid', 'test']
+
+
+def read_lines(fn):
+    with io.open(fn, 'r', encoding='utf8', newline='\n') as f:
+        return [line.rstrip('\n') for line in f]
+
+
+def write_lines(fn, lines):
+    with io.open(fn, 'w', encoding='utf8', newline='\n') as f:
+        for line in lines:
+            f.write(line + '\n')
+
+
+def unique_index(keys):
+    """Distinct keys in order of appearance and the entity index of every key."""
+    ids = {}
+    index = np.array([ids.setdefault(key, len(ids)) for key in keys], dtype=np.int64)
+    return list(ids), index
+
+
+def pair_tanimoto(words, pairs, block=1 << 20):
+    """Exact Tanimoto similarity of `pairs` of fingerprint words."""
+    counts = popcount(words).sum(axis=1, dtype=np.int32)
+    sim = np.empty(len(pairs), dtype=np.float32)
+    for start in range(0, len(pairs), block):
+        i, j = pairs[start:start + block].T
+        common = popcount(words[i] & words[j]).sum(axis=1, dtype=np.int32)
+        sim[start:start + block] = common / np.maximum(counts[i] + counts[j] - common, 1)
+    return sim
+
+
+def pair_jaccard(codes, offsets, pairs, block=1 << 12):
+    """Exact Jaccard similarity of `pairs` of entities, given their distinct codes (see minhash.kmer_codes)."""
+    sizes = np.diff(offsets)
+    sim = np.empty(len(pairs), dtype=np.float32)
+    for start in range(0, len(pairs), block):
+        i, j = pairs[start:start + block].T
+        sides = np.concatenate([i, j])
+        lengths = sizes[sides]
+        # the codes of both sides of every pair, tagged with the pair; a shared code appears twice
+        tags = np.repeat(np.tile(np.arange(len(i)), 2), lengths)
+        rows = np.arange(lengths.sum()) - np.repeat(np.cumsum(lengths) - lengths - offsets[sides], lengths)
+        values = codes[rows]
+        order = np.lexsort((values, tags))
+        tags, values = tags[order], values[order]
+        shared = (tags[1:] == tags[:-1]) & (values[1:] == values[:-1])
+        common = np.bincount(tags[1:][shared], minlength=len(i))
+        sim[start:start + block] = common / np.maximum(sizes[i] + sizes[j] - common, 1)
+    return sim
+
+
+def cluster_entities(name, codes, offsets, universe, threshold, args, exact=None):
+    """Cluster of every entity, linking the LSH candidates at or above `threshold`.
+
+    Candidates are verified with `exact(pairs)` when given, otherwise with
+    the similarity estimated from the MinHash signatures.
+    """
+    start = time.time()
+    n = len(offsets) - 1
+    sig = minhash.signatures(codes, offsets, args.num_perm, args.seed, universe)
+    bands = minhash.choose_bands(args.num_perm, threshold)
+    pairs = minhash.candidate_pairs(sig, bands, args.bucket_reps)
+    sim = exact(pairs) if exact is not None else minhash.estimated_similarity(sig, pairs)
+    linked = pairs[sim >= threshold]
+    labels = minhash.cluster(n, linked)
+    print('%s: %d unique, %d bands of %d, %d candidate pairs, %d linked, %d clusters (largest %d) in %.1fs' % (
+        name, n, bands, args.num_perm // bands, len(pairs), len(linked), labels.max() + 1 if n else 0,
+        np.bincount(labels).max() if n else 0, time.time() - start))
+    return labels
+
+
+def assign_clusters(clusters, fractions, seed):
+    """Split of every cluster, given the cluster of every pair.
+
+    Clusters are taken largest first, in a seeded random order among equal
+    sizes, and each goes to the split furthest below its share of pairs, so
+    the same seed always gives the same split.
+    """
+    sizes = np.bincount(clusters)
+    order = np.random.RandomState(seed).permutation(len(sizes))
+    order = order[np.argsort(-sizes[order], kind='stable')]
+    targets = np.asarray(fractions, dtype=np.float64) * len(clusters)
+    filled = np.zeros(len(fractions), dtype=np.float64)
+    assignment = np.zeros(len(sizes), dtype=np.int64)
+    for c in order:
+        if sizes[c] == 0:
+            continue
+        s = int(np.argmax(targets - filled))
+        assignment[c] = s
+        filled[s] += sizes[c]
+    return assignment
+
+
+def assign_given(clusters, other_split, fractions, seed):
+    """Split of every cluster of one side, given the split of the other side of every pair.
+
+    For ``--cold both``: a pair is kept when both of its sides fall in the
+    same split. Clusters are taken largest first, in a seeded random order
+    among equal sizes. Each goes to the split where the most of its pairs
+    are kept, counting only the pairs that split still needs to reach its
+    share of the kept pairs. The kept pairs then follow `fractions` while
+    few are dropped.
+    """
+    fractions = np.asarray(fractions, dtype=np.float64)
+    counts = np.zeros((clusters.max() + 1 if len(clusters) else 0, len(fractions)), dtype=np.int64)
+    np.add.at(counts, (clusters, other_split), 1)
+    sizes = counts.sum(axis=1)
+    order = np.random.RandomState(seed).permutation(len(sizes))
+    order = order[np.argsort(-sizes[order], kind='stable')]
+    kept = np.zeros(len(fractions), dtype=np.float64)
+    assignment = np.zeros(len(sizes), dtype=np.int64)
+    for c in order:
+        if sizes[c] == 0:
+            continue
+        needed = fractions * (kept.sum() + counts[c]) - kept
+        s = int(np.argmax(np.minimum(counts[c], needed)))
+        assignment[c] = s
+        kept[s] += counts[c, s]
+    return assignment
+
+
+def main(args):
+    mols = read_lines(args.pref + '.mol')
+    pros = read_lines(args.pref + '.pro')
+    labels = read_lines(args.pref + '.label')
+    assert len(mols) == len(pros) == len(labels), 'the .mol, .pro and .label files are not aligned'
+    fractions = [1.0 - args.valid - args.test, args.valid, args.test]
+    splits = {}
+
+    if args.cold in ('protein', 'both'):
+        seqs, pro_index = unique_index([pro.replace(' ', '') for pro in pros])
+        codes, offsets = minhash.kmer_codes(seqs, args.kmer)
+        clusters = cluster_entities('proteins', codes, offsets, minhash.kmer_universe(args.kmer),
+                                    args.protein_threshold, args,
+                                    exact=lambda pairs: pair_jaccard(codes, offsets, pairs))[pro_index]
+        splits['protein'] = assign_clusters(clusters, fractions, args.seed)[clusters]
+
+    if args.cold in ('compound', 'both'):
+        if args.fingerprints:
+            # one 0/1 string per pair, e.g. the baseline/*_compound_fingerprint files of split.py
+            fps = read_lines(args.fingerprints)
+            assert len(fps) == len(mols), '%s is not aligned with the .mol file' % args.fingerprints
+            keys, mol_index = unique_index(fps)
+            packed = np.array([pack(np.frombuffer(fp.encode('ascii'), dtype=np.uint8)[:FP_BITS] - ord('0'))
+                               for fp in keys], dtype=np.uint8).reshape(len(keys), -1)
+            codes, offsets = minhash.bit_codes(packed)
+            words = to_words(packed)
+            clusters = cluster_entities('compounds', codes, offsets, packed.shape[1] * 8, args.compound_threshold,
+                                        args, exact=lambda pairs: pair_tanimoto(words, pairs))[mol_index]
+        else:
+            # without fingerprints only identical SMILES are grouped
+            keys, clusters = unique_index(mols)
+            print('compounds: %d unique, grouped by SMILES' % len(keys))
+        if args.cold == 'both':
+            # the compounds follow the proteins of their pairs, so that few pairs are dropped
+            splits['compound'] = assign_given(clusters, splits['protein'], fractions, args.seed + 1)[clusters]
+        else:
+            splits['compound'] = assign_clusters(clusters, fractions, args.seed + 1)[clusters]
+
+    if args.cold == 'both':
+        # pairs whose protein and compound fall in different splits would leak, they are dropped
+        split = np.where(splits['protein'] == splits['compound'], splits['protein'], -1)
+    else:
+        split = splits[args.cold]
+
+    os.makedirs(args.destdir, exist_ok=True)
+    for s, name in enumerate(SPLITS):
+        rows = np.flatnonzero(split == s)
+        pref = os.path.join(args.destdir, name)
+        write_lines(pref + '.mol', [mols[i] for i in rows])
+        write_lines(pref + '.pro', [pros[i] for i in rows])
+        write_lines(pref + '.label', [labels[i] for i in rows])
+        print('%s: %d pairs (%.1f%% of the kept ones), %d proteins, %d compounds' % (
+            name, len(rows), 100.0 * len(rows) / max((split >= 0).sum(), 1),
+            len(set(pros[i] for i in rows)), len(set(mols[i] for i in rows))))
+    if args.cold == 'both':
+        print('dropped: %d pairs (%.1f%%) across splits' % ((split < 0).sum(), 100.0 * (split < 0).mean()))
+
+
+if __name__ == "__main__":
+    # reads {pref}.mol, {pref}.pro and {pref}.label and writes {destdir}/{train,valid,test}.{mol,pro,label}
+    parser = argparse.ArgumentParser()
+    parser.add_argument('pref', type=str)
+    parser.add_argument('--destdir', type=str, required=True)
+    parser.add_argument('--cold', type=str, default='protein', choices=['protein', 'compound', 'both'],
+                        help='side whose clusters do not cross splits')
+    parser.add_argument('--fingerprints', type=str, default=None,
+                        help='881-bit 0/1 fingerprint of every pair, to cluster compounds by Tanimoto similarity')
+    parser.add_argument('--valid', type=float, default=0.1,
+                        help='fraction of the pairs, of the kept pairs with --cold both')
+    parser.add_argument('--test', type=float, default=0.2,
+                        help='fraction of the pairs, of the kept pairs with --cold both')
+    parser.add_argument('--kmer', type=int, default=3)
+    parser.add_argument('--protein-threshold', type=float, default=0.5, help='k-mer Jaccard similarity')
+    parser.add_argument('--compound-threshold', type=float, default=0.7, help='Tanimoto similarity')
+    parser.add_argument('--num-perm', type=int, default=64, help='MinHash values per entity')
+    parser.add_argument('--bucket-reps', type=int, default=4, help='members of an LSH bucket every member is compared to')
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+    main(args)
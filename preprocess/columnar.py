@@ -0,0 +1,274 @@
+import os
+import csv
+import json
+import argparse
+import itertools
+import numpy as np
+from tqdm import tqdm
+
+try:
+    import pyarrow as pa
+    import pyarrow.compute as pc
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+
+
+# columns of BindingDB_All.tsv used by the preprocessing steps
+SMI_COL, CID_COL, NCHAIN_COL, SEQ_COL = 1, 28, 36, 37
+# typed columns derived from the raw strings, for filters and lookups
+NCHAIN = '_nchain'  # int32 of column 36
+SEQ_LEN = '_seq_len'  # int32 length of the stripped sequence of column 37
+CID = '_cid'  # int64 of column 28, null when empty
+# number of fields of the row and the fields beyond the header, tab-joined
+NFIELDS = '_nfields'
+EXTRA = '_extra'
+ROW_GROUP_SIZE = 1 << 17
+INT_PATTERN = r'^[+-]?\d+$'
+FLOAT_PATTERN = r'^[+-]?(\d+\.?\d*|\.\d+)([eE][+-]?\d+)?$'
+
+OPS = {'<': pc.less, '<=': pc.less_equal, '>': pc.greater, '>=': pc.greater_equal, '==': pc.equal} if pa else {}
+
+
+def require_pyarrow():
+    if pa is None:
+        raise ImportError('--columnar needs pyarrow: pip install pyarrow')
+
+
+def parquet_path(tsv_fn):
+    return os.path.splitext(tsv_fn)[0] + '.parquet'
+
+
+def col(i):
+    """Name of the raw string column `i` (0-based, as in `row[i]`)."""
+    return str(i)
+
+
+def parse_numbers(strings, pattern, type):
+    """Cast strings matching `pattern` after stripping to `type`, the others to null."""
+    strings = pc.utf8_trim_whitespace(strings)
+    valid = pc.match_substring_regex(strings, pattern)
+    return pc.if_else(valid, pc.cast(pc.if_else(valid, strings, '0'), type), pa.scalar(None, type))
+
+
+def typed_columns(table):
+    seq = pc.utf8_trim_whitespace(table[col(SEQ_COL)])
+    cid = parse_numbers(table[col(CID_COL)], FLOAT_PATTERN, pa.float64())
+    return {
+        NCHAIN: parse_numbers(table[col(NCHAIN_COL)], INT_PATTERN, pa.int32()),
+        SEQ_LEN: pc.cast(pc.utf8_length(seq), pa.int32()),
+        # int(float(cid)) as in split.py
+        CID: pc.cast(pc.trunc(cid), pa.int64()),
+    }
+
+
+def replace_column(table, i, values):
+    """Table with the raw column `i` replaced by the strings `values`."""
+    return table.set_column(table.schema.get_field_index(col(i)), col(i), pa.array(values, pa.string()))
+
+
+def filter_rows(table, keep):
+    return table.filter(pa.array(keep, pa.bool_()))
+
+
+def concat_tables(tables):
+    return pa.concat_tables(tables)
+
+
+def format_row(row):
+    """Same text as `csv.writer(f, dialect='excel-tab').writerow(row)`.
+
+    The writer only quotes fields with a quote character, a tab or a newline,
+    and tabs and newlines cannot occur within the fields of a BindingDB row.
+    """
+    text = '\t'.join(row)
+    if '"' in text:
+        text = '\t'.join(['"' + x.replace('"', '""') + '"' if '"' in x else x for x in row])
+    return text + '\r\n'
+
+
+def table_rows(table, width):
+    """Rebuild the original rows of a table with every raw column."""
+    fields = [table[col(i)].to_pylist() for i in range(width)]
+    rows = []
+    for row, n, extra in zip(zip(*fields), table[NFIELDS].to_pylist(), table[EXTRA].to_pylist()):
+        row = list(row[:n])
+        if n > width:
+            row.extend(extra.split('\t'))
+        rows.append(row)
+    return rows
+
+
+def format_rows(table, width):
+    """`format_row` of every original row of a table, joined by Arrow."""
+    columns = []
+    for i in range(width):
+        values = table[col(i)]
+        quoted = pc.match_substring(values, '"')
+        if pc.any(quoted).as_py():
+            escaped = pc.binary_join_element_wise('"', pc.replace_substring(values, '"', '""'), '"', '')
+            values = pc.if_else(quoted, escaped, values)
+        columns.append(values)
+    texts = pc.binary_join_element_wise(*columns, '\t') if columns else pa.array([''] * len(table))
+    texts = pc.binary_join_element_wise(texts, '\r\n', '').to_pylist()
+    # rows of another length than the header
+    irregular = np.flatnonzero(pc.not_equal(table[NFIELDS], width).to_numpy(zero_copy_only=False))
+    if len(irregular):
+        for i, row in zip(irregular, table_rows(table.take(irregular), width)):
+            texts[i] = format_row(row)
+    return texts
+
+
+class ColumnarWriter(object):
+    """Write BindingDB rows to Parquet, one string column per field plus typed columns.
+
+    Rows keep their exact fields: shorter rows are padded with '' and
+    `_nfields` records their length, fields beyond the header go to `_extra`.
+    `writerow` buffers rows like a `csv.writer` and writes one row group at
+    a time.
+    """
+
+    def __init__(self, fn, header):
+        require_pyarrow()
+        self.header = list(header)
+        self.width = len(header)
+        fields = [pa.field(col(i), pa.string()) for i in range(self.width)]
+        fields += [pa.field(NFIELDS, pa.int32()), pa.field(EXTRA, pa.string())]
+        fields += [pa.field(NCHAIN, pa.int32()), pa.field(SEQ_LEN, pa.int32()), pa.field(CID, pa.int64())]
+        metadata = {b'header': json.dumps(self.header).encode('utf8')}
+        self.schema = pa.schema(fields, metadata=metadata)
+        self.writer = pq.ParquetWriter(fn, self.schema)
+        self.buffer = []
+
+    def writerow(self, row):
+        self.buffer.append(row)
+        if len(self.buffer) >= ROW_GROUP_SIZE:
+            self.flush()
+
+    def flush(self):
+        rows, self.buffer = self.buffer, []
+        self.write_rows(rows)
+
+    def write_rows(self, rows):
+        if self.buffer:
+            self.flush()
+        if not rows:
+            return
+        width = self.width
+        columns = {}
+        for i in range(width):
+            columns[col(i)] = pa.array([row[i] if i < len(row) else '' for row in rows], pa.string())
+        columns[NFIELDS] = pa.array([len(row) for row in rows], pa.int32())
+        columns[EXTRA] = pa.array(['\t'.join(row[width:]) for row in rows], pa.string())
+        columns.update(typed_columns(pa.table(columns)))
+        self.write_table(pa.table(columns))
+
+    def write_table(self, table):
+        """Write a table with every column, e.g. one from `ColumnarReader.iter_tables()`.
+
+        The typed columns are written as given, so they must still match the raw ones.
+        """
+        if self.buffer:
+            self.flush()
+        self.writer.write_table(table.select(self.schema.names).cast(self.schema), row_group_size=ROW_GROUP_SIZE)
+
+    def close(self):
+        self.flush()
+        self.writer.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class ColumnarReader(object):
+    """Read the columns a step needs from a file written by `ColumnarWriter`.
+
+    `filters` are (column, op, value) conditions that must all hold, e.g.
+    `[(NCHAIN, '<', 2), (SEQ_LEN, '<=', 1500)]`. Row groups whose statistics
+    rule a condition out are not read at all; the rest is filtered after
+    reading. Row groups are read in file order, so row order is kept.
+    """
+
+    def __init__(self, fn):
+        require_pyarrow()
+        self.file = pq.ParquetFile(fn)
+        self.header = json.loads(self.file.schema_arrow.metadata[b'header'].decode('utf8'))
+        self.width = len(self.header)
+        self.names = self.file.schema_arrow.names
+
+    @property
+    def num_row_groups(self):
+        return self.file.num_row_groups
+
+    def may_match(self, i, filters):
+        row_group = self.file.metadata.row_group(i)
+        for name, op, value in filters:
+            stats = row_group.column(self.names.index(name)).statistics
+            if stats is None or not stats.has_min_max:
+                continue
+            if (op == '<' and stats.min >= value) or (op == '<=' and stats.min > value) \
+                    or (op == '>' and stats.max <= value) or (op == '>=' and stats.max < value) \
+                    or (op == '==' and not stats.min <= value <= stats.max):
+                return False
+        return True
+
+    def read_row_group(self, i, columns, filters=()):
+        names = list(dict.fromkeys(list(columns) + [name for name, op, value in filters]))
+        table = self.file.read_row_group(i, columns=names)
+        if filters:
+            mask = None
+            for name, op, value in filters:
+                cond = OPS[op](table[name], value)
+                mask = cond if mask is None else pc.and_(mask, cond)
+            table = table.filter(mask)
+        return table.select(list(columns))
+
+    def iter_tables(self, columns=None, filters=()):
+        """Tables of `columns` (all columns by default), one per row group that may match."""
+        if columns is None:
+            columns = self.names
+        for i in range(self.num_row_groups):
+            if self.may_match(i, filters):
+                yield self.read_row_group(i, columns, filters)
+
+    def iter_rows(self, filters=()):
+        """Lists of original rows, one per row group that may match."""
+        for table in self.iter_tables(filters=filters):
+            yield table_rows(table, self.width)
+
+
+def tsv_to_parquet(tsv_fn, parquet_fn, chunk_size=ROW_GROUP_SIZE):
+    with open(tsv_fn) as f:
+        reader = csv.reader(f, delimiter="\t", quoting=csv.QUOTE_NONE)
+        with ColumnarWriter(parquet_fn, next(reader)) as writer:
+            with tqdm(unit=' rows') as progress:
+                while True:
+                    rows = list(itertools.islice(reader, chunk_size))
+                    if not rows:
+                        break
+                    writer.write_rows(rows)
+                    progress.update(len(rows))
+
+
+def parquet_to_tsv(parquet_fn, tsv_fn):
+    reader = ColumnarReader(parquet_fn)
+    with open(tsv_fn, 'w+') as csvout:
+        csvout.write(format_row(reader.header))
+        for table in reader.iter_tables():
+            csvout.write(''.join(format_rows(table, reader.width)))
+
+
+if __name__ == "__main__":
+    # convert BindingDB_All.tsv (or any stage output) to the columnar format and back
+    parser = argparse.ArgumentParser()
+    parser.add_argument('input_fn', type=str)
+    parser.add_argument('output_fn', type=str, nargs='?', default=None)
+    parser.add_argument('--to-tsv', action='store_true', default=False)
+    args = parser.parse_args()
+    if args.to_tsv:
+        parquet_to_tsv(args.input_fn, args.output_fn or os.path.splitext(args.input_fn)[0] + '.tsv')
+    else:
+        tsv_to_parquet(args.input_fn, args.output_fn or parquet_path(args.input_fn))
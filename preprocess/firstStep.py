@@ -1,18 +1,26 @@
 #coding:utf-8
 from __future__ import division
 import re
+import os
 import csv
 import sys
+import time
+import argparse
 from subprocess import call
 
-def main():
+import numpy as np
+import pandas as pd
+
+import columnar
+
+def main(input_fn='BindingDB_All.tsv', output_fn='BindingDB_All_firststep_noMulti.tsv'):
     count = 0
     countMul = 0
     dropM = 0
     pairDic = {}
     multiMDic = {}
     tempDic = {}
-    with open('BindingDB_All.tsv') as tsvfile:
+    with open(input_fn) as tsvfile:
         reader = csv.reader(tsvfile, delimiter="\t",quoting=csv.QUOTE_NONE)
         header = next(reader)
         for row in reader:
@@ -43,7 +51,7 @@ def main():
                 else:
                     multiMDic[seq] = [smi]
             dropM = 0
-    with open('BindingDB_All.tsv') as tsvfile, open("BindingDB_All_firststep_noMulti.tsv",'w+') as csvout:
+    with open(input_fn) as tsvfile, open(output_fn,'w+') as csvout:
         reader = csv.reader(tsvfile, delimiter="\t",quoting=csv.QUOTE_NONE)
         # line = {}
         # k = ''
@@ -289,7 +297,275 @@ def main():
         print("Final number: %d" %count)
 
 
+# Columns of BindingDB_All.tsv used below.
+SMI_COL, KI_COL, IC50_COL, KD_COL, CID_COL, NCHAIN_COL, SEQ_COL = 1, 8, 9, 10, 28, 36, 37
+# IC50, Ki and Kd, in the order they are aggregated
+MEASURE_COLS = [IC50_COL, KI_COL, KD_COL]
+NON_STANDARD_RESIDUE = re.compile(r'[a-z0-9\W]')
+
+
+def keep_row(row, seq):
+    """Same filters as the second pass of `main`."""
+    return keep_fields(int(row[NCHAIN_COL]), seq, row[CID_COL])
+
+
+def keep_fields(nchain, seq, cid):
+    if nchain >= 2:
+        return False
+    if seq == '' or seq == 'n/a' or seq == 'N/A' or seq == 'None':
+        return False
+    if 'X' in seq or 'x' in seq:
+        return False
+    if cid == '':
+        return False
+    if NON_STANDARD_RESIDUE.search(seq):
+        return False
+    return len(seq) <= 1500
+
+
+def product(values):
+    # same left-to-right order as the `icMean *= ...` loops, so the means are bit-identical
+    result = 1
+    for value in values:
+        result *= value
+    return result
+
+
+def aggregate_measurements(group, measure, raw):
+    """Aggregate repeated measurements of every (pair, measurement) group.
+
+    Vectorised version of the per-pair loops of `main`: measurements whose
+    values spread by 1000x or more are dropped, inequalities that carry no
+    information (`<` above 0.01, `>` below 1E7) are ignored, exact values are
+    preferred over inequalities, and the rest is replaced by its geometric
+    mean. Returns {(group, measure): value}, where a missing key means the
+    measurement is dropped.
+    """
+    df = pd.DataFrame({'group': group, 'measure': measure, 'raw': raw})
+    df = df[df['raw'] != '']
+    if len(df) == 0:
+        return {}
+    df['value'] = df['raw'].str.replace(r'[<>=]', '', regex=True).map(float)
+    ineq = df['raw'].str.contains(r'[<>=]', regex=True)
+    less = df['raw'].str.contains('<', regex=False)
+    greater = df['raw'].str.contains('>', regex=False)
+    blank = ineq & ((less & (df['value'] > 0.01)) | (greater & (df['value'] < 1E7)))
+    df['inequality'] = ineq & ~blank
+    df['exact'] = ~ineq
+    df['less'] = less
+
+    keys = ['group', 'measure']
+    stats = df.groupby(keys, sort=False).agg(
+        low=('value', 'min'), high=('value', 'max'), inequality=('inequality', 'any'), exact=('exact', 'any'))
+    with np.errstate(divide='ignore', invalid='ignore'):
+        spread = np.where(stats['low'] != 0, stats['high'] / stats['low'] >= 1000, stats['high'] >= 1000)
+    stats = stats[~spread & (stats['inequality'] | stats['exact'])]
+    exact_groups = stats.index[stats['exact']]
+    inequality_groups = stats.index[~stats['exact']]
+
+    result = {}
+    index = pd.MultiIndex.from_frame(df[keys])
+    exact = df[df['exact'].values & index.isin(exact_groups)]
+    for key, values in exact.groupby(keys, sort=False)['value']:
+        result[key] = str(product(values.tolist()) ** (1.0 / len(values)))
+
+    inequality = df[df['inequality'].values & index.isin(inequality_groups)]
+    for key, part in inequality.groupby(keys, sort=False):
+        mean = product(part['value'].tolist()) ** (1.0 / len(part))
+        lesM, larM = part['less'].any(), (~part['less']).any()
+        if lesM and not larM:
+            mean = '<' + str(mean)
+        elif larM and not lesM:
+            mean = '>' + str(mean)
+        else:
+            print("Error: No Inequality or both directions")
+            mean = str(mean)
+        result[key] = mean
+    return result
+
+
+def main_single_pass(input_fn, output_fn):
+    """Single-pass version of `main` with the same output.
+
+    `main` reads the input twice and tracks seen pairs in lists. Here every
+    (seq, smi) pair gets an id from a dict while the input is read once;
+    rows that pass the filters are spilled to `<output_fn>.spill` with their
+    pair id. Once the pair counts are known, the spill is replayed: pairs seen
+    once are written as they come and the measurements of repeated pairs are
+    aggregated by `aggregate_measurements`.
+    """
+    start = time.time()
+    seqIds = {}
+    pairIds = {}
+    pairCount = []
+    total = 0
+    spill_fn = output_fn + '.spill'
+    with open(input_fn) as tsvfile, open(spill_fn, 'w', newline='') as spillfile:
+        reader = csv.reader(tsvfile, delimiter="\t", quoting=csv.QUOTE_NONE)
+        spill = csv.writer(spillfile, dialect='excel-tab')
+        header = next(reader)
+        for row in reader:
+            total += 1
+            seq = row[SEQ_COL].strip()
+            key = (seqIds.setdefault(seq, len(seqIds)), row[SMI_COL].strip())
+            pair = pairIds.setdefault(key, len(pairIds))
+            if pair == len(pairCount):
+                pairCount.append(1)
+            else:
+                pairCount[pair] += 1
+            if keep_row(row, seq):
+                spill.writerow([pair] + row)
+    del pairIds
+    scanned = time.time()
+
+    with open(spill_fn, newline='') as spillfile, open(output_fn, 'w+') as csvout:
+        writer = csv.writer(csvout, dialect='excel-tab')
+        writer.writerow(header)
+        pair_rows = ((int(row[0]), row[1:]) for row in csv.reader(spillfile, dialect='excel-tab'))
+        count, countMul, numGroups, written = write_pairs(pair_rows, pairCount, writer)
+    os.remove(spill_fn)
+    report(count, total, pairCount, countMul, numGroups, start, scanned, written)
+
+
+def main_columnar(input_fn, output_fn):
+    """`main_single_pass` on files written by `columnar.py`, with the same output.
+
+    The pair counts only read the sequence and SMILES columns. The rows are
+    then read again as tables with the chain-number and sequence-length
+    filters pushed down to the Parquet reader, so no spill file is needed:
+    rows of pairs seen once are copied table-wise, and only the columns used
+    by the filters and the aggregation are turned into Python objects.
+    """
+    start = time.time()
+    reader = columnar.ColumnarReader(input_fn)
+    seqIds = {}
+    pairIds = {}
+    pairCount = []
+    total = 0
+    for table in reader.iter_tables([columnar.col(SEQ_COL), columnar.col(SMI_COL)]):
+        for seq, smi in zip(table[0].to_pylist(), table[1].to_pylist()):
+            total += 1
+            seq = seq.strip()
+            key = (seqIds.setdefault(seq, len(seqIds)), smi.strip())
+            pair = pairIds.setdefault(key, len(pairIds))
+            if pair == len(pairCount):
+                pairCount.append(1)
+            else:
+                pairCount[pair] += 1
+    scanned = time.time()
+
+    count = 0
+    countMul = 0
+    groups = {}
+    firstRows = []
+    numFirst = 0
+    group, measure, raw = [], [], []
+    filters = [(columnar.NCHAIN, '<', 2), (columnar.SEQ_LEN, '<=', 1500)]
+    with columnar.ColumnarWriter(output_fn, reader.header) as writer:
+        for table in reader.iter_tables(filters=filters):
+            seqs = [seq.strip() for seq in table[columnar.col(SEQ_COL)].to_pylist()]
+            smis = table[columnar.col(SMI_COL)].to_pylist()
+            cids = table[columnar.col(CID_COL)].to_pylist()
+            single = []
+            first = []
+            measurements = None
+            for i, (seq, smi, cid) in enumerate(zip(seqs, smis, cids)):
+                # the chain number is already filtered
+                if not keep_fields(1, seq, cid):
+                    single.append(False)
+                    continue
+                pair = pairIds[(seqIds[seq], smi.strip())]
+                single.append(pairCount[pair] == 1)
+                if single[-1]:
+                    continue
+                if measurements is None:
+                    measurements = [table[columnar.col(c)].to_pylist() for c in MEASURE_COLS]
+                pairs = groups.setdefault(seq, {})
+                if pair not in pairs:
+                    pairs[pair] = numFirst + len(first)
+                    first.append(i)
+                for m in range(len(MEASURE_COLS)):
+                    group.append(pair)
+                    measure.append(m)
+                    raw.append(measurements[m][i].strip())
+                countMul += 1
+            kept = columnar.filter_rows(table, single)
+            writer.write_table(kept)
+            count += len(kept)
+            if first:
+                firstRows.append(table.take(first))
+                numFirst += len(first)
+        written = time.time()
+
+        means = aggregate_measurements(group, measure, raw)
+        if firstRows:
+            order = [(pair, index) for pairs in groups.values() for pair, index in pairs.items()]
+            table = columnar.concat_tables(firstRows).take([index for pair, index in order])
+            for m, col in enumerate(MEASURE_COLS):
+                table = columnar.replace_column(table, col, [means.get((pair, m), '') for pair, index in order])
+            writer.write_table(table)
+            count += len(table)
+    report(count, total, pairCount, countMul, sum(len(p) for p in groups.values()), start, scanned, written)
+
+
+def write_pairs(pair_rows, pairCount, writer):
+    """Write the (pair id, row) items that passed the filters as `main` does.
+
+    Pairs seen once are written as they come, the rows of repeated pairs are
+    written last with their measurements aggregated.
+    """
+    count = 0
+    countMul = 0
+    groups = {}
+    group, measure, raw = [], [], []
+    for pair, row in pair_rows:
+        if pairCount[pair] == 1:
+            writer.writerow(row)
+            count += 1
+            continue
+        # output order of `main`: by first sequence, then by first SMILES within it
+        pairs = groups.setdefault(row[SEQ_COL].strip(), {})
+        if pair not in pairs:
+            pairs[pair] = row
+        for m, col in enumerate(MEASURE_COLS):
+            group.append(pair)
+            measure.append(m)
+            raw.append(row[col].strip())
+        countMul += 1
+    written = time.time()
+
+    means = aggregate_measurements(group, measure, raw)
+    for pairs in groups.values():
+        for pair, row in pairs.items():
+            for m, col in enumerate(MEASURE_COLS):
+                row[col] = means.get((pair, m), '')
+            writer.writerow(row)
+            count += 1
+    return count, countMul, sum(len(p) for p in groups.values()), written
+
+
+def report(count, total, pairCount, countMul, numGroups, start, scanned, written):
+    done = time.time()
+    print("Final number: %d" %count)
+    print("%d rows, %d pairs (%d repeated) in %.1fs: scan %.1fs (%.0f rows/s), "
+          "write %.1fs, aggregate %d measurements of %d pairs %.1fs" % (
+              total, len(pairCount), sum(1 for c in pairCount if c > 1), done - start,
+              scanned - start, total / max(scanned - start, 1e-9), written - scanned,
+              countMul, numGroups, done - written))
 
 
 if __name__ == '__main__':
-    main()
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--input-fn', type=str, default='BindingDB_All.tsv')
+    parser.add_argument('--output-fn', type=str, default='BindingDB_All_firststep_noMulti.tsv')
+    parser.add_argument('--single-pass', action='store_true', default=False,
+                        help='read the input once and aggregate repeated pairs with pandas; same output')
+    parser.add_argument('--columnar', action='store_true', default=False,
+                        help='read and write the .parquet files of columnar.py instead of the .tsv files')
+    args = parser.parse_args()
+    if args.columnar:
+        main_columnar(columnar.parquet_path(args.input_fn), columnar.parquet_path(args.output_fn))
+    elif args.single_pass:
+        main_single_pass(args.input_fn, args.output_fn)
+    else:
+        main(args.input_fn, args.output_fn)
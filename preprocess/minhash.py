@@ -0,0 +1,173 @@
+import functools
+import numpy as np
+from scipy.sparse import coo_matrix
+from scipy.sparse.csgraph import connected_components
+
+MAX_HASH = np.iinfo(np.uint64).max
+# a small universe of codes (e.g. fingerprint bits) is ranked once per permutation and looked up
+TABLE_LIMIT = 1 << 16
+# lookups of all permutations at once up to this many values, one permutation at a time above
+BATCH_LIMIT = 1 << 22
+
+
+def mix64(x):
+    """splitmix64 finalizer of a uint64 array, a cheap stand-in for a random permutation."""
+    x = np.asarray(x, dtype=np.uint64) + np.uint64(0x9E3779B97F4A7C15)
+    x = (x ^ (x >> np.uint64(30))) * np.uint64(0xBF58476D1CE4E5B9)
+    x = (x ^ (x >> np.uint64(27))) * np.uint64(0x94D049BB133111EB)
+    return x ^ (x >> np.uint64(31))
+
+
+def kmer_codes(seqs, k=3):
+    """Codes of the distinct k-mers of every sequence, concatenated, and the offset of every sequence.
+
+    A k-mer is packed 5 bits per residue, so k is at most 12. A sequence
+    shorter than k is a single shingle.
+    """
+    assert 1 <= k <= 12, 'k-mers are packed into 64 bits, k must be at most 12'
+    codes = []
+    offsets = np.zeros(len(seqs) + 1, dtype=np.int64)
+    for i, seq in enumerate(seqs):
+        residues = np.frombuffer(seq.encode('ascii'), dtype=np.uint8).astype(np.uint64) & np.uint64(31)
+        width = min(k, len(residues))
+        kmers = np.zeros(len(residues) - width + 1, dtype=np.uint64)
+        for j in range(width):
+            kmers |= residues[j:len(residues) - width + 1 + j] << np.uint64(5 * j)
+        kmers = np.unique(kmers)
+        codes.append(kmers)
+        offsets[i + 1] = offsets[i] + len(kmers)
+    return np.concatenate(codes) if codes else np.empty(0, dtype=np.uint64), offsets
+
+
+def bit_codes(packed):
+    """Indices of the set bits of packed fingerprints (uint8[N, B]), concatenated, and the offset of every row."""
+    rows, bits = np.nonzero(np.unpackbits(np.asarray(packed, dtype=np.uint8), axis=1))
+    offsets = np.zeros(len(packed) + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum(np.bincount(rows, minlength=len(packed)))
+    return bits.astype(np.uint64), offsets
+
+
+def kmer_universe(k):
+    return 1 << (5 * k)
+
+
+def permutation_seeds(num_perm, seed):
+    return mix64(np.arange(num_perm, dtype=np.uint64) + np.uint64(seed) * np.uint64(num_perm))
+
+
+@functools.lru_cache(maxsize=8)
+def permutation_ranks(num_perm, seed, universe):
+    """uint16[num_perm, universe] rank of every code in each permutation, ordered like their hash."""
+    seeds = permutation_seeds(num_perm, seed)
+    order = np.argsort(mix64(np.arange(universe, dtype=np.uint64)[None, :] ^ seeds[:, None]), axis=1)
+    ranks = np.empty_like(order, dtype=np.uint16)
+    np.put_along_axis(ranks, order, np.arange(universe, dtype=np.uint16)[None, :], axis=1)
+    return ranks
+
+
+@functools.lru_cache(maxsize=8)
+def code_ranks(num_perm, seed, universe):
+    """uint16[universe, num_perm], the ranks of every code in one row."""
+    return np.ascontiguousarray(permutation_ranks(num_perm, seed, universe).T)
+
+
+def signatures(codes, offsets, num_perm=64, seed=1, universe=None):
+    """uint64[N, num_perm] MinHash signatures of the sets `codes[offsets[i]:offsets[i + 1]]`.
+
+    The fraction of equal signature values of two sets estimates their Jaccard
+    similarity, which for fingerprint bits is the Tanimoto similarity.
+    `universe` is the number of possible codes (`kmer_universe(k)`, or the
+    bits of a fingerprint); signatures are only comparable when computed
+    with the same `num_perm`, `seed` and `universe`.
+    """
+    seeds = permutation_seeds(num_perm, seed)
+    n = len(offsets) - 1
+    sig = np.full((n, num_perm), MAX_HASH, dtype=np.uint64)
+    nonempty = np.flatnonzero(offsets[1:] > offsets[:-1])
+    if len(codes) == 0:
+        return sig
+    small = universe is not None and universe <= TABLE_LIMIT
+    if small:
+        codes = codes.astype(np.int64)
+        if len(codes) * num_perm <= BATCH_LIMIT:
+            # e.g. a single query: the rows of its codes, reduced per set
+            rows = np.take(code_ranks(num_perm, seed, universe), codes, axis=0)
+            sig[nonempty] = np.minimum.reduceat(rows, offsets[nonempty], axis=0)
+            return sig
+        ranks = permutation_ranks(num_perm, seed, universe)
+    for p in range(num_perm):
+        hashes = ranks[p][codes] if small else mix64(codes ^ seeds[p])
+        sig[nonempty, p] = np.minimum.reduceat(hashes, offsets[nonempty])
+    return sig
+
+
+def choose_bands(num_perm, threshold):
+    """Number of LSH bands for `threshold`.
+
+    Two sets with Jaccard similarity s share a bucket in at least one of b
+    bands of r rows with probability 1 - (1 - s^r)^b, which rises steeply
+    around (1/b)^(1/r). The split with the highest such point clearly below
+    `threshold` keeps the recall high at the threshold while producing few
+    candidates.
+    """
+    best = num_perm
+    for bands in range(1, num_perm + 1):
+        if num_perm % bands:
+            continue
+        rows = num_perm // bands
+        if (1.0 / bands) ** (1.0 / rows) <= 0.8 * threshold:
+            best = bands
+            break
+    return best
+
+
+def band_keys(sig, bands):
+    """uint64[bands, N] bucket keys: the values of every band of rows hashed together."""
+    rows = sig.shape[1] // bands
+    sig = sig[:, :bands * rows].reshape(len(sig), bands, rows)
+    keys = np.broadcast_to(np.arange(bands, dtype=np.uint64), (len(sig), bands))
+    for j in range(rows):
+        keys = mix64(keys ^ sig[:, :, j])
+    return np.ascontiguousarray(keys.T)
+
+
+def candidate_pairs(sig, bands, reps=4):
+    """int64[M, 2] distinct pairs (i < j) sharing a bucket in some band.
+
+    Every member of a bucket is paired with the first `reps` members only, so
+    a bucket of m members gives at most reps * m pairs instead of m^2 / 2.
+    The first members link the rest of the bucket once clustered.
+    """
+    n = len(sig)
+    pairs = []
+    for keys in band_keys(sig, bands):
+        order = np.argsort(keys, kind='stable')
+        sorted_keys = keys[order]
+        first = np.ones(n, dtype=bool)
+        first[1:] = sorted_keys[1:] != sorted_keys[:-1]
+        starts = np.flatnonzero(first)
+        bucket = np.cumsum(first) - 1
+        pos = np.arange(n) - starts[bucket]
+        for j in range(reps):
+            members = np.flatnonzero(pos > j)
+            pairs.append(np.stack([order[starts[bucket[members]] + j], order[members]], axis=1))
+    if not pairs:
+        return np.empty((0, 2), dtype=np.int64)
+    pairs = np.sort(np.concatenate(pairs), axis=1)
+    codes = np.unique(pairs[:, 0] * n + pairs[:, 1])
+    return np.stack([codes // n, codes % n], axis=1)
+
+
+def estimated_similarity(sig, pairs, block=1 << 20):
+    """Jaccard similarity of `pairs` estimated from their signatures."""
+    sim = np.empty(len(pairs), dtype=np.float32)
+    for start in range(0, len(pairs), block):
+        i, j = pairs[start:start + block].T
+        sim[start:start + block] = (sig[i] == sig[j]).mean(axis=1)
+    return sim
+
+
+def cluster(n, pairs):
+    """Connected component of every one of `n` items linked by `pairs`."""
+    graph = coo_matrix((np.ones(len(pairs), dtype=np.int8), (pairs[:, 0], pairs[:, 1])), shape=(n, n))
+    return connected_components(graph, directed=False)[1]
@@ -0,0 +1,70 @@
+import io
+
+import numpy as np
+
+
+class ProteinBinarizer(object):
+    """Map protein sequences to the ids of a character dictionary with a byte lookup table.
+
+    Gives the same ids as `Dictionary.encode_line(addspace(seq))`: the
+    symbols of `dict_fn` follow fairseq's four special symbols (<s>, <pad>,
+    </s>, <unk>), every other character maps to <unk> and whitespace is
+    skipped. Instead of splitting strings and looking characters up one by
+    one, whole sequences are converted with `np.frombuffer` and indexing
+    into a 256-entry table.
+    """
+
+    bos, pad, eos, unk = 0, 1, 2, 3
+    nspecial = 4
+
+    def __init__(self, dict_fn, append_eos=True, prepend_bos=False):
+        self.append_eos = append_eos
+        self.prepend_bos = prepend_bos
+        self.lut = np.full(256, self.unk, dtype=np.int32)
+        with io.open(dict_fn, 'r', encoding='utf8') as f:
+            symbols = [line.rstrip().rsplit(' ', 1)[0] for line in f if line.strip()]
+        for i, symbol in enumerate(symbols):
+            if len(symbol) != 1 or ord(symbol) > 255:
+                raise ValueError('{} is not a single byte character: {}'.format(dict_fn, symbol))
+            self.lut[ord(symbol)] = self.nspecial + i
+        self.vocab_size = self.nspecial + len(symbols)
+        # whitespace separates tokens in the text pipeline and is dropped
+        self.lut[[ord(c) for c in ' \t\r\n\x0b\x0c']] = -1
+
+    def _lookup(self, seq):
+        # latin-1 keeps one byte per character, other characters become '?' (<unk>)
+        return self.lut[np.frombuffer(seq.encode('latin-1', errors='replace'), dtype=np.uint8)]
+
+    def _wrap(self, ids):
+        if self.prepend_bos:
+            ids = np.concatenate([[self.bos], ids])
+        if self.append_eos:
+            ids = np.concatenate([ids, [self.eos]])
+        return ids.astype(np.int32)
+
+    def encode(self, seq):
+        ids = self._lookup(seq)
+        return self._wrap(ids[ids >= 0])
+
+    def encode_batch(self, seqs):
+        """Encode many sequences with one table lookup over their concatenation."""
+        if len(seqs) == 0:
+            return []
+        ids = self._lookup(''.join(seqs))
+        if (ids < 0).any():
+            return [self.encode(seq) for seq in seqs]
+
+        lengths = np.array([len(seq) for seq in seqs], dtype=np.int64)
+        extra = int(self.prepend_bos) + int(self.append_eos)
+        ends = np.cumsum(lengths + extra)
+        starts = ends - lengths - extra
+        out = np.empty(int(ends[-1]) if len(ends) else 0, dtype=np.int32)
+        residue = np.ones(len(out), dtype=bool)
+        if self.prepend_bos:
+            out[starts] = self.bos
+            residue[starts] = False
+        if self.append_eos:
+            out[ends - 1] = self.eos
+            residue[ends - 1] = False
+        out[residue] = ids
+        return np.split(out, ends[:-1])
@@ -0,0 +1,178 @@
+import io
+import sys
+import json
+import time
+import argparse
+import multiprocessing
+import numpy as np
+
+import minhash
+import streaming
+
+
+def sequence_signatures(seqs, k, num_perm, seed):
+    codes, offsets = minhash.kmer_codes(seqs, k)
+    return minhash.signatures(codes, offsets, num_perm, seed, minhash.kmer_universe(k))
+
+
+def _sequence_signatures(args):
+    return sequence_signatures(*args)
+
+
+class ProteinLSHIndex(object):
+    """MinHash LSH index of protein sequences over residue k-mers.
+
+    Every sequence is a MinHash signature; the keys of each band are kept
+    sorted with the row they belong to, so the sequences sharing a bucket
+    with a query are found by binary search. A query returns the rows whose
+    estimated k-mer Jaccard similarity is at or above a threshold. The bands
+    are chosen for `threshold` at build time; queries with a lower threshold
+    may miss hits.
+
+    Saved as `{prefix}.json` (parameters), `{prefix}.sig.npy`,
+    `{prefix}.keys.npy`, `{prefix}.rows.npy` and `{prefix}.ids` (one id per
+    row); the arrays are memory-mapped when loaded.
+    """
+
+    def __init__(self, sig, keys, rows, ids, k=3, num_perm=64, seed=1, threshold=0.5):
+        self.sig = sig
+        self.keys = keys
+        self.rows = rows
+        self.ids = ids
+        self.k = k
+        self.num_perm = num_perm
+        self.seed = seed
+        self.threshold = threshold
+
+    @property
+    def bands(self):
+        return len(self.keys)
+
+    def __len__(self):
+        return len(self.sig)
+
+    @classmethod
+    def build(cls, seqs, ids=None, k=3, num_perm=64, seed=1, threshold=0.5, workers=1, chunk_size=1000):
+        chunks = [(seqs[i:i + chunk_size], k, num_perm, seed) for i in range(0, len(seqs), chunk_size)]
+        if workers > 1:
+            pool = multiprocessing.Pool(workers)
+            parts = list(pool.imap(_sequence_signatures, chunks))
+            pool.close()
+            pool.join()
+        else:
+            parts = [_sequence_signatures(chunk) for chunk in chunks]
+        sig = np.concatenate(parts) if parts else np.empty((0, num_perm), dtype=np.uint64)
+        keys = minhash.band_keys(sig, minhash.choose_bands(num_perm, threshold))
+        rows = np.argsort(keys, axis=1, kind='stable')
+        keys = np.take_along_axis(keys, rows, axis=1)
+        # int32 rows halve the index for any realistic number of proteins
+        rows = rows.astype(np.int32 if len(sig) < 2 ** 31 else np.int64)
+        ids = list(ids) if ids is not None else [str(i) for i in range(len(seqs))]
+        return cls(sig, keys, rows, ids, k, num_perm, seed, threshold)
+
+    def save(self, prefix):
+        with open(prefix + '.json', 'w') as f:
+            json.dump({'k': self.k, 'num_perm': self.num_perm, 'seed': self.seed, 'threshold': self.threshold}, f)
+        np.save(prefix + '.sig.npy', self.sig)
+        np.save(prefix + '.keys.npy', self.keys)
+        np.save(prefix + '.rows.npy', self.rows)
+        with io.open(prefix + '.ids', 'w', encoding='utf8', newline='\n') as f:
+            for i in self.ids:
+                f.write(i + '\n')
+
+    @classmethod
+    def load(cls, prefix, mmap_mode='r'):
+        with open(prefix + '.json') as f:
+            params = json.load(f)
+        ids = list(streaming.read_lines(prefix + '.ids'))
+        # plain ndarray views of the maps: slicing a np.memmap costs more than the lookup itself
+        arrays = [np.asarray(np.load('{}.{}.npy'.format(prefix, name), mmap_mode=mmap_mode))
+                  for name in ['sig', 'keys', 'rows']]
+        return cls(*arrays, ids=ids, **params)
+
+    def signature(self, seq):
+        return sequence_signatures([seq], self.k, self.num_perm, self.seed)[0]
+
+    def candidates(self, sig):
+        """Rows sharing at least one bucket with signature `sig`."""
+        found = []
+        keys = minhash.band_keys(sig[None, :], self.bands)[:, 0]
+        # the bucket of a key is [key, key + 1) in the sorted keys of its band
+        bounds = np.stack([keys, keys + np.uint64(1)], axis=1)
+        for band, key in enumerate(keys):
+            left, right = self.keys[band].searchsorted(bounds[band])
+            if key == minhash.MAX_HASH:
+                right = self.keys.shape[1]
+            if right > left:
+                found.append(self.rows[band, left:right])
+        return np.unique(np.concatenate(found)) if found else np.empty(0, dtype=np.int64)
+
+    def query(self, seq, threshold=None):
+        """(rows, similarities) of the indexed sequences at or above `threshold`, most similar first."""
+        threshold = self.threshold if threshold is None else threshold
+        sig = self.signature(seq)
+        rows = self.candidates(sig)
+        sim = (self.sig[rows] == sig[None, :]).mean(axis=1)
+        keep = sim >= threshold
+        rows, sim = rows[keep], sim[keep]
+        order = np.lexsort((rows, -sim))
+        return rows[order], sim[order]
+
+    def query_ids(self, seq, threshold=None):
+        rows, sim = self.query(seq, threshold)
+        return [(self.ids[i], s) for i, s in zip(rows, sim)]
+
+
+def read_sequences(fn):
+    # .pro files, with or without the spaces of add_space.py
+    return [line.replace(' ', '') for line in streaming.read_lines(fn)]
+
+
+def build(args):
+    seqs = read_sequences(args.fn)
+    ids = list(streaming.read_lines(args.ids)) if args.ids else [str(i) for i in range(len(seqs))]
+    assert len(ids) == len(seqs), '%s is not aligned with %s' % (args.ids, args.fn)
+    # exact duplicates are indexed once, under the id of their first line
+    first = {}
+    for seq, i in zip(seqs, ids):
+        first.setdefault(seq, i)
+    start = time.time()
+    index = ProteinLSHIndex.build(list(first), list(first.values()), args.kmer, args.num_perm, args.seed,
+                                  args.threshold, args.workers)
+    index.save(args.index)
+    print('%d sequences, %d distinct, %d bands of %d rows, built in %.1fs' % (
+        len(seqs), len(index), index.bands, index.num_perm // index.bands, time.time() - start))
+
+
+def query(args):
+    index = ProteinLSHIndex.load(args.index)
+    start = time.time()
+    count = 0
+    for n, seq in enumerate(read_sequences(args.fn)):
+        for i, sim in index.query_ids(seq, args.threshold):
+            sys.stdout.write('%d\t%s\t%.4f\n' % (n, i, sim))
+        count += 1
+    print('%d queries against %d sequences, %.3fms per query' % (
+        count, len(index), (time.time() - start) * 1000 / max(count, 1)), file=sys.stderr)
+
+
+if __name__ == "__main__":
+    # build: index the sequences of a .pro file; query: print line, id and similarity of the hits of every sequence
+    parser = argparse.ArgumentParser()
+    parser.add_argument('command', type=str, choices=['build', 'query'])
+    parser.add_argument('fn', type=str, help='sequences, one per line')
+    parser.add_argument('--index', type=str, required=True, help='prefix of the index files')
+    parser.add_argument('--ids', type=str, default=None, help='id of every sequence (build), defaults to line numbers')
+    parser.add_argument('--kmer', type=int, default=3)
+    parser.add_argument('--num-perm', type=int, default=64)
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--threshold', type=float, default=None,
+                        help='k-mer Jaccard similarity; build: defaults to 0.5, query: defaults to the one of the index')
+    parser.add_argument('--workers', type=int, default=1)
+    args = parser.parse_args()
+    if args.command == 'build':
+        if args.threshold is None:
+            args.threshold = 0.5
+        build(args)
+    else:
+        query(args)
@@ -0,0 +1,80 @@
+import base64
+import numpy as np
+
+
+# PUBCHEM_CACTVS_SUBSKEYS: a 4-byte length prefix, then the 881 bits of the fingerprint
+FP_BITS = 881
+FP_BYTES = (FP_BITS + 7) // 8
+
+
+def decode_bits(subskeys):
+    """Bits of a base64 PUBCHEM_CACTVS_SUBSKEYS value without the length prefix, as uint8 0/1."""
+    bits = np.unpackbits(np.frombuffer(base64.b64decode(subskeys), dtype=np.uint8))
+    return bits[32:-7]
+
+
+def bits_to_string(bits):
+    return (bits + ord('0')).tobytes().decode('ascii')
+
+
+def pack(bits):
+    """uint8[FP_BYTES] of a decoded fingerprint."""
+    return np.packbits(bits[:FP_BITS], bitorder='big')
+
+
+def unpack_strings(packed):
+    """'0'/'1' strings of packed fingerprints (uint8[N, FP_BYTES])."""
+    bits = np.unpackbits(np.asarray(packed, dtype=np.uint8), axis=1)[:, :FP_BITS] + ord('0')
+    text = bits.tobytes().decode('ascii')
+    return [text[i:i + FP_BITS] for i in range(0, len(text), FP_BITS)]
+
+
+class FingerprintStore(object):
+    """Packed fingerprints with a sorted CID index.
+
+    `{prefix}.cid.npy` holds the sorted int64 CIDs and `{prefix}.fp.npy` the
+    matching uint8[N, 111] fingerprints, 8 times smaller than '0'/'1'
+    strings. Both are memory-mapped when loaded and looked up with a binary
+    search.
+    """
+
+    def __init__(self, cids, fingerprints):
+        self.cids = cids
+        self.fingerprints = fingerprints
+
+    @classmethod
+    def build(cls, cids, fingerprints):
+        """Sort by CID; the last fingerprint of a repeated CID wins, as with a dict."""
+        cids = np.asarray(cids, dtype=np.int64)
+        fingerprints = np.asarray(fingerprints, dtype=np.uint8).reshape(len(cids), FP_BYTES)
+        last = len(cids) - 1 - np.unique(cids[::-1], return_index=True)[1]
+        return cls(cids[last], fingerprints[last])
+
+    @classmethod
+    def load(cls, prefix, mmap_mode='r'):
+        return cls(np.load(prefix + '.cid.npy', mmap_mode=mmap_mode), np.load(prefix + '.fp.npy', mmap_mode=mmap_mode))
+
+    def save(self, prefix):
+        np.save(prefix + '.cid.npy', self.cids)
+        np.save(prefix + '.fp.npy', self.fingerprints)
+
+    def __len__(self):
+        return len(self.cids)
+
+    def index(self, cids):
+        """Rows of `cids`; raises KeyError for the first unknown CID."""
+        cids = np.asarray(cids, dtype=np.int64)
+        pos = np.searchsorted(self.cids, cids)
+        pos[pos == len(self.cids)] = 0
+        missing = self.cids[pos] != cids if len(self.cids) else np.ones(len(cids), dtype=bool)
+        if missing.any():
+            raise KeyError(str(cids[missing][0]))
+        return pos
+
+    def lookup(self, cids):
+        """Packed fingerprints of `cids`, uint8[len(cids), 111]."""
+        return self.fingerprints[self.index(cids)]
+
+    def lookup_strings(self, cids):
+        """'0'/'1' strings of `cids`, as written to CID_Smi_Feature."""
+        return unpack_strings(self.lookup(cids))
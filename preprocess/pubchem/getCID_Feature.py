@@ -3,62 +3,88 @@ from __future__ import division
 import re
 import csv
 import sys
+import glob
+import time
+import argparse
+import multiprocessing
 from subprocess import call
 
-str2bin = {'0': 52, '1': 53, '2': 54, '3': 55, '4': 56, '5': 57, '6': 58, '7': 59, '8': 60, '9': 61, '+': 62, '/': 63,
-           'A': 0, 'C': 2, 'B': 1, 'E': 4, 'D': 3, 'G': 6, 'F': 5, 'I': 8, 'H': 7, 'K': 10, 'J': 9,
-           'M': 12, 'L': 11, 'O': 14, 'N': 13, 'Q': 16, 'P': 15, 'S': 18, 'R': 17, 'U': 20, 'T': 19,
-           'W': 22, 'V': 21, 'Y': 24, 'X': 23, 'Z': 25, 'a': 26, 'c': 28, 'b': 27, 'e': 30, 'd': 29,
-           'g': 32, 'f': 31, 'i': 34, 'h': 33, 'k': 36, 'j': 35, 'm': 38, 'l': 37, 'o': 40, 'n': 39,
-           'q': 42, 'p': 41, 's': 44, 'r': 43, 'u': 46, 't': 45, 'w': 48, 'v': 47, 'y': 50, 'x': 49, 'z': 51}
+import numpy as np
+
+from fingerprints import FP_BYTES, FingerprintStore, bits_to_string, decode_bits, pack
+
 def decode64(string):
-    result = ''
-    for c in string:
-        if c == '=':
-            result = result[:-2]
-        elif c == ' ':
-            continue
-        elif c == '\n':
-            continue
-        else:
-            temp = '{:b}'.format(str2bin[c])
-            temp = (6-len(temp)) * '0' + temp
-            result += temp
-    return result[32:-7]
+    """881 '0'/'1' characters of a base64 PUBCHEM_CACTVS_SUBSKEYS value."""
+    return bits_to_string(decode_bits(string))
+
+
+def parse_sdf(resultFile):
+    """CID_Smi_Feature text of one SDF file, with its CIDs and packed fingerprints."""
+    parts = []
+    storeStr = []
+    cids = []
+    packed = []
+    cid = None
+    fp = None
+    with open(resultFile) as f:
+        for line in f:
+            if line.strip() == '> <PUBCHEM_COMPOUND_CID>':
+                storeStr.append(line)
+                line = next(f)
+                storeStr.append(line)
+                cid = int(line)
+            elif line.strip() == '> <PUBCHEM_CACTVS_SUBSKEYS>':
+                storeStr.append(line)
+                bits = decode_bits(next(f).strip())
+                storeStr.append(bits_to_string(bits) + '\n')
+                fp = pack(bits)
+            elif line.strip() == '> <PUBCHEM_OPENEYE_CAN_SMILES>':
+                storeStr.append(line)
+                storeStr.append(next(f))
+            elif line.strip() == '$$$$':
+                storeStr.append(line + '\n')
+                parts.extend(storeStr)
+                storeStr = []
+                if cid is not None and fp is not None:
+                    cids.append(cid)
+                    packed.append(fp)
+                cid = None
+                fp = None
+    return ''.join(parts), cids, packed
 
-def main():
-    fileNum = 3
-    count = 0
-    fileC = 1
-    i = 0
-    w = open("CID_Smi_Feature", 'w+')
-    for i in range(1,fileNum+1):
-        resultFile = 'CID' + str(i) + '.sdf'
-        with open(resultFile) as f:
-            storeStr = ''
-            for line in f:
-                if line.strip() == '> <PUBCHEM_COMPOUND_CID>':
-                    storeStr += line
-                    line = f.next()
-                    storeStr += line
-                elif line.strip() == '> <PUBCHEM_CACTVS_SUBSKEYS>':
-                    storeStr += line
-                    key = f.next().strip()
-                    key = decode64(key)
-                    storeStr += key + '\n'
-                elif line.strip() == '> <PUBCHEM_OPENEYE_CAN_SMILES>':
-                    storeStr += line
-                    line = f.next()
-                    storeStr += line
-                elif line.strip() == '$$$$':
-                    storeStr += line + '\n'
-                    w.write(storeStr)
-                    storeStr = ''
-     # print total
 
+def sdf_files():
+    # CID1.sdf, CID2.sdf, ... in numeric order
+    files = glob.glob('CID*.sdf')
+    return sorted(files, key=lambda fn: int(re.sub(r'\D', '', fn) or 0))
 
 
+def main(files, workers=1, output='CID_Smi_Feature', store='CID_Feature'):
+    cids = []
+    packed = []
+    start = time.time()
+    pool = multiprocessing.Pool(workers)
+    with open(output, 'w+') as w:
+        # one SDF file per task, written in the order of `files`
+        for resultFile, (text, file_cids, file_packed) in zip(files, pool.imap(parse_sdf, files)):
+            w.write(text)
+            cids.extend(file_cids)
+            packed.extend(file_packed)
+            print('%s: %d compounds' % (resultFile, len(file_cids)))
+    pool.close()
+    pool.join()
+    fingerprints = FingerprintStore.build(cids, np.array(packed, dtype=np.uint8).reshape(len(packed), FP_BYTES))
+    fingerprints.save(store)
+    print('%d compounds, %d unique CIDs in %.1fs; fingerprints in %s.cid.npy and %s.fp.npy' % (
+        len(cids), len(fingerprints), time.time() - start, store, store))
 
 
 if __name__ == '__main__':
-    main()
\ No newline at end of file
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--files', type=str, nargs='+', default=None, help='defaults to every CID*.sdf')
+    parser.add_argument('--workers', type=int, default=1)
+    parser.add_argument('--output', type=str, default='CID_Smi_Feature')
+    parser.add_argument('--store', type=str, default='CID_Feature',
+                        help='prefix of the packed fingerprint store used by split.py --fingerprints')
+    args = parser.parse_args()
+    main(args.files or sdf_files(), args.workers, args.output, args.store)
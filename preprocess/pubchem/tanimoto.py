@@ -0,0 +1,199 @@
+import sys
+import time
+import argparse
+import multiprocessing
+import numpy as np
+
+from fingerprints import FingerprintStore
+
+# popcount of every 16-bit value, for NumPy versions without np.bitwise_count
+POPCOUNT16 = np.array([bin(i).count('1') for i in range(1 << 16)], dtype=np.uint8)
+# queries and library rows compared at once: a 64 x 16384 tile keeps the temporaries near 10 MB
+QUERY_BLOCK = 64
+LIBRARY_BLOCK = 16384
+# hits are ranked by one int64 key per (score, row), see hit_keys
+ROW_MASK = np.int64(0xFFFFFFFF)
+NO_HIT = np.iinfo(np.int64).min
+
+# index shared with the forked workers of all_vs_all
+_index = None
+
+
+def popcount(words):
+    """Set bits of every uint64 of `words`."""
+    if hasattr(np, 'bitwise_count'):
+        return np.bitwise_count(words)
+    counts = POPCOUNT16[words.view(np.uint16)].reshape(words.shape + (4,))
+    return counts.sum(axis=-1, dtype=np.uint8)
+
+
+def to_words(packed):
+    """uint64[N, 14] words of packed fingerprints (uint8[N, 111]), zero padded."""
+    packed = np.asarray(packed, dtype=np.uint8)
+    n, width = packed.shape
+    padded = np.zeros((n, -(-width // 8) * 8), dtype=np.uint8)
+    padded[:, :width] = packed
+    return padded.view(np.uint64)
+
+
+def hit_keys(scores, rows):
+    """int64 keys ordered by score, then by lower row: the float32 bits of the score over the complement of the row."""
+    return (scores.view(np.int32).astype(np.int64) << 32) | (ROW_MASK - rows)
+
+
+def decode_keys(keys):
+    """(rows, scores) of hit keys."""
+    return ROW_MASK - (keys & ROW_MASK), (keys >> 32).astype(np.int32).view(np.float32)
+
+
+def top_keys(keys, k):
+    """The `k` largest keys of every row of a 2-d array, unsorted."""
+    if keys.shape[1] <= k:
+        return keys
+    return np.partition(keys, keys.shape[1] - k, axis=1)[:, -k:]
+
+
+class TanimotoIndex(object):
+    """Tanimoto similarity of query fingerprints against a library.
+
+    The library is kept as uint64 words, one contiguous array per word, with
+    the bit count of every fingerprint, so a comparison is an AND and a
+    popcount per word. Queries run block by block against blocks of the
+    library and only the selected hits of a block are kept, so memory does
+    not grow with the library size.
+    """
+
+    def __init__(self, words, cids=None):
+        words = np.asarray(words, dtype=np.uint64)
+        self.columns = np.ascontiguousarray(words.T)
+        self.counts = popcount(words).sum(axis=1, dtype=np.int32)
+        self.cids = np.arange(len(words), dtype=np.int64) if cids is None else np.asarray(cids)
+
+    @classmethod
+    def from_store(cls, store):
+        return cls(to_words(store.fingerprints), store.cids)
+
+    def __len__(self):
+        return len(self.counts)
+
+    def words(self, rows):
+        return self.columns[:, rows].T
+
+    def similarity(self, query, start=0, end=None):
+        """float32[len(query), end - start] similarities of `query` words to library rows start:end."""
+        query = np.atleast_2d(np.asarray(query, dtype=np.uint64))
+        columns = self.columns[:, start:end]
+        common = np.zeros((len(query), columns.shape[1]), dtype=np.int32)
+        for w in range(len(columns)):
+            common += popcount(np.bitwise_and.outer(query[:, w], columns[w]))
+        union = popcount(query).sum(axis=1, dtype=np.int32)[:, None] + self.counts[None, start:end] - common
+        # two empty fingerprints have no bit in common: similarity 0
+        return (common / np.maximum(union, 1)).astype(np.float32)
+
+    def search_block(self, query, k=10, threshold=0.0, exclude=None, library_block=LIBRARY_BLOCK):
+        """Best library rows of every query, as a list of (rows, scores), best first.
+
+        Hits are the rows at or above `threshold`, at most `k` of them unless
+        `k` is None. Ties are broken by lower row, so the result does not
+        depend on the blocking. `exclude[i]` is a library row never returned
+        for query `i` (e.g. the query itself), or -1.
+        """
+        if k is not None and k < 1:
+            raise ValueError('k must be at least 1, or None for every hit')
+        query = np.atleast_2d(query)
+        best = np.full((len(query), k), NO_HIT, dtype=np.int64) if k is not None else None
+        found = []
+        for start in range(0, len(self), library_block):
+            scores = self.similarity(query, start, start + library_block)
+            rows = np.arange(start, start + scores.shape[1], dtype=np.int64)
+            keys = hit_keys(scores, rows[None, :])
+            keys[scores < threshold] = NO_HIT
+            if exclude is not None:
+                inside = (exclude >= start) & (exclude < start + library_block)
+                keys[np.flatnonzero(inside), exclude[inside] - start] = NO_HIT
+            if k is not None:
+                # only the k best of the tile and of the blocks before are kept
+                best = top_keys(np.concatenate([best, top_keys(keys, k)], axis=1), k)
+            else:
+                i, j = np.nonzero(keys != NO_HIT)
+                found.append((i, keys[i, j]))
+        if k is None:
+            i = np.concatenate([np.empty(0, dtype=np.int64)] + [i for i, keys in found])
+            keys = np.concatenate([np.empty(0, dtype=np.int64)] + [keys for i, keys in found])
+            order = np.lexsort((-keys, i))
+            groups = np.split(keys[order], np.searchsorted(i[order], np.arange(1, len(query))))
+        else:
+            groups = [keys[keys != NO_HIT] for keys in best]
+        return [decode_keys(np.sort(keys)[::-1]) for keys in groups]
+
+    def search(self, query, k=10, threshold=0.0):
+        """(cids, scores) of the library hits of one query fingerprint (uint64 words)."""
+        rows, scores = self.search_block(query, k, threshold)[0]
+        return self.cids[rows], scores
+
+    def all_vs_all(self, k=10, threshold=0.0, workers=1, query_block=QUERY_BLOCK):
+        """Yield (cid, neighbour cids, scores) for every library entry, in library order."""
+        global _index
+        starts = range(0, len(self), query_block)
+        if workers > 1:
+            # forked workers share the library
+            _index = self
+            pool = multiprocessing.get_context('fork').Pool(workers)
+            blocks = pool.imap(_search_rows, [(start, start + query_block, k, threshold) for start in starts])
+        else:
+            blocks = (self.search_rows(start, start + query_block, k, threshold) for start in starts)
+        try:
+            for start, hits in zip(starts, blocks):
+                for i, (rows, scores) in enumerate(hits):
+                    yield self.cids[start + i], self.cids[rows], scores
+        finally:
+            if workers > 1:
+                pool.terminate()
+                _index = None
+
+    def search_rows(self, start, end, k, threshold):
+        rows = np.arange(start, min(end, len(self)), dtype=np.int64)
+        return self.search_block(self.words(rows), k, threshold, exclude=rows)
+
+
+def _search_rows(args):
+    return _index.search_rows(*args)
+
+
+def main(args):
+    # -k 0 keeps every hit at or above the threshold
+    k = args.k or None
+    store = FingerprintStore.load(args.store)
+    index = TanimotoIndex.from_store(store)
+    print('%d fingerprints loaded from %s' % (len(index), args.store), file=sys.stderr)
+    out = open(args.output, 'w') if args.output else sys.stdout
+    start = time.time()
+    if args.query:
+        queries = to_words(store.lookup(args.query))
+        for cid, query in zip(args.query, queries):
+            for neighbour, score in zip(*index.search(query, k, args.threshold)):
+                out.write('%d\t%d\t%.4f\n' % (cid, neighbour, score))
+    else:
+        for cid, neighbours, scores in index.all_vs_all(k, args.threshold, args.workers):
+            for neighbour, score in zip(neighbours, scores):
+                out.write('%d\t%d\t%.4f\n' % (cid, neighbour, score))
+    if args.output:
+        out.close()
+    print('%.2fs' % (time.time() - start), file=sys.stderr)
+
+
+if __name__ == '__main__':
+    # nearest neighbours by Tanimoto similarity of the fingerprint store of getCID_Feature.py
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--store', type=str, default='CID_Feature')
+    parser.add_argument('--query', type=int, nargs='+', default=None,
+                        help='CIDs to search for; every CID of the store against all others when omitted')
+    parser.add_argument('-k', type=int, default=10,
+                        help='neighbours per query, 0 for every neighbour at or above --threshold')
+    parser.add_argument('--threshold', type=float, default=0.0, help='minimum similarity')
+    parser.add_argument('--workers', type=int, default=1, help='processes for the all-vs-all search')
+    parser.add_argument('--output', type=str, default=None, help='tsv of cid, neighbour cid, similarity')
+    args = parser.parse_args()
+    if args.k < 0:
+        parser.error('-k must be at least 0')
+    main(args)
@@ -0,0 +1,80 @@
+import os
+import sqlite3
+
+
+class SmilesCache(object):
+    """On-disk cache of canonical SMILES, shared by every dataset and run.
+
+    Entries are keyed by the raw SMILES and a `version` string (the RDKit
+    version plus anything else that changes the result), so upgrading RDKit
+    never serves stale entries. SMILES that RDKit rejects are cached as None.
+    """
+
+    # stay below SQLite's limit of host parameters per statement
+    batch = 500
+
+    def __init__(self, path, version):
+        dirname = os.path.dirname(os.path.abspath(path))
+        if not os.path.isdir(dirname):
+            os.makedirs(dirname)
+        self.version = version
+        self.conn = sqlite3.connect(path)
+        self.conn.execute(
+            'CREATE TABLE IF NOT EXISTS canonical '
+            '(version TEXT NOT NULL, raw TEXT NOT NULL, can TEXT, PRIMARY KEY (version, raw))')
+        self.conn.commit()
+        self.hits = 0
+        self.misses = 0
+
+    def get_many(self, raws):
+        """Return {raw: canonical or None} for the cached entries of `raws`."""
+        found = {}
+        for i in range(0, len(raws), self.batch):
+            part = raws[i:i + self.batch]
+            rows = self.conn.execute(
+                'SELECT raw, can FROM canonical WHERE version = ? AND raw IN ({})'.format(
+                    ','.join('?' * len(part))),
+                [self.version] + part)
+            found.update(rows)
+        self.hits += len(found)
+        self.misses += len(raws) - len(found)
+        return found
+
+    def put_many(self, items):
+        self.conn.executemany(
+            'INSERT OR REPLACE INTO canonical (version, raw, can) VALUES (?, ?, ?)',
+            [(self.version, raw, can) for raw, can in items])
+        self.conn.commit()
+
+    def close(self):
+        self.conn.close()
+
+
+class CachedChunkMapper(object):
+    """Chunk mapper for `streaming.run` that only computes unseen inputs.
+
+    Every chunk is deduplicated when dispatched, looked up in the cache, and
+    only the missing unique inputs are sent to the pool without waiting for
+    them, so the next chunk is computed while the current one is written.
+    Their results are added to the cache when the chunk is consumed.
+    """
+
+    def __init__(self, func, cache, chunksize=1000):
+        self.func = func
+        self.cache = cache
+        self.chunksize = chunksize
+
+    def __call__(self, pool, chunk):
+        unique = list(dict.fromkeys(chunk))
+        known = self.cache.get_many(unique)
+        todo = [raw for raw in unique if raw not in known]
+        computing = pool.map_async(self.func, todo, chunksize=self.chunksize) if todo else None
+        return self._results(chunk, known, todo, computing)
+
+    def _results(self, chunk, known, todo, computing):
+        if computing is not None:
+            computed = computing.get()
+            self.cache.put_many(zip(todo, computed))
+            known.update(zip(todo, computed))
+        for raw in chunk:
+            yield known[raw]
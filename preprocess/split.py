@@ -1,348 +1,52 @@
 #coding:utf-8
 import re
-import random
 import os
-import sys
 import csv
+import time
+import argparse
+import itertools
+import multiprocessing
 import numpy as np
-# def pos2vec(string):
-# 	vector = 16712 * ['0']
-# 	for pos in string.split():
-# 		vector[int(pos)] = '1'
-# 	return ''.join(str(x) for x in vector)
-
-def main(dataDir):
-	countic = 0
-	countki = 0
-	countkd = 0
-	countec = 0
-	noicC = 0
-	nokiC = 0
-	nokdC = 0
-	noecC = 0
-	nouid = 0
-	dropic = 0
-	dropki = 0
-	dropkd = 0
-	dropec = 0
-	dropicC = 0
-	dropkiC = 0
-	dropkdC = 0
-	dropecC = 0
-	count1_ic = 0
-	count2_ic = 0
-	count3_ic = 0
-	count4_ic = 0
-	count5_ic = 0
-	count6_ic = 0
-	count1_ec = 0
-	count2_ec = 0
-	count3_ec = 0
-	count4_ec = 0
-	count5_ec = 0
-	count6_ec = 0
-	count1_ki = 0
-	count2_ki = 0
-	count3_ki = 0
-	count4_ki = 0
-	count5_ki = 0
-	count6_ki = 0
-	count1_kd = 0
-	count2_kd = 0
-	count3_kd = 0
-	count4_kd = 0
-	count5_kd = 0
-	count6_kd = 0
-	mark1 = 0  #train
-	mark2 = 0  #GPCR
-	mark3 = 0  #ER
-	mark4 = 0  #channel
-	mark5 = 0  #kinase
-	mark6 = 0  #test
-	random.seed(1234)
-	for folder in ['IC50', 'Ki', 'Kd', 'EC50']:
-		if not os.path.exists('./' + folder):
-			os.makedirs('./' + folder)
-		if not os.path.exists('./' + folder + '/baseline'):
-			os.makedirs('./' + folder + '/baseline')
-		if not os.path.exists('./' + folder + '/SPS'):
-			os.makedirs('./' + folder + '/SPS')
-	ic_o1 = open('./IC50/train','w+')
-	ic_o2 = open('./IC50/GPCR','w+')
-	ic_o3 = open('./IC50/ER','w+')
-	ic_o4 = open('./IC50/channel','w+')
-	ic_o5 = open('./IC50/kinase','w+')
-	ic_o6 = open('./IC50/test','w+')
-	ec_o1 = open('./EC50/train','w+')
-	ec_o2 = open('./EC50/GPCR','w+')
-	ec_o3 = open('./EC50/ER','w+')
-	ec_o4 = open('./EC50/channel','w+')
-	ec_o5 = open('./EC50/kinase','w+')
-	ec_o6 = open('./EC50/test','w+')
-	ki_o1 = open('./Ki/train','w+')
-	ki_o2 = open('./Ki/GPCR','w+')
-	ki_o3 = open('./Ki/ER','w+')
-	ki_o4 = open('./Ki/channel','w+')
-	ki_o5 = open('./Ki/kinase','w+')
-	ki_o6 = open('./Ki/test','w+')
-	kd_o1 = open('./Kd/train','w+')
-	kd_o2 = open('./Kd/GPCR','w+')
-	kd_o3 = open('./Kd/ER','w+')
-	kd_o4 = open('./Kd/channel','w+')
-	kd_o5 = open('./Kd/kinase','w+')
-	kd_o6 = open('./Kd/test','w+')
-
-	ic_o1_writer = csv.writer(ic_o1, dialect='excel-tab')
-	ic_o2_writer = csv.writer(ic_o2, dialect='excel-tab')
-	ic_o3_writer = csv.writer(ic_o3, dialect='excel-tab')
-	ic_o4_writer = csv.writer(ic_o4, dialect='excel-tab')
-	ic_o5_writer = csv.writer(ic_o5, dialect='excel-tab')
-	ic_o6_writer = csv.writer(ic_o6, dialect='excel-tab')
-	ec_o1_writer = csv.writer(ec_o1, dialect='excel-tab')
-	ec_o2_writer = csv.writer(ec_o2, dialect='excel-tab')
-	ec_o3_writer = csv.writer(ec_o3, dialect='excel-tab')
-	ec_o4_writer = csv.writer(ec_o4, dialect='excel-tab')
-	ec_o5_writer = csv.writer(ec_o5, dialect='excel-tab')
-	ec_o6_writer = csv.writer(ec_o6, dialect='excel-tab')
-	ki_o1_writer = csv.writer(ki_o1, dialect='excel-tab')
-	ki_o2_writer = csv.writer(ki_o2, dialect='excel-tab')
-	ki_o3_writer = csv.writer(ki_o3, dialect='excel-tab')
-	ki_o4_writer = csv.writer(ki_o4, dialect='excel-tab')
-	ki_o5_writer = csv.writer(ki_o5, dialect='excel-tab')
-	ki_o6_writer = csv.writer(ki_o6, dialect='excel-tab')
-	kd_o1_writer = csv.writer(kd_o1, dialect='excel-tab')
-	kd_o2_writer = csv.writer(kd_o2, dialect='excel-tab')
-	kd_o3_writer = csv.writer(kd_o3, dialect='excel-tab')
-	kd_o4_writer = csv.writer(kd_o4, dialect='excel-tab')
-	kd_o5_writer = csv.writer(kd_o5, dialect='excel-tab')
-	kd_o6_writer = csv.writer(kd_o6, dialect='excel-tab')
-
-	#IC50
-	bl_ic_w1_ic = open('./IC50/baseline/train_ic50', 'w+')
-	bl_ic_w2_ic = open('./IC50/baseline/GPCR_ic50', 'w+')
-	bl_ic_w3_ic = open('./IC50/baseline/ER_ic50', 'w+')
-	bl_ic_w4_ic = open('./IC50/baseline/channel_ic50', 'w+')
-	bl_ic_w5_ic = open('./IC50/baseline/kinase_ic50', 'w+')
-	bl_ic_w6_ic = open('./IC50/baseline/test_ic50', 'w+')
-	bl_ic_w1_com = open('./IC50/baseline/train_compound_fingerprint', 'w+')
-	bl_ic_w2_com = open('./IC50/baseline/GPCR_compound_fingerprint', 'w+')
-	bl_ic_w3_com = open('./IC50/baseline/ER_compound_fingerprint', 'w+')
-	bl_ic_w4_com = open('./IC50/baseline/channel_compound_fingerprint', 'w+')
-	bl_ic_w5_com = open('./IC50/baseline/kinase_compound_fingerprint', 'w+')
-	bl_ic_w6_com = open('./IC50/baseline/test_compound_fingerprint', 'w+')
-	# bl_ic_w1_pro = open('./IC50/baseline/train_protein_domain', 'w+')
-	# bl_ic_w2_pro = open('./IC50/baseline/GPCR_protein_domain', 'w+')
-	# bl_ic_w3_pro = open('./IC50/baseline/ER_protein_domain', 'w+')
-	# bl_ic_w4_pro = open('./IC50/baseline/channel_protein_domain', 'w+')
-	# bl_ic_w5_pro = open('./IC50/baseline/kinase_protein_domain', 'w+')
-	# bl_ic_w6_pro = open('./IC50/baseline/test_protein_domain', 'w+')
-	bl_ic_w1_seq = open('./IC50/baseline/train_protein_seq', 'w+')
-	bl_ic_w2_seq = open('./IC50/baseline/GPCR_protein_seq', 'w+')
-	bl_ic_w3_seq = open('./IC50/baseline/ER_protein_seq', 'w+')
-	bl_ic_w4_seq = open('./IC50/baseline/channel_protein_seq', 'w+')
-	bl_ic_w5_seq = open('./IC50/baseline/kinase_protein_seq', 'w+')
-	bl_ic_w6_seq = open('./IC50/baseline/test_protein_seq', 'w+')
-
-	sps_ic_w1_ic = open('./IC50/SPS/train_ic50', 'w+')
-	sps_ic_w2_ic = open('./IC50/SPS/GPCR_ic50', 'w+')
-	sps_ic_w3_ic = open('./IC50/SPS/ER_ic50', 'w+')
-	sps_ic_w4_ic = open('./IC50/SPS/channel_ic50', 'w+')
-	sps_ic_w5_ic = open('./IC50/SPS/kinase_ic50', 'w+')
-	sps_ic_w6_ic = open('./IC50/SPS/test_ic50', 'w+')
-	sps_ic_w1_smi = open('./IC50/SPS/train_smile', 'w+')
-	sps_ic_w2_smi = open('./IC50/SPS/GPCR_smile', 'w+')
-	sps_ic_w3_smi = open('./IC50/SPS/ER_smile', 'w+')
-	sps_ic_w4_smi = open('./IC50/SPS/channel_smile', 'w+')
-	sps_ic_w5_smi = open('./IC50/SPS/kinase_smile', 'w+')
-	sps_ic_w6_smi = open('./IC50/SPS/test_smile', 'w+')
-	# sps_ic_w1_sps = open('./IC50/SPS/train_sps', 'w+')
-	# sps_ic_w2_sps = open('./IC50/SPS/GPCR_sps', 'w+')
-	# sps_ic_w3_sps = open('./IC50/SPS/ER_sps', 'w+')
-	# sps_ic_w4_sps = open('./IC50/SPS/channel_sps', 'w+')
-	# sps_ic_w5_sps = open('./IC50/SPS/kinase_sps', 'w+')
-	# sps_ic_w6_sps = open('./IC50/SPS/test_sps', 'w+')
-
-	#EC50
-	bl_ec_w1_ec = open('./EC50/baseline/train_ec50', 'w+')
-	bl_ec_w2_ec = open('./EC50/baseline/GPCR_ec50', 'w+')
-	bl_ec_w3_ec = open('./EC50/baseline/ER_ec50', 'w+')
-	bl_ec_w4_ec = open('./EC50/baseline/channel_ec50', 'w+')
-	bl_ec_w5_ec = open('./EC50/baseline/kinase_ec50', 'w+')
-	bl_ec_w6_ec = open('./EC50/baseline/test_ec50', 'w+')
-	bl_ec_w1_com = open('./EC50/baseline/train_compound_fingerprint', 'w+')
-	bl_ec_w2_com = open('./EC50/baseline/GPCR_compound_fingerprint', 'w+')
-	bl_ec_w3_com = open('./EC50/baseline/ER_compound_fingerprint', 'w+')
-	bl_ec_w4_com = open('./EC50/baseline/channel_compound_fingerprint', 'w+')
-	bl_ec_w5_com = open('./EC50/baseline/kinase_compound_fingerprint', 'w+')
-	bl_ec_w6_com = open('./EC50/baseline/test_compound_fingerprint', 'w+')
-	# bl_ec_w1_pro = open('./EC50/baseline/train_protein_domain', 'w+')
-	# bl_ec_w2_pro = open('./EC50/baseline/GPCR_protein_domain', 'w+')
-	# bl_ec_w3_pro = open('./EC50/baseline/ER_protein_domain', 'w+')
-	# bl_ec_w4_pro = open('./EC50/baseline/channel_protein_domain', 'w+')
-	# bl_ec_w5_pro = open('./EC50/baseline/kinase_protein_domain', 'w+')
-	# bl_ec_w6_pro = open('./EC50/baseline/test_protein_domain', 'w+')
-	bl_ec_w1_seq = open('./EC50/baseline/train_protein_seq', 'w+')
-	bl_ec_w2_seq = open('./EC50/baseline/GPCR_protein_seq', 'w+')
-	bl_ec_w3_seq = open('./EC50/baseline/ER_protein_seq', 'w+')
-	bl_ec_w4_seq = open('./EC50/baseline/channel_protein_seq', 'w+')
-	bl_ec_w5_seq = open('./EC50/baseline/kinase_protein_seq', 'w+')
-	bl_ec_w6_seq = open('./EC50/baseline/test_protein_seq', 'w+')
-
-	sps_ec_w1_ec = open('./EC50/SPS/train_ec50', 'w+')
-	sps_ec_w2_ec = open('./EC50/SPS/GPCR_ec50', 'w+')
-	sps_ec_w3_ec = open('./EC50/SPS/ER_ec50', 'w+')
-	sps_ec_w4_ec = open('./EC50/SPS/channel_ec50', 'w+')
-	sps_ec_w5_ec = open('./EC50/SPS/kinase_ec50', 'w+')
-	sps_ec_w6_ec = open('./EC50/SPS/test_ec50', 'w+')
-	sps_ec_w1_smi = open('./EC50/SPS/train_smile', 'w+')
-	sps_ec_w2_smi = open('./EC50/SPS/GPCR_smile', 'w+')
-	sps_ec_w3_smi = open('./EC50/SPS/ER_smile', 'w+')
-	sps_ec_w4_smi = open('./EC50/SPS/channel_smile', 'w+')
-	sps_ec_w5_smi = open('./EC50/SPS/kinase_smile', 'w+')
-	sps_ec_w6_smi = open('./EC50/SPS/test_smile', 'w+')
-	# sps_ec_w1_sps = open('./EC50/SPS/train_sps', 'w+')
-	# sps_ec_w2_sps = open('./EC50/SPS/GPCR_sps', 'w+')
-	# sps_ec_w3_sps = open('./EC50/SPS/ER_sps', 'w+')
-	# sps_ec_w4_sps = open('./EC50/SPS/channel_sps', 'w+')
-	# sps_ec_w5_sps = open('./EC50/SPS/kinase_sps', 'w+')
-	# sps_ec_w6_sps = open('./EC50/SPS/test_sps', 'w+')
-
-	#Ki
-	bl_ki_w1_ki = open('./Ki/baseline/train_ki', 'w+')
-	bl_ki_w2_ki = open('./Ki/baseline/GPCR_ki', 'w+')
-	bl_ki_w3_ki = open('./Ki/baseline/ER_ki', 'w+')
-	bl_ki_w4_ki = open('./Ki/baseline/channel_ki', 'w+')
-	bl_ki_w5_ki = open('./Ki/baseline/kinase_ki', 'w+')
-	bl_ki_w6_ki = open('./Ki/baseline/test_ki', 'w+')
-	bl_ki_w1_com = open('./Ki/baseline/train_compound_fingerprint', 'w+')
-	bl_ki_w2_com = open('./Ki/baseline/GPCR_compound_fingerprint', 'w+')
-	bl_ki_w3_com = open('./Ki/baseline/ER_compound_fingerprint', 'w+')
-	bl_ki_w4_com = open('./Ki/baseline/channel_compound_fingerprint', 'w+')
-	bl_ki_w5_com = open('./Ki/baseline/kinase_compound_fingerprint', 'w+')
-	bl_ki_w6_com = open('./Ki/baseline/test_compound_fingerprint', 'w+')
-	# bl_ki_w1_pro = open('./Ki/baseline/train_protein_domain', 'w+')
-	# bl_ki_w2_pro = open('./Ki/baseline/GPCR_protein_domain', 'w+')
-	# bl_ki_w3_pro = open('./Ki/baseline/ER_protein_domain', 'w+')
-	# bl_ki_w4_pro = open('./Ki/baseline/channel_protein_domain', 'w+')
-	# bl_ki_w5_pro = open('./Ki/baseline/kinase_protein_domain', 'w+')
-	# bl_ki_w6_pro = open('./Ki/baseline/test_protein_domain', 'w+')
-	bl_ki_w1_seq = open('./Ki/baseline/train_protein_seq', 'w+')
-	bl_ki_w2_seq = open('./Ki/baseline/GPCR_protein_seq', 'w+')
-	bl_ki_w3_seq = open('./Ki/baseline/ER_protein_seq', 'w+')
-	bl_ki_w4_seq = open('./Ki/baseline/channel_protein_seq', 'w+')
-	bl_ki_w5_seq = open('./Ki/baseline/kinase_protein_seq', 'w+')
-	bl_ki_w6_seq = open('./Ki/baseline/test_protein_seq', 'w+')
-
-	sps_ki_w1_ki = open('./Ki/SPS/train_ki', 'w+')
-	sps_ki_w2_ki = open('./Ki/SPS/GPCR_ki', 'w+')
-	sps_ki_w3_ki = open('./Ki/SPS/ER_ki', 'w+')
-	sps_ki_w4_ki = open('./Ki/SPS/channel_ki', 'w+')
-	sps_ki_w5_ki = open('./Ki/SPS/kinase_ki', 'w+')
-	sps_ki_w6_ki = open('./Ki/SPS/test_ki', 'w+')
-	sps_ki_w1_smi = open('./Ki/SPS/train_smile', 'w+')
-	sps_ki_w2_smi = open('./Ki/SPS/GPCR_smile', 'w+')
-	sps_ki_w3_smi = open('./Ki/SPS/ER_smile', 'w+')
-	sps_ki_w4_smi = open('./Ki/SPS/channel_smile', 'w+')
-	sps_ki_w5_smi = open('./Ki/SPS/kinase_smile', 'w+')
-	sps_ki_w6_smi = open('./Ki/SPS/test_smile', 'w+')
-	# sps_ki_w1_sps = open('./Ki/SPS/train_sps', 'w+')
-	# sps_ki_w2_sps = open('./Ki/SPS/GPCR_sps', 'w+')
-	# sps_ki_w3_sps = open('./Ki/SPS/ER_sps', 'w+')
-	# sps_ki_w4_sps = open('./Ki/SPS/channel_sps', 'w+')
-	# sps_ki_w5_sps = open('./Ki/SPS/kinase_sps', 'w+')
-	# sps_ki_w6_sps = open('./Ki/SPS/test_sps', 'w+')
-
-	# Kd
-	bl_kd_w1_kd = open('./Kd/baseline/train_kd', 'w+')
-	bl_kd_w2_kd = open('./Kd/baseline/GPCR_kd', 'w+')
-	bl_kd_w3_kd = open('./Kd/baseline/ER_kd', 'w+')
-	bl_kd_w4_kd = open('./Kd/baseline/channel_kd', 'w+')
-	bl_kd_w5_kd = open('./Kd/baseline/kinase_kd', 'w+')
-	bl_kd_w6_kd = open('./Kd/baseline/test_kd', 'w+')
-	bl_kd_w1_com = open('./Kd/baseline/train_compound_fingerprint', 'w+')
-	bl_kd_w2_com = open('./Kd/baseline/GPCR_compound_fingerprint', 'w+')
-	bl_kd_w3_com = open('./Kd/baseline/ER_compound_fingerprint', 'w+')
-	bl_kd_w4_com = open('./Kd/baseline/channel_compound_fingerprint', 'w+')
-	bl_kd_w5_com = open('./Kd/baseline/kinase_compound_fingerprint', 'w+')
-	bl_kd_w6_com = open('./Kd/baseline/test_compound_fingerprint', 'w+')
-	# bl_kd_w1_pro = open('./Kd/baseline/train_protein_domain', 'w+')
-	# bl_kd_w2_pro = open('./Kd/baseline/GPCR_protein_domain', 'w+')
-	# bl_kd_w3_pro = open('./Kd/baseline/ER_protein_domain', 'w+')
-	# bl_kd_w4_pro = open('./Kd/baseline/channel_protein_domain', 'w+')
-	# bl_kd_w5_pro = open('./Kd/baseline/kinase_protein_domain', 'w+')
-	# bl_kd_w6_pro = open('./Kd/baseline/test_protein_domain', 'w+')
-	bl_kd_w1_seq = open('./Kd/baseline/train_protein_seq', 'w+')
-	bl_kd_w2_seq = open('./Kd/baseline/GPCR_protein_seq', 'w+')
-	bl_kd_w3_seq = open('./Kd/baseline/ER_protein_seq', 'w+')
-	bl_kd_w4_seq = open('./Kd/baseline/channel_protein_seq', 'w+')
-	bl_kd_w5_seq = open('./Kd/baseline/kinase_protein_seq', 'w+')
-	bl_kd_w6_seq = open('./Kd/baseline/test_protein_seq', 'w+')
-
-	sps_kd_w1_kd = open('./Kd/SPS/train_kd', 'w+')
-	sps_kd_w2_kd = open('./Kd/SPS/GPCR_kd', 'w+')
-	sps_kd_w3_kd = open('./Kd/SPS/ER_kd', 'w+')
-	sps_kd_w4_kd = open('./Kd/SPS/channel_kd', 'w+')
-	sps_kd_w5_kd = open('./Kd/SPS/kinase_kd', 'w+')
-	sps_kd_w6_kd = open('./Kd/SPS/test_kd', 'w+')
-	sps_kd_w1_smi = open('./Kd/SPS/train_smile', 'w+')
-	sps_kd_w2_smi = open('./Kd/SPS/GPCR_smile', 'w+')
-	sps_kd_w3_smi = open('./Kd/SPS/ER_smile', 'w+')
-	sps_kd_w4_smi = open('./Kd/SPS/channel_smile', 'w+')
-	sps_kd_w5_smi = open('./Kd/SPS/kinase_smile', 'w+')
-	sps_kd_w6_smi = open('./Kd/SPS/test_smile', 'w+')
-	# sps_kd_w1_sps = open('./Kd/SPS/train_sps', 'w+')
-	# sps_kd_w2_sps = open('./Kd/SPS/GPCR_sps', 'w+')
-	# sps_kd_w3_sps = open('./Kd/SPS/ER_sps', 'w+')
-	# sps_kd_w4_sps = open('./Kd/SPS/channel_sps', 'w+')
-	# sps_kd_w5_sps = open('./Kd/SPS/kinase_sps', 'w+')
-	# sps_kd_w6_sps = open('./Kd/SPS/test_sps', 'w+')
-
-
-	#Loading dictionary
-	# seq_sps = {}
-	# seq_dom = {}
-	cid_fea = {}
-	# uid_class = {}
-
-	# groupedDir = 'protein_grouped_finalPresentation' # protein_grouped directory
-	# proteinDom = 'Seq_Vector'                        # protein_feature directory
-	compoundFea = 'CID_Smi_Feature'                  # compound_Feature directory
-	# uidClass = 'uniID_class'                         # UniprotID_Class directory
-
-
-	# with open(uidClass) as f:
-	# 	mark = 0
-	# 	for line in f:
-	# 		if mark == 0:
-	# 			uid = line.strip()
-	# 			mark = 1
-	# 		else:
-	# 			uinClass = line.strip()
-	# 			mark = 0
-	# 			uid_class[uid] = uinClass
-
-	# with open(groupedDir) as f:
-	# 	mark = 0
-	# 	for line in f:
-	# 		if mark == 0:
-	# 			protein = line.strip()
-	# 			mark = 1
-	# 		else:
-	# 			sps = line.strip()
-	# 			mark = 0
-	# 			seq_sps[protein] = sps
-
-	# with open(proteinDom) as f:
-	# 	mark = 0
-	# 	for line in f:
-	# 		if mark == 0:
-	# 			protein = line.strip()
-	# 			mark = 1
-	# 		else:
-	# 			dom = line.strip()
-	# 			mark = 0
-	# 			seq_dom[protein] = dom
 
+import columnar
+import streaming
+from pubchem.fingerprints import FP_BITS, FingerprintStore, pack, unpack_strings
+
+# (name, column in BindingDB_All.tsv, output folder, label file suffix), in the order of the statistics
+MEASURES = [
+	('IC50', 9, 'IC50', 'ic50'),
+	('EC50', 11, 'EC50', 'ec50'),
+	('Ki', 8, 'Ki', 'ki'),
+	('Kd', 10, 'Kd', 'kd'),
+]
+CLASSES = ['train', 'GPCR', 'ER', 'channel', 'kinase', 'test']
+# files written for every measurement and class: (path template, content)
+OUTPUTS = [
+	('./{folder}/{cls}', 'row'),
+	('./{folder}/baseline/{cls}_{suffix}', 'label'),
+	('./{folder}/baseline/{cls}_compound_fingerprint', 'feature'),
+	('./{folder}/baseline/{cls}_protein_seq', 'seq'),
+	('./{folder}/SPS/{cls}_{suffix}', 'label'),
+	('./{folder}/SPS/{cls}_smile', 'smi'),
+]
+SMI_COL, CID_COL, SEQ_COL, UID_COL = 1, 28, 37, 41
+# columns read by the split besides the CID
+FIELD_COLS = [SMI_COL, SEQ_COL, UID_COL] + [measure[1] for measure in MEASURES]
+INEQUALITY = re.compile(r'[><=]+')
+# status of a converted measurement
+KEPT, MISSING, DROPPED = 0, 1, 2
+BUFFER_SIZE = 1 << 20
+
+# compound features as a FingerprintStore (sorted CIDs, packed fingerprints), inherited by the forked workers
+compound_store = None
+# input of --columnar, opened once per worker
+columnar_fn = None
+columnar_reader = None
+
+
+def load_features(compoundFea):
+	cids = []
+	features = []
 	with open(compoundFea) as f:
 		for line in f:
 			line = line.strip()
@@ -350,690 +54,247 @@ def main(dataDir):
 				cid = next(f).strip()
 			elif line == '> <PUBCHEM_CACTVS_SUBSKEYS>':
 				fea = next(f).strip()
+				assert len(fea) == FP_BITS, 'fingerprint of CID %s has %d bits' % (cid, len(fea))
 			elif line == '$$$$':
-				cid_fea[cid] = fea
-	print('Dictionary loaded')
-
-	with open(dataDir) as f, open('noUniprotID.tsv','w+') as tsvout:
-		noUniprotID = csv.writer(tsvout, dialect='excel-tab')
-		reader = csv.reader(f, delimiter="\t",quoting=csv.QUOTE_NONE)
-		header = next(reader)
-		header[8] = "pKi_[M]"
-		header[9] = "pIC50_[M]"
-		header[10] = "pKd_[M]"
-		header[11] = "pEC50_[M]"
-		noUniprotID.writerow(header)
-		ic_o1_writer.writerow(header)
-		ic_o2_writer.writerow(header)
-		ic_o3_writer.writerow(header)
-		ic_o4_writer.writerow(header)
-		ic_o5_writer.writerow(header)
-		ic_o6_writer.writerow(header)
-		ec_o1_writer.writerow(header)
-		ec_o2_writer.writerow(header)
-		ec_o3_writer.writerow(header)
-		ec_o4_writer.writerow(header)
-		ec_o5_writer.writerow(header)
-		ec_o6_writer.writerow(header)
-		ki_o1_writer.writerow(header)
-		ki_o2_writer.writerow(header)
-		ki_o3_writer.writerow(header)
-		ki_o4_writer.writerow(header)
-		ki_o5_writer.writerow(header)
-		ki_o6_writer.writerow(header)
-		kd_o1_writer.writerow(header)
-		kd_o2_writer.writerow(header)
-		kd_o3_writer.writerow(header)
-		kd_o4_writer.writerow(header)
-		kd_o5_writer.writerow(header)
-		kd_o6_writer.writerow(header)
-		for row in reader:
-			smi = row[1]
-			bd_name = row[6]
-			uni_name = row[39]
-			ki = row[8]
-			ic = row[9]
-			kd = row[10]
-			ec = row[11]
-			cid = str(int(float(row[28])))
-			seq = row[37]
-			uid = row[41]
-			# if seq not in seq_dom:
-			# 	print(row)
-			# domain = pos2vec(seq_dom[seq])
-			#domain = seq_dom[seq]
-			feature = cid_fea[cid]
-			# sps = seq_sps[seq]
-
-	#filter IC50, Ki, Kd with corresponding lower and upper bound threshold and convert nM to µM
-			if ic.strip() == '':
-				dropic = 1
-				noicC += 1
-			elif '<' in ic:
-				value = float(re.sub(r'[><=]+', '', ic))
-				if value > 0.01:
-					dropic = 1
-					dropicC += 1
-				else:
-					ic = str(11)
-			elif '>' in ic:
-				value = float(re.sub(r'[><=]+', '', ic))
-				if value < 1E7:
-					dropic = 1
-					dropicC += 1
-				else:
-					ic = str(2)
-			else:
-				if float(ic) < 0.01:
-					ic = str(11)
-				elif float(ic) > 1E7:
-					ic = str(2)
-				else:
-					ic = str(-np.log10(float(ic))+9)
-
-
-			if ec.strip() == '':
-				dropec = 1
-				noecC += 1
-			elif '<' in ec:
-				value = float(re.sub(r'[><=]+', '', ec))
-				if value > 0.01:
-					dropec = 1
-					dropecC += 1
+				cids.append(int(cid))
+				features.append(pack(np.frombuffer(fea.encode('ascii'), dtype=np.uint8) - ord('0')))
+	return FingerprintStore.build(cids, features)
+
+
+def lookup_features(cids):
+	return unpack_strings(compound_store.lookup(cids))
+
+
+def to_p_scale(raw):
+	"""Convert nM measurements to the p-scale: -log10(M), clipped to [2, 11].
+
+	Inequalities are kept only when they fall outside of the clipping range
+	(`<` at most 0.01 nM, `>` at least 1E7 nM). Returns the labels as strings
+	and the status of every measurement; dropped and missing measurements keep
+	their raw string.
+	"""
+	raw = np.asarray(raw, dtype=object)
+	labels = raw.copy()
+	status = np.full(len(raw), KEPT, dtype=np.int8)
+	missing = np.array([not x.strip() for x in raw], dtype=bool)
+	less = np.array(['<' in x for x in raw], dtype=bool) & ~missing
+	greater = np.array(['>' in x for x in raw], dtype=bool) & ~missing & ~less
+	exact = ~(missing | less | greater)
+	status[missing] = MISSING
+
+	value = np.full(len(raw), np.nan)
+	bound = less | greater
+	value[bound] = [float(INEQUALITY.sub('', x)) for x in raw[bound]]
+	value[exact] = [float(x) for x in raw[exact]]
+	status[less & (value > 0.01)] = DROPPED
+	status[greater & (value < 1E7)] = DROPPED
+
+	high = (less & (status == KEPT)) | (exact & (value < 0.01))
+	low = (greater & (status == KEPT)) | (exact & (value > 1E7))
+	labels[high] = str(11)
+	labels[low] = str(2)
+	scaled = exact & ~high & ~low
+	labels[scaled] = [str(x) for x in (-np.log10(value[scaled]) + 9).tolist()]
+	return labels, status
+
+
+def assign_class(uids):
+	"""Index into CLASSES of every row, -1 for rows without a UniProt ID.
+
+	The GPCR/ER/channel/kinase split is disabled: every row with a UniProt ID
+	goes to the test set and the other classes only get a header.
+	"""
+	return np.where([uid.strip() != '' for uid in uids], CLASSES.index('test'), -1)
+
+
+def split_chunk(lines):
+	"""Split a block of input lines, see `split_rows`."""
+	chunk = list(csv.reader(lines, delimiter="\t", quoting=csv.QUOTE_NONE))
+
+	def format_rows(labels, rows):
+		texts = []
+		for i in rows:
+			row = chunk[i]
+			for col, values in labels.items():
+				row[col] = values[i]
+			texts.append(columnar.format_row(row))
+		return texts
+
+	fields = {col: [row[col] for row in chunk] for col in FIELD_COLS}
+	return split_rows(fields, [int(float(row[CID_COL])) for row in chunk], format_rows)
+
+
+def split_row_group(i):
+	"""Split a row group of the columnar input, see `split_rows`.
+
+	Only the columns used by the split become Python objects, whole rows are
+	formatted by Arrow.
+	"""
+	global columnar_reader
+	if columnar_reader is None:
+		columnar_reader = columnar.ColumnarReader(columnar_fn)
+	table = columnar_reader.read_row_group(i, columnar_reader.names)
+	if table[columnar.CID].null_count:
+		raise ValueError('invalid CID in row group %d of %s' % (i, columnar_fn))
+
+	def format_rows(labels, index):
+		rows = table.take(index)
+		for col, values in labels.items():
+			rows = columnar.replace_column(rows, col, values[index].tolist())
+		return columnar.format_rows(rows, columnar_reader.width)
+
+	fields = {col: table[columnar.col(col)].to_pylist() for col in FIELD_COLS}
+	return split_rows(fields, table[columnar.CID].to_numpy(), format_rows)
+
+
+def split_rows(fields, cids, format_rows):
+	"""Split a block of rows.
+
+	`fields` holds the columns used by the split and `format_rows(labels, rows)`
+	returns the output lines of the given rows with their measurements
+	replaced by `labels`. Returns the text to append to every output file,
+	keyed by (measure, class, output) or 'noUniprotID', and the statistics of
+	the block as an array of per-class counts followed by missing and dropped
+	counts for every measurement.
+	"""
+	features = lookup_features(cids)
+	labels = {}
+	statuses = []
+	for name, col, folder, suffix in MEASURES:
+		labels[col], status = to_p_scale(fields[col])
+		statuses.append(status)
+	classes = assign_class(fields[UID_COL])
+	# every row is formatted once, even when it goes to the files of several measurements
+	kept = np.any([status == KEPT for status in statuses], axis=0) & (classes >= 0)
+	needed = np.flatnonzero(kept | (classes < 0))
+	row_texts = [None] * len(classes)
+	for i, text in zip(needed, format_rows(labels, needed)):
+		row_texts[i] = text
+	stats = np.zeros((len(MEASURES), len(CLASSES) + 2), dtype=np.int64)
+	texts = {'noUniprotID': ''.join([text for text, c in zip(row_texts, classes) if c < 0])}
+	for m, (name, col, folder, suffix) in enumerate(MEASURES):
+		status = statuses[m]
+		stats[m, -2] = (status == MISSING).sum()
+		stats[m, -1] = (status == DROPPED).sum()
+		for c in range(len(CLASSES)):
+			rows = np.flatnonzero((classes == c) & (status == KEPT))
+			stats[m, c] = len(rows)
+			if len(rows) == 0:
+				continue
+			columns = {
+				'row': [row_texts[i] for i in rows],
+				'label': labels[col][rows].tolist(),
+				'feature': [features[i] for i in rows],
+				'seq': [fields[SEQ_COL][i] for i in rows],
+				'smi': [fields[SMI_COL][i] for i in rows],
+			}
+			for k, (template, content) in enumerate(OUTPUTS):
+				if content == 'row':
+					texts[m, c, k] = ''.join(columns['row'])
 				else:
-					ec = str(11)
-			elif '>' in ec:
-				value = float(re.sub(r'[><=]+', '', ec))
-				if value < 1E7:
-					dropec = 1
-					dropecC += 1
-				else:
-					ec = str(2)
-			else:
-				if float(ec) < 0.01:
-					ec = str(11)
-				elif float(ec) > 1E7:
-					ec = str(2)
-				else:
-					ec = str(-np.log10(float(ec))+9)
-
-			if ki.strip() == '':
-				dropki = 1
-				nokiC += 1
-			elif '<' in ki:
-				value = float(re.sub(r'[><=]+', '', ki))
-				if value > 0.01:
-					dropki = 1
-					dropkiC += 1
-				else:
-					ki = str(11)
-			elif '>' in ki:
-				value = float(re.sub(r'[><=]+', '', ki))
-				if value < 1E7:
-					dropki = 1
-					dropkiC += 1
-				else:
-					ki = str(2)
-			else:
-				if float(ki) < 0.01:
-					ki = str(11)
-				elif float(ki) > 1E7:
-					ki = str(2)
-				else:
-					ki = str(-np.log10(float(ki))+9)
-
-			if kd.strip() == '':
-				dropkd = 1
-				nokdC += 1
-			elif '<' in kd:
-				value = float(re.sub(r'[><=]+', '', kd))
-				if value > 0.01:
-					dropkd = 1
-					dropkdC += 1
-				else:
-					kd = str(11)
-			elif '>' in kd:
-				value = float(re.sub(r'[><=]+', '', kd))
-				if value < 1E7:
-					dropkd = 1
-					dropkdC += 1
-				else:
-					kd = str(2)
-			else:
-				if float(kd) < 0.01:
-					kd = str(11)
-				elif float(kd) > 1E7:
-					kd = str(2)
-				else:
-					kd = str(-np.log10(float(kd))+9)
-
-		#split data by class
-			if uid.strip() == '':
-				nouid = 1
-			else:
-				randomNum = random.randint(1,100)
-				if randomNum <= 30:
-					mark6 = 1
-				else:
-					mark6 = 1
-                # As test set
-			row[8] = ki
-			row[9] = ic
-			row[10] = kd
-			row[11] = ec
-		#output to files
-			if mark1 == 1:
-				if dropic == 0:
-					ic_o1_writer.writerow(row)
-					bl_ic_w1_ic.write(ic+'\n')
-					bl_ic_w1_com.write(feature+'\n')
-					# bl_ic_w1_pro.write(domain+'\n')
-					bl_ic_w1_seq.write(seq+'\n')
-					sps_ic_w1_ic.write(ic+'\n')
-					sps_ic_w1_smi.write(smi+'\n')
-					# sps_ic_w1_sps.write(sps+'\n')
-					countic += 1
-					count1_ic += 1
-				if dropec == 0:
-					ec_o1_writer.writerow(row)
-					bl_ec_w1_ec.write(ec+'\n')
-					bl_ec_w1_com.write(feature+'\n')
-					# bl_ec_w1_pro.write(domain+'\n')
-					bl_ec_w1_seq.write(seq+'\n')
-					sps_ec_w1_ec.write(ec+'\n')
-					sps_ec_w1_smi.write(smi+'\n')
-					# sps_ec_w1_sps.write(sps+'\n')
-					countec += 1
-					count1_ec += 1
-				if dropki == 0:
-					ki_o1_writer.writerow(row)
-					bl_ki_w1_ki.write(ki+'\n')
-					bl_ki_w1_com.write(feature+'\n')
-					# bl_ki_w1_pro.write(domain+'\n')
-					bl_ki_w1_seq.write(seq+'\n')
-					sps_ki_w1_ki.write(ki+'\n')
-					sps_ki_w1_smi.write(smi+'\n')
-					# sps_ki_w1_sps.write(sps+'\n')
-					countki += 1
-					count1_ki += 1
-				if dropkd == 0:
-					kd_o1_writer.writerow(row)
-					bl_kd_w1_kd.write(kd+'\n')
-					bl_kd_w1_com.write(feature+'\n')
-					# bl_kd_w1_pro.write(domain+'\n')
-					bl_kd_w1_seq.write(seq+'\n')
-					sps_kd_w1_kd.write(kd+'\n')
-					sps_kd_w1_smi.write(smi+'\n')
-					# sps_kd_w1_sps.write(sps+'\n')
-					countkd += 1
-					count1_kd += 1
-			if mark2 == 1:
-				if dropic == 0:
-					ic_o2_writer.writerow(row)
-					bl_ic_w2_ic.write(ic+'\n')
-					bl_ic_w2_com.write(feature+'\n')
-					# bl_ic_w2_pro.write(domain+'\n')
-					bl_ic_w2_seq.write(seq+'\n')
-					sps_ic_w2_ic.write(ic+'\n')
-					sps_ic_w2_smi.write(smi+'\n')
-					# sps_ic_w2_sps.write(sps+'\n')
-					countic += 1
-					count2_ic += 1
-				if dropec == 0:
-					ec_o2_writer.writerow(row)
-					bl_ec_w2_ec.write(ec+'\n')
-					bl_ec_w2_com.write(feature+'\n')
-					# bl_ec_w2_pro.write(domain+'\n')
-					bl_ec_w2_seq.write(seq+'\n')
-					sps_ec_w2_ec.write(ec+'\n')
-					sps_ec_w2_smi.write(smi+'\n')
-					# sps_ec_w2_sps.write(sps+'\n')
-					countec += 1
-					count2_ec += 1
-				if dropki == 0:
-					ki_o2_writer.writerow(row)
-					bl_ki_w2_ki.write(ki+'\n')
-					bl_ki_w2_com.write(feature+'\n')
-					# bl_ki_w2_pro.write(domain+'\n')
-					bl_ki_w2_seq.write(seq+'\n')
-					sps_ki_w2_ki.write(ki+'\n')
-					sps_ki_w2_smi.write(smi+'\n')
-					# sps_ki_w2_sps.write(sps+'\n')
-					countki += 1
-					count2_ki += 1
-				if dropkd == 0:
-					kd_o2_writer.writerow(row)
-					bl_kd_w2_kd.write(kd+'\n')
-					bl_kd_w2_com.write(feature+'\n')
-					# bl_kd_w2_pro.write(domain+'\n')
-					bl_kd_w2_seq.write(seq+'\n')
-					sps_kd_w2_kd.write(kd+'\n')
-					sps_kd_w2_smi.write(smi+'\n')
-					# sps_kd_w2_sps.write(sps+'\n')
-					countkd += 1
-					count2_kd += 1
-			if mark3 == 1:
-				if dropic == 0:
-					ic_o3_writer.writerow(row)
-					bl_ic_w3_ic.write(ic+'\n')
-					bl_ic_w3_com.write(feature+'\n')
-					# bl_ic_w3_pro.write(domain+'\n')
-					bl_ic_w3_seq.write(seq+'\n')
-					sps_ic_w3_ic.write(ic+'\n')
-					sps_ic_w3_smi.write(smi+'\n')
-					# sps_ic_w3_sps.write(sps+'\n')
-					countic += 1
-					count3_ic += 1
-				if dropec == 0:
-					ec_o3_writer.writerow(row)
-					bl_ec_w3_ec.write(ec+'\n')
-					bl_ec_w3_com.write(feature+'\n')
-					# bl_ec_w3_pro.write(domain+'\n')
-					bl_ec_w3_seq.write(seq+'\n')
-					sps_ec_w3_ec.write(ec+'\n')
-					sps_ec_w3_smi.write(smi+'\n')
-					# sps_ec_w3_sps.write(sps+'\n')
-					countec += 1
-					count3_ec += 1
-				if dropki == 0:
-					ki_o3_writer.writerow(row)
-					bl_ki_w3_ki.write(ki+'\n')
-					bl_ki_w3_com.write(feature+'\n')
-					# bl_ki_w3_pro.write(domain+'\n')
-					bl_ki_w3_seq.write(seq+'\n')
-					sps_ki_w3_ki.write(ki+'\n')
-					sps_ki_w3_smi.write(smi+'\n')
-					# sps_ki_w3_sps.write(sps+'\n')
-					countki += 1
-					count3_ki += 1
-				if dropkd == 0:
-					kd_o3_writer.writerow(row)
-					bl_kd_w3_kd.write(kd+'\n')
-					bl_kd_w3_com.write(feature+'\n')
-					# bl_kd_w3_pro.write(domain+'\n')
-					bl_kd_w3_seq.write(seq+'\n')
-					sps_kd_w3_kd.write(kd+'\n')
-					sps_kd_w3_smi.write(smi+'\n')
-					# sps_kd_w3_sps.write(sps+'\n')
-					countkd += 1
-					count3_kd += 1
-			if mark4 == 1:
-				if dropic == 0:
-					ic_o4_writer.writerow(row)
-					bl_ic_w4_ic.write(ic+'\n')
-					bl_ic_w4_com.write(feature+'\n')
-					# bl_ic_w4_pro.write(domain+'\n')
-					bl_ic_w4_seq.write(seq+'\n')
-					sps_ic_w4_ic.write(ic+'\n')
-					sps_ic_w4_smi.write(smi+'\n')
-					# sps_ic_w4_sps.write(sps+'\n')
-					countic += 1
-					count4_ic += 1
-				if dropec == 0:
-					ec_o4_writer.writerow(row)
-					bl_ec_w4_ec.write(ec+'\n')
-					bl_ec_w4_com.write(feature+'\n')
-					# bl_ec_w4_pro.write(domain+'\n')
-					bl_ec_w4_seq.write(seq+'\n')
-					sps_ec_w4_ec.write(ec+'\n')
-					sps_ec_w4_smi.write(smi+'\n')
-					# sps_ec_w4_sps.write(sps+'\n')
-					countec += 1
-					count4_ec += 1
-				if dropki == 0:
-					ki_o4_writer.writerow(row)
-					bl_ki_w4_ki.write(ki+'\n')
-					bl_ki_w4_com.write(feature+'\n')
-					# bl_ki_w4_pro.write(domain+'\n')
-					bl_ki_w4_seq.write(seq+'\n')
-					sps_ki_w4_ki.write(ki+'\n')
-					sps_ki_w4_smi.write(smi+'\n')
-					# sps_ki_w4_sps.write(sps+'\n')
-					countki += 1
-					count4_ki += 1
-				if dropkd == 0:
-					kd_o4_writer.writerow(row)
-					bl_kd_w4_kd.write(kd+'\n')
-					bl_kd_w4_com.write(feature+'\n')
-					# bl_kd_w4_pro.write(domain+'\n')
-					bl_kd_w4_seq.write(seq+'\n')
-					sps_kd_w4_kd.write(kd+'\n')
-					sps_kd_w4_smi.write(smi+'\n')
-					# sps_kd_w4_sps.write(sps+'\n')
-					countkd += 1
-					count4_kd += 1
-			if mark5 == 1:
-				if dropic == 0:
-					ic_o5_writer.writerow(row)
-					bl_ic_w5_ic.write(ic+'\n')
-					bl_ic_w5_com.write(feature+'\n')
-					# bl_ic_w5_pro.write(domain+'\n')
-					bl_ic_w5_seq.write(seq+'\n')
-					sps_ic_w5_ic.write(ic+'\n')
-					sps_ic_w5_smi.write(smi+'\n')
-					# sps_ic_w5_sps.write(sps+'\n')
-					countic += 1
-					count5_ic += 1
-				if dropec == 0:
-					ec_o5_writer.writerow(row)
-					bl_ec_w5_ec.write(ec+'\n')
-					bl_ec_w5_com.write(feature+'\n')
-					# bl_ec_w5_pro.write(domain+'\n')
-					bl_ec_w5_seq.write(seq+'\n')
-					sps_ec_w5_ec.write(ec+'\n')
-					sps_ec_w5_smi.write(smi+'\n')
-					# sps_ec_w5_sps.write(sps+'\n')
-					countec += 1
-					count5_ec += 1
-				if dropki == 0:
-					ki_o5_writer.writerow(row)
-					bl_ki_w5_ki.write(ki+'\n')
-					bl_ki_w5_com.write(feature+'\n')
-					# bl_ki_w5_pro.write(domain+'\n')
-					bl_ki_w5_seq.write(seq+'\n')
-					sps_ki_w5_ki.write(ki+'\n')
-					sps_ki_w5_smi.write(smi+'\n')
-					# sps_ki_w5_sps.write(sps+'\n')
-					countki += 1
-					count5_ki += 1
-				if dropkd == 0:
-					kd_o5_writer.writerow(row)
-					bl_kd_w5_kd.write(kd+'\n')
-					bl_kd_w5_com.write(feature+'\n')
-					# bl_kd_w5_pro.write(domain+'\n')
-					bl_kd_w5_seq.write(seq+'\n')
-					sps_kd_w5_kd.write(kd+'\n')
-					sps_kd_w5_smi.write(smi+'\n')
-					# sps_kd_w5_sps.write(sps+'\n')
-					countkd += 1
-					count5_kd += 1
-			if mark6 == 1:
-				if dropic == 0:
-					ic_o6_writer.writerow(row)
-					bl_ic_w6_ic.write(ic+'\n')
-					bl_ic_w6_com.write(feature+'\n')
-					# bl_ic_w6_pro.write(domain+'\n')
-					bl_ic_w6_seq.write(seq+'\n')
-					sps_ic_w6_ic.write(ic+'\n')
-					sps_ic_w6_smi.write(smi+'\n')
-					# sps_ic_w6_sps.write(sps+'\n')
-					countic += 1
-					count6_ic += 1
-				if dropec == 0:
-					ec_o6_writer.writerow(row)
-					bl_ec_w6_ec.write(ec+'\n')
-					bl_ec_w6_com.write(feature+'\n')
-					# bl_ec_w6_pro.write(domain+'\n')
-					bl_ec_w6_seq.write(seq+'\n')
-					sps_ec_w6_ec.write(ec+'\n')
-					sps_ec_w6_smi.write(smi+'\n')
-					# sps_ec_w6_sps.write(sps+'\n')
-					countec += 1
-					count6_ec += 1
-				if dropki == 0:
-					ki_o6_writer.writerow(row)
-					bl_ki_w6_ki.write(ki+'\n')
-					bl_ki_w6_com.write(feature+'\n')
-					# bl_ki_w6_pro.write(domain+'\n')
-					bl_ki_w6_seq.write(seq+'\n')
-					sps_ki_w6_ki.write(ki+'\n')
-					sps_ki_w6_smi.write(smi+'\n')
-					# sps_ki_w6_sps.write(sps+'\n')
-					countki += 1
-					count6_ki += 1
-				if dropkd == 0:
-					kd_o6_writer.writerow(row)
-					bl_kd_w6_kd.write(kd+'\n')
-					bl_kd_w6_com.write(feature+'\n')
-					# bl_kd_w6_pro.write(domain+'\n')
-					bl_kd_w6_seq.write(seq+'\n')
-					sps_kd_w6_kd.write(kd+'\n')
-					sps_kd_w6_smi.write(smi+'\n')
-					# sps_kd_w6_sps.write(sps+'\n')
-					countkd += 1
-					count6_kd += 1
-			if nouid == 1:
-				noUniprotID.writerow(row)
-
-			mark1 = 0
-			mark2 = 0
-			mark3 = 0
-			mark4 = 0
-			mark5 = 0
-			mark6 = 0
-			dropec = 0
-			dropic = 0
-			dropki = 0
-			dropkd = 0
-			nouid = 0
-
-	ic_o1.close()
-	ic_o2.close()
-	ic_o3.close()
-	ic_o4.close()
-	ic_o5.close()
-	ic_o6.close()
-	ec_o1.close()
-	ec_o2.close()
-	ec_o3.close()
-	ec_o4.close()
-	ec_o5.close()
-	ec_o6.close()
-	ki_o1.close()
-	ki_o2.close()
-	ki_o3.close()
-	ki_o4.close()
-	ki_o5.close()
-	ki_o6.close()
-	kd_o1.close()
-	kd_o2.close()
-	kd_o3.close()
-	kd_o4.close()
-	kd_o5.close()
-	kd_o6.close()
-
-	# IC50
-	bl_ic_w1_ic.close()
-	bl_ic_w2_ic.close()
-	bl_ic_w3_ic.close()
-	bl_ic_w4_ic.close()
-	bl_ic_w5_ic.close()
-	bl_ic_w6_ic.close()
-	bl_ic_w1_com.close()
-	bl_ic_w2_com.close()
-	bl_ic_w3_com.close()
-	bl_ic_w4_com.close()
-	bl_ic_w5_com.close()
-	bl_ic_w6_com.close()
-	# bl_ic_w1_pro.close()
-	# bl_ic_w2_pro.close()
-	# bl_ic_w3_pro.close()
-	# bl_ic_w4_pro.close()
-	# bl_ic_w5_pro.close()
-	# bl_ic_w6_pro.close()
-
-	sps_ic_w1_ic.close()
-	sps_ic_w2_ic.close()
-	sps_ic_w3_ic.close()
-	sps_ic_w4_ic.close()
-	sps_ic_w5_ic.close()
-	sps_ic_w6_ic.close()
-	sps_ic_w1_smi.close()
-	sps_ic_w2_smi.close()
-	sps_ic_w3_smi.close()
-	sps_ic_w4_smi.close()
-	sps_ic_w5_smi.close()
-	sps_ic_w6_smi.close()
-	# sps_ic_w1_sps.close()
-	# sps_ic_w2_sps.close()
-	# sps_ic_w3_sps.close()
-	# sps_ic_w4_sps.close()
-	# sps_ic_w5_sps.close()
-	# sps_ic_w6_sps.close()
-
-	# EC50
-	bl_ec_w1_ec.close()
-	bl_ec_w2_ec.close()
-	bl_ec_w3_ec.close()
-	bl_ec_w4_ec.close()
-	bl_ec_w5_ec.close()
-	bl_ec_w6_ec.close()
-	bl_ec_w1_com.close()
-	bl_ec_w2_com.close()
-	bl_ec_w3_com.close()
-	bl_ec_w4_com.close()
-	bl_ec_w5_com.close()
-	bl_ec_w6_com.close()
-	# bl_ec_w1_pro.close()
-	# bl_ec_w2_pro.close()
-	# bl_ec_w3_pro.close()
-	# bl_ec_w4_pro.close()
-	# bl_ec_w5_pro.close()
-	# bl_ec_w6_pro.close()
-
-	sps_ec_w1_ec.close()
-	sps_ec_w2_ec.close()
-	sps_ec_w3_ec.close()
-	sps_ec_w4_ec.close()
-	sps_ec_w5_ec.close()
-	sps_ec_w6_ec.close()
-	sps_ec_w1_smi.close()
-	sps_ec_w2_smi.close()
-	sps_ec_w3_smi.close()
-	sps_ec_w4_smi.close()
-	sps_ec_w5_smi.close()
-	sps_ec_w6_smi.close()
-	# sps_ec_w1_sps.close()
-	# sps_ec_w2_sps.close()
-	# sps_ec_w3_sps.close()
-	# sps_ec_w4_sps.close()
-	# sps_ec_w5_sps.close()
-	# sps_ec_w6_sps.close()
-
-	# Ki
-	bl_ki_w1_ki.close()
-	bl_ki_w2_ki.close()
-	bl_ki_w3_ki.close()
-	bl_ki_w4_ki.close()
-	bl_ki_w5_ki.close()
-	bl_ki_w6_ki.close()
-	bl_ki_w1_com.close()
-	bl_ki_w2_com.close()
-	bl_ki_w3_com.close()
-	bl_ki_w4_com.close()
-	bl_ki_w5_com.close()
-	bl_ki_w6_com.close()
-	# bl_ki_w1_pro.close()
-	# bl_ki_w2_pro.close()
-	# bl_ki_w3_pro.close()
-	# bl_ki_w4_pro.close()
-	# bl_ki_w5_pro.close()
-	# bl_ki_w6_pro.close()
-
-	sps_ki_w1_ki.close()
-	sps_ki_w2_ki.close()
-	sps_ki_w3_ki.close()
-	sps_ki_w4_ki.close()
-	sps_ki_w5_ki.close()
-	sps_ki_w6_ki.close()
-	sps_ki_w1_smi.close()
-	sps_ki_w2_smi.close()
-	sps_ki_w3_smi.close()
-	sps_ki_w4_smi.close()
-	sps_ki_w5_smi.close()
-	sps_ki_w6_smi.close()
-	# sps_ki_w1_sps.close()
-	# sps_ki_w2_sps.close()
-	# sps_ki_w3_sps.close()
-	# sps_ki_w4_sps.close()
-	# sps_ki_w5_sps.close()
-	# sps_ki_w6_sps.close()
-
-	# Kd
-	bl_kd_w1_kd.close()
-	bl_kd_w2_kd.close()
-	bl_kd_w3_kd.close()
-	bl_kd_w4_kd.close()
-	bl_kd_w5_kd.close()
-	bl_kd_w6_kd.close()
-	bl_kd_w1_com.close()
-	bl_kd_w2_com.close()
-	bl_kd_w3_com.close()
-	bl_kd_w4_com.close()
-	bl_kd_w5_com.close()
-	bl_kd_w6_com.close()
-	# bl_kd_w1_pro.close()
-	# bl_kd_w2_pro.close()
-	# bl_kd_w3_pro.close()
-	# bl_kd_w4_pro.close()
-	# bl_kd_w5_pro.close()
-	# bl_kd_w6_pro.close()
+					texts[m, c, k] = ''.join([x + '\n' for x in columns[content]])
+	return texts, stats
+
+
+def read_blocks(f, block_size):
+	with f:
+		while True:
+			lines = list(itertools.islice(f, block_size))
+			if not lines:
+				break
+			yield lines
+
+
+def open_input(dataDir, block_size, use_columnar):
+	"""Header of the input and the (function, items) that split it block by block."""
+	global columnar_fn
+	if use_columnar:
+		# workers open the file themselves and only get row group numbers
+		columnar_fn = dataDir
+		reader = columnar.ColumnarReader(dataDir)
+		return list(reader.header), split_row_group, range(reader.num_row_groups)
+	f = open(dataDir)
+	header = next(csv.reader([next(f)], delimiter="\t", quoting=csv.QUOTE_NONE))
+	return header, split_chunk, read_blocks(f, block_size)
+
+
+def main(dataDir, compoundFea='CID_Smi_Feature', workers=1, block_size=10000, use_columnar=False, fingerprints=None):
+	global compound_store
+	start = time.time()
+	for name, col, folder, suffix in MEASURES:
+		for sub in ['', '/baseline', '/SPS']:
+			if not os.path.exists('./' + folder + sub):
+				os.makedirs('./' + folder + sub)
+
+	if fingerprints:
+		# store written by pubchem/getCID_Feature.py, memory-mapped instead of parsed
+		compound_store = FingerprintStore.load(fingerprints)
+	else:
+		compound_store = load_features(compoundFea)
+	print('Dictionary loaded')
 
-	sps_kd_w1_kd.close()
-	sps_kd_w2_kd.close()
-	sps_kd_w3_kd.close()
-	sps_kd_w4_kd.close()
-	sps_kd_w5_kd.close()
-	sps_kd_w6_kd.close()
-	sps_kd_w1_smi.close()
-	sps_kd_w2_smi.close()
-	sps_kd_w3_smi.close()
-	sps_kd_w4_smi.close()
-	sps_kd_w5_smi.close()
-	sps_kd_w6_smi.close()
-	# sps_kd_w1_sps.close()
-	# sps_kd_w2_sps.close()
-	# sps_kd_w3_sps.close()
-	# sps_kd_w4_sps.close()
-	# sps_kd_w5_sps.close()
-	# sps_kd_w6_sps.close()
+	files = {'noUniprotID': open('noUniprotID.tsv', 'w+', buffering=BUFFER_SIZE)}
+	for m, (name, col, folder, suffix) in enumerate(MEASURES):
+		for c, cls in enumerate(CLASSES):
+			for k, (template, content) in enumerate(OUTPUTS):
+				path = template.format(folder=folder, cls=cls, suffix=suffix)
+				files[m, c, k] = open(path, 'w+', buffering=BUFFER_SIZE)
+
+	stats = np.zeros((len(MEASURES), len(CLASSES) + 2), dtype=np.int64)
+	header, split_block, blocks = open_input(dataDir, block_size, use_columnar)
+	header[8] = "pKi_[M]"
+	header[9] = "pIC50_[M]"
+	header[10] = "pKd_[M]"
+	header[11] = "pEC50_[M]"
+	header = columnar.format_row(header)
+	for key, out in files.items():
+		if key == 'noUniprotID' or OUTPUTS[key[2]][1] == 'row':
+			out.write(header)
+
+	if workers > 1:
+		# forked workers share the compound features loaded above
+		pool = multiprocessing.get_context('fork').Pool(workers)
+		results = streaming.imap_ordered(pool, split_block, blocks, workers, workers * 4)
+	else:
+		results = map(split_block, blocks)
+	# blocks come back in input order, so the output does not depend on the number of workers
+	for texts, block_stats in results:
+		for key, text in texts.items():
+			files[key].write(text)
+		stats += block_stats
+	if workers > 1:
+		pool.close()
+		pool.join()
+	for out in files.values():
+		out.close()
 	print('split conmplete\n\n\n')
 
-	print('---------------------IC50 Statistic----------------------')
-	print('Total number: %d' %countic)
-	print('Train: %d' %count1_ic)
-	print('GPCR: %d' %count2_ic)
-	print('ER: %d' %count3_ic)
-	print('channel: %d' %count4_ic)
-	print('kinase: %d' %count5_ic)
-	print('Test: %d' %count6_ic)
-	print('No IC50: %d' % noicC)
-	print('Dropped cases: %d\n' %dropicC)
-
-	print('---------------------EC50 Statistic----------------------')
-	print('Total number: %d' %countec)
-	print('Train: %d' %count1_ec)
-	print('GPCR: %d' %count2_ec)
-	print('ER: %d' %count3_ec)
-	print('channel: %d' %count4_ec)
-	print('kinase: %d' %count5_ec)
-	print('Test: %d' %count6_ec)
-	print('No EC50: %d' % noecC)
-	print('Dropped cases: %d\n' %dropecC)
-
-	print('---------------------Ki Statistic----------------------')
-	print('Total number: %d' % countki)
-	print('Train: %d' % count1_ki)
-	print('GPCR: %d' % count2_ki)
-	print('ER: %d' % count3_ki)
-	print('channel: %d' % count4_ki)
-	print('kinase: %d' % count5_ki)
-	print('Test: %d' % count6_ki)
-	print('No Ki: %d' % nokiC)
-	print('Dropped cases: %d\n' % dropkiC)
-
-	print('---------------------Kd Statistic----------------------')
-	print('Total number: %d' % countkd)
-	print('Train: %d' % count1_kd)
-	print('GPCR: %d' % count2_kd)
-	print('ER: %d' % count3_kd)
-	print('channel: %d' % count4_kd)
-	print('kinase: %d' % count5_kd)
-	print('Test: %d' % count6_kd)
-	print('No Kd: %d' % nokdC)
-	print('Dropped cases: %d\n' % dropkdC)
+	for m, (name, col, folder, suffix) in enumerate(MEASURES):
+		print('---------------------%s Statistic----------------------' % name)
+		print('Total number: %d' % stats[m, :len(CLASSES)].sum())
+		print('Train: %d' % stats[m, 0])
+		print('GPCR: %d' % stats[m, 1])
+		print('ER: %d' % stats[m, 2])
+		print('channel: %d' % stats[m, 3])
+		print('kinase: %d' % stats[m, 4])
+		print('Test: %d' % stats[m, 5])
+		print('No %s: %d' % (name, stats[m, -2]))
+		print('Dropped cases: %d\n' % stats[m, -1])
+	print('%.1fs with %d workers' % (time.time() - start, workers))
 
 if __name__ == '__main__':
-	if len(sys.argv) != 2:
-		print("usage: split.py <data directory>")
-	main(sys.argv[1])
+	parser = argparse.ArgumentParser(usage="split.py <data directory>")
+	parser.add_argument('dataDir', type=str)
+	parser.add_argument('--compound-fea', type=str, default='CID_Smi_Feature')
+	parser.add_argument('--workers', type=int, default=1)
+	parser.add_argument('--block-size', type=int, default=10000, help='input lines per task')
+	parser.add_argument('--columnar', action='store_true', default=False,
+						help='read the .parquet file of columnar.py instead of the .tsv file, one row group per task')
+	parser.add_argument('--fingerprints', type=str, default=None,
+						help='prefix of the fingerprint store of pubchem/getCID_Feature.py, used instead of --compound-fea')
+	args = parser.parse_args()
+	if args.columnar:
+		main(columnar.parquet_path(args.dataDir), args.compound_fea, args.workers, use_columnar=True,
+			fingerprints=args.fingerprints)
+	else:
+		main(args.dataDir, args.compound_fea, args.workers, args.block_size, fingerprints=args.fingerprints)
@@ -0,0 +1,106 @@
+import io
+import time
+import argparse
+import itertools
+import collections
+import multiprocessing
+from tqdm import tqdm
+
+
+def dropped_path(output_fn):
+    return '{}.dropped'.format(output_fn)
+
+
+def read_lines(input_fn):
+    with io.open(input_fn, 'r', encoding='utf8', newline='\n') as srcf:
+        for line in srcf:
+            yield line.strip()
+
+
+def imap_ordered(pool, func, items, workers, chunk_size=100000, map_chunk=None):
+    """Ordered `pool.imap` over `items` that reads at most two chunks ahead.
+
+    `Pool.imap` alone consumes its whole input up front; here the input is
+    read `chunk_size` items at a time and the next chunk is dispatched while
+    the results of the current one are yielded. `map_chunk(pool, chunk)`
+    replaces the plain `pool.imap` of a chunk when given, e.g. to skip inputs
+    that are already cached. It is called when the chunk is dispatched and
+    must start the work without waiting for it, returning an iterable that
+    yields the results in input order once the chunk is consumed.
+    """
+    items = iter(items)
+    # keep every worker busy within one chunk
+    imap_chunksize = max(1, chunk_size // (workers * 4))
+    pending = collections.deque()
+
+    def submit():
+        chunk = list(itertools.islice(items, chunk_size))
+        if chunk and map_chunk is None:
+            pending.append(pool.imap(func, chunk, chunksize=imap_chunksize))
+        elif chunk:
+            pending.append(map_chunk(pool, chunk))
+
+    submit()
+    submit()
+    while pending:
+        results = pending.popleft()
+        submit()
+        for res in results:
+            yield res
+
+
+def run(func, input_fn, output_fn, workers=1, chunk_size=100000, desc=None, map_chunk=None):
+    """Apply `func` to every line of `input_fn` and write the results in order.
+
+    Lines are streamed through `imap_ordered`, so memory does not grow with
+    the input size. Lines whose result is empty or None are dropped; their
+    0-based line numbers are written to `<output_fn>.dropped` so that the
+    parallel `.pro`/`.label` files can be filtered with `drop_lines` and stay
+    aligned.
+    """
+    pool = multiprocessing.Pool(workers)
+    total, kept = 0, 0
+    start = time.time()
+    with io.open(output_fn, 'w', encoding='utf8', newline='\n') as dstf, \
+            io.open(dropped_path(output_fn), 'w', encoding='utf8', newline='\n') as dropf:
+        results = imap_ordered(pool, func, read_lines(input_fn), workers, chunk_size, map_chunk)
+        for res in tqdm(results, desc=desc, unit=' lines'):
+            if res:
+                dstf.write('{}\n'.format(res))
+                kept += 1
+            else:
+                dropf.write('{}\n'.format(total))
+            total += 1
+    pool.close()
+    pool.join()
+
+    report(total, kept, time.time() - start, dropped_path(output_fn))
+    return kept, total
+
+
+def report(total, kept, elapsed, dropped_fn):
+    print('{}/{}'.format(kept, total))
+    print('{} lines in {:.1f}s ({:.0f} lines/s), {} dropped, listed in {}'.format(
+        total, elapsed, total / max(elapsed, 1e-9), total - kept, dropped_fn))
+
+
+def drop_lines(input_fn, dropped_fn, output_fn):
+    """Copy `input_fn` to `output_fn` without the line numbers listed in `dropped_fn`."""
+    with io.open(dropped_fn, 'r', encoding='utf8') as f:
+        dropped = set(int(line) for line in f if line.strip())
+    with io.open(input_fn, 'r', encoding='utf8', newline='\n') as srcf, \
+            io.open(output_fn, 'w', encoding='utf8', newline='\n') as dstf:
+        for i, line in enumerate(srcf):
+            if i not in dropped:
+                dstf.write(line)
+    print('{} lines dropped from {}'.format(len(dropped), input_fn))
+
+
+if __name__ == "__main__":
+    # filter a parallel file (e.g. .pro or .label) with the dropped lines of another stage
+    parser = argparse.ArgumentParser()
+    parser.add_argument('fn', type=str)
+    parser.add_argument('--dropped', type=str, required=True)
+    parser.add_argument('--output-fn', type=str, required=True)
+    args = parser.parse_args()
+    drop_lines(args.fn, args.dropped, args.output_fn)
@@ -0,0 +1,270 @@
+import io
+import os
+import sys
+import time
+import shutil
+import argparse
+import numpy as np
+import torch
+from tqdm import tqdm
+
+sys.path.append(os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "fairseq"))
+
+from fairseq.data import indexed_dataset
+
+# fairseq Dictionary: <s>, <pad>, </s>, <unk>, then the symbols of dict.txt
+NSPECIAL = 4
+EOS = 2
+# random streams, see rng()
+MOL, PRO, PAIRS, EMBED = range(4)
+SPLITS = ['train', 'valid', 'test']
+# entities are drawn in chunks of a fixed size, so they do not depend on --chunk-size
+ENTITY_CHUNK = 1 << 16
+
+
+def rng(seed, *stream):
+    """Generator of one stream (kind, side or split, chunk), independent of every other stream."""
+    return np.random.default_rng([seed] + list(stream))
+
+
+def read_dict(dict_fn):
+    """Token ids of the symbols of a fairseq dict.txt and their sampling weights (the counts)."""
+    counts = []
+    with io.open(dict_fn, 'r', encoding='utf8') as f:
+        for line in f:
+            counts.append(float(line.rstrip('\n').rsplit(' ', 1)[1]))
+    counts = np.array(counts)
+    return np.arange(NSPECIAL, NSPECIAL + len(counts)), counts / counts.sum()
+
+
+def token_pool(seed, side, num, dict_fn, mean_len, sigma, max_len):
+    """Tokens of `num` entities, concatenated with an </s> after each, and the offset of every entity.
+
+    Lengths are log-normal around `mean_len` tokens, tokens are drawn with
+    the frequencies of the dictionary.
+    """
+    ids, weights = read_dict(dict_fn)
+    cdf = np.cumsum(weights)
+    tokens = []
+    offsets = np.zeros(num + 1, dtype=np.int64)
+    for c, start in enumerate(range(0, num, ENTITY_CHUNK)):
+        r = rng(seed, side, c)
+        n = min(ENTITY_CHUNK, num - start)
+        lengths = np.clip(np.rint(r.lognormal(np.log(mean_len), sigma, n)), 1, max_len).astype(np.int64)
+        chunk = ids[np.minimum(np.searchsorted(cdf, r.random(int(lengths.sum()))), len(ids) - 1)]
+        # </s> after every entity, as appended by the binarizers
+        chunk = np.insert(chunk, np.cumsum(lengths), EOS)
+        tokens.append(chunk.astype(np.int32))
+        offsets[start + 1:start + n + 1] = offsets[start] + np.cumsum(lengths + 1)
+    return np.concatenate(tokens), offsets
+
+
+def embeddings(seed, side, start, end, dim):
+    """float32[end - start, dim] CLS-like vectors of entities start:end."""
+    r = rng(seed, EMBED, side, start)
+    return (r.standard_normal((end - start, dim)) / np.sqrt(dim)).astype(np.float32)
+
+
+def entity_effects(seed, side, num, dim, datastore_fn=None):
+    """Contribution of every entity to the label, a linear function of its embedding.
+
+    Pairs of entities with close embeddings get close labels, so retrieval
+    over the datastore finds informative neighbours. The embeddings are
+    written to `datastore_fn` when given.
+    """
+    w = rng(seed, EMBED, side).standard_normal(dim).astype(np.float32)
+    effects = np.empty(num, dtype=np.float32)
+    out = np.lib.format.open_memmap(datastore_fn, mode='w+', dtype=np.float32, shape=(num, dim)) \
+        if datastore_fn else None
+    for start in range(0, num, ENTITY_CHUNK):
+        end = min(start + ENTITY_CHUNK, num)
+        emb = embeddings(seed, side, start, end, dim)
+        effects[start:end] = emb @ w
+        if out is not None:
+            out[start:end] = emb
+    if out is not None:
+        out.flush()
+    return effects
+
+
+def popularity(num, skew):
+    """Cumulative probability of drawing every entity: the i-th entity has weight (i + 1)^-skew."""
+    weights = np.arange(1, num + 1, dtype=np.float64) ** -skew
+    return np.cumsum(weights / weights.sum())
+
+
+def standardize(effects, cdf):
+    """`effects` with mean 0 and variance 1 over entities drawn with the probabilities of `cdf`."""
+    weights = np.diff(cdf, prepend=0.0)
+    mean = np.dot(weights, effects)
+    std = np.sqrt(np.dot(weights, (effects - mean) ** 2))
+    return ((effects - mean) / max(std, 1e-12)).astype(np.float32)
+
+
+def sample(r, cdf, n, start=None):
+    """Entities of n pairs. With `start`, pairs start:start + n of a split that takes every entity once first."""
+    ids = np.minimum(np.searchsorted(cdf, r.random(n)), len(cdf) - 1)
+    if start is None:
+        return ids
+    pos = np.arange(start, start + n)
+    return np.where(pos < len(cdf), pos, ids)
+
+
+def draw_pairs(args, split, c, start, mol_cdf, pro_cdf):
+    """Molecule, protein and label noise of pairs start:start + chunk size of a split."""
+    r = rng(args.seed, PAIRS, SPLITS.index(split), c)
+    n = min(args.chunk_size, getattr(args, split + '_pairs') - start)
+    # only the train split is guaranteed to cover every entity
+    cover = start if split == 'train' else None
+    return sample(r, mol_cdf, n, cover), sample(r, pro_cdf, n, cover), r.standard_normal(n)
+
+
+class PairWriter(object):
+    """Write the pairs of a split in the regular and/or the unique-entity layout, chunk by chunk."""
+
+    def __init__(self, args, split, num_pairs, pools):
+        self.pools = pools
+        self.builders = []
+        if 'regular' in args.layout:
+            for side, pool in enumerate(pools):
+                prefix = os.path.join(args.destdir, 'input{}'.format(side), split)
+                self.builders.append((prefix, indexed_dataset.make_builder(
+                    indexed_dataset.data_file_path(prefix), impl='mmap', vocab_size=pool[2])))
+        self.pairs = None
+        if 'unique' in args.layout:
+            self.pairs = np.lib.format.open_memmap(
+                os.path.join(args.destdir, 'pairs', '{}.npy'.format(split)), mode='w+',
+                dtype=np.int32, shape=(num_pairs, 2))
+        self.labelf = io.open(os.path.join(args.destdir, 'label', '{}.label'.format(split)), 'w',
+                              encoding='utf8', newline='\n')
+
+    def write(self, start, mol_ids, pro_ids, labels):
+        for (prefix, builder), (tokens, offsets, vocab_size), ids in zip(self.builders, self.pools, [mol_ids, pro_ids]):
+            for i in ids:
+                builder.add_item(torch.from_numpy(tokens[offsets[i]:offsets[i + 1]]))
+        if self.pairs is not None:
+            self.pairs[start:start + len(mol_ids)] = np.stack([mol_ids, pro_ids], axis=1)
+        self.labelf.write(''.join(['%.4f\n' % x for x in labels]))
+
+    def close(self):
+        for prefix, builder in self.builders:
+            builder.finalize(indexed_dataset.index_file_path(prefix))
+        if self.pairs is not None:
+            self.pairs.flush()
+        self.labelf.close()
+
+
+def write_unique_entities(args, pools):
+    for side, (tokens, offsets, vocab_size) in enumerate(pools):
+        for split in SPLITS:
+            if not getattr(args, split + '_pairs'):
+                continue
+            # every split indexes the same table of entities
+            prefix = os.path.join(args.destdir, 'input{}_unique'.format(side), split)
+            builder = indexed_dataset.make_builder(
+                indexed_dataset.data_file_path(prefix), impl='mmap', vocab_size=vocab_size)
+            for i in range(len(offsets) - 1):
+                builder.add_item(torch.from_numpy(tokens[offsets[i]:offsets[i + 1]]))
+            builder.finalize(indexed_dataset.index_file_path(prefix))
+
+
+def write_datastore(args, mol_cdf, pro_cdf):
+    """cls_0.npy / cls_1.npy of every train pair, as build_datastore.py writes them.
+
+    cls_0_unique_mol.npy and cls_1_unique_pro.npy are the entity tables,
+    written by entity_effects.
+    """
+    mol_table = np.load(os.path.join(args.datastore, 'cls_0_unique_mol.npy'), mmap_mode='r')
+    pro_table = np.load(os.path.join(args.datastore, 'cls_1_unique_pro.npy'), mmap_mode='r')
+    outs = [np.lib.format.open_memmap(os.path.join(args.datastore, 'cls_{}.npy'.format(side)), mode='w+',
+                                      dtype=np.float32, shape=(args.train_pairs, args.embed_dim))
+            for side in range(2)]
+    for c, start in enumerate(tqdm(range(0, args.train_pairs, args.chunk_size), desc='datastore', unit=' chunks')):
+        mol_ids, pro_ids, _ = draw_pairs(args, 'train', c, start, mol_cdf, pro_cdf)
+        outs[0][start:start + len(mol_ids)] = mol_table[mol_ids]
+        outs[1][start:start + len(pro_ids)] = pro_table[pro_ids]
+    for out in outs:
+        out.flush()
+
+
+def main(args):
+    start_time = time.time()
+    dirs = []
+    if 'regular' in args.layout:
+        dirs += ['input0', 'input1']
+    if 'unique' in args.layout:
+        dirs += ['input0_unique', 'input1_unique', 'pairs']
+    for name in dirs + ['label']:
+        os.makedirs(os.path.join(args.destdir, name), exist_ok=True)
+    for name in dirs:
+        if name != 'pairs':
+            shutil.copyfile(args.mol_dict if name.startswith('input0') else args.pro_dict,
+                            os.path.join(args.destdir, name, 'dict.txt'))
+
+    pools = []
+    for side, (dict_fn, num, mean_len, max_len) in enumerate([
+            (args.mol_dict, args.num_mols, args.mol_len, args.max_mol_len),
+            (args.pro_dict, args.num_pros, args.pro_len, args.max_pro_len)]):
+        tokens, offsets = token_pool(args.seed, [MOL, PRO][side], num, dict_fn, mean_len, args.len_sigma, max_len)
+        pools.append((tokens, offsets, NSPECIAL + len(read_dict(dict_fn)[0])))
+        print('input{}: {} entities, {:.1f} tokens on average'.format(side, num, len(tokens) / max(num, 1)))
+    if 'unique' in args.layout:
+        write_unique_entities(args, pools)
+
+    if args.datastore:
+        os.makedirs(args.datastore, exist_ok=True)
+    datastore_fns = [os.path.join(args.datastore, name) if args.datastore else None
+                     for name in ['cls_0_unique_mol.npy', 'cls_1_unique_pro.npy']]
+    mol_effects = entity_effects(args.seed, MOL, args.num_mols, args.embed_dim, datastore_fns[0])
+    pro_effects = entity_effects(args.seed, PRO, args.num_pros, args.embed_dim, datastore_fns[1])
+    mol_cdf, pro_cdf = popularity(args.num_mols, args.skew), popularity(args.num_pros, args.skew)
+    # popular entities make most of the pairs, so the effects are standardized under their popularity
+    mol_effects, pro_effects = standardize(mol_effects, mol_cdf), standardize(pro_effects, pro_cdf)
+
+    for split in SPLITS:
+        num_pairs = getattr(args, split + '_pairs')
+        if not num_pairs:
+            continue
+        writer = PairWriter(args, split, num_pairs, pools)
+        for c, start in enumerate(tqdm(range(0, num_pairs, args.chunk_size), desc=split, unit=' chunks')):
+            mol_ids, pro_ids, noise = draw_pairs(args, split, c, start, mol_cdf, pro_cdf)
+            # pKd-like labels: mean 6, spread 1.5 from the entities, plus noise
+            labels = 6.0 + 1.5 * (mol_effects[mol_ids] + pro_effects[pro_ids]) / np.sqrt(2) + args.label_noise * noise
+            writer.write(start, mol_ids, pro_ids, labels)
+        writer.close()
+    if args.datastore:
+        write_datastore(args, mol_cdf, pro_cdf)
+    print('{} train, {} valid and {} test pairs in {:.1f}s'.format(
+        args.train_pairs, args.valid_pairs, args.test_pairs, time.time() - start_time))
+
+
+if __name__ == "__main__":
+    # writes a binarized dataset of random pairs for load tests, see the README
+    here = os.path.dirname(os.path.abspath(__file__))
+    parser = argparse.ArgumentParser()
+    parser.add_argument('destdir', type=str)
+    parser.add_argument('--layout', type=str, nargs='+', default=['regular'], choices=['regular', 'unique'],
+                        help='input0/input1 (dti_separate_add_mask_token) and/or input{0,1}_unique + pairs '
+                             '(dti_separate_add_mask_token_unique_entity)')
+    parser.add_argument('--datastore', type=str, default=None,
+                        help='also write cls_0.npy, cls_1.npy, cls_0_unique_mol.npy and cls_1_unique_pro.npy here')
+    parser.add_argument('--embed-dim', type=int, default=768)
+    parser.add_argument('--num-mols', type=int, default=100000)
+    parser.add_argument('--num-pros', type=int, default=2000)
+    parser.add_argument('--train-pairs', type=int, default=1000000)
+    parser.add_argument('--valid-pairs', type=int, default=10000)
+    parser.add_argument('--test-pairs', type=int, default=10000)
+    parser.add_argument('--skew', type=float, default=1.0,
+                        help='popularity of the i-th entity is (i + 1)^-skew; 0 draws entities uniformly')
+    parser.add_argument('--mol-len', type=float, default=45, help='typical molecule length in tokens')
+    parser.add_argument('--pro-len', type=float, default=550, help='typical protein length in tokens')
+    parser.add_argument('--len-sigma', type=float, default=0.4, help='sigma of the log-normal lengths')
+    parser.add_argument('--max-mol-len', type=int, default=510)
+    parser.add_argument('--max-pro-len', type=int, default=1022)
+    parser.add_argument('--label-noise', type=float, default=0.5, help='standard deviation of the label noise')
+    parser.add_argument('--mol-dict', type=str, default=os.path.join(here, 'dict.mol.txt'))
+    parser.add_argument('--pro-dict', type=str, default=os.path.join(here, 'dict.pro.txt'))
+    parser.add_argument('--chunk-size', type=int, default=100000)
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+    main(args)
@@ -4,9 +4,12 @@ import re
 import pybel
 import csv
 import sys
+import argparse
 from subprocess import call
 
-def main():
+import columnar
+
+def main(use_columnar=False):
     # i = 0
     countDrop = 0
     dropM = 0
@@ -33,6 +36,8 @@ def main():
             elif line.strip() == '$$$$':
                 cid_can[cid] = can
     print("Dictionary Loaded!")
+    if use_columnar:
+        return main_columnar(cid_can)
     with open('BindingDB_All_firststep_noMulti.tsv') as tsvfile, open('BindingDB_All_firststep_noMulti_can.tsv','w+') as csvout:
         reader = csv.reader(tsvfile, delimiter="\t",quoting=csv.QUOTE_NONE)
         writer = csv.writer(csvout, dialect='excel-tab')
@@ -54,8 +59,26 @@ def main():
     # print countDrop
 
 
+def main_columnar(cid_can):
+    # only the SMILES column changes, so whole row groups are rewritten without rebuilding rows
+    total = 0
+    reader = columnar.ColumnarReader('BindingDB_All_firststep_noMulti.parquet')
+    with columnar.ColumnarWriter('BindingDB_All_firststep_noMulti_can.parquet', reader.header) as writer:
+        for table in reader.iter_tables():
+            cans = [cid_can[cid] for cid in table[columnar.col(28)].to_pylist()]
+            keep = [len(can.strip()) <= 100 for can in cans]
+            table = columnar.filter_rows(columnar.replace_column(table, 1, cans), keep)
+            writer.write_table(table)
+            total += len(table)
+    print(total)
+
+
 
 
 
 if __name__ == '__main__':
-    main()
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--columnar', action='store_true', default=False,
+                        help='read and write the .parquet files of columnar.py instead of the .tsv files')
+    args = parser.parse_args()
+    main(args.columnar)
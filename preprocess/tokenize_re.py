@@ -1,17 +1,17 @@
-import re
-import io
+import os
+import sys
 import argparse
-from tqdm import tqdm
-import multiprocessing
+
+import streaming
+
+sys.path.append(os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "knn_dta", "modules"))
+
+from smiles_tokenizer import SmilesTokenizer
 
 
 def smi_tokenizer(smi):
-    pattern =  "(\[[^\]]+]|Br?|Cl?|N|O|S|P|F|I|b|c|n|o|s|p|\(|\)|\.|=|#|-|\+|\\\\|\/|:|~|@|\?|>|\*|\$|\%[0-9]{2}|[0-9])"
-    regex = re.compile(pattern)
-    tokens = [token for token in regex.findall(smi)]
-    try:
-        assert re.sub('\s+', '', smi) == ''.join(tokens)
-    except:
+    tokens = SmilesTokenizer.tokenize(smi)
+    if tokens is None:
         return ''
 
     return ' '.join(tokens)
@@ -19,25 +19,11 @@ def smi_tokenizer(smi):
 
 def main(args):
     input_fn = args.fn
-    def lines():
-        with io.open(input_fn, 'r', encoding='utf8', newline='\n') as srcf:
-            for line in srcf:
-                yield line.strip()
-
-    results = []
-    total = len(io.open(input_fn, 'r', encoding='utf8', newline='\n').readlines())
-
-    pool = multiprocessing.Pool(args.workers)
-    for res in tqdm(pool.imap(smi_tokenizer, lines(), chunksize=100000), total=total):
-        if res:
-            results.append('{}\n'.format(res))
-
     if args.output_fn is None:
         output_fn = '{}.bpe'.format(input_fn)
     else:
         output_fn = args.output_fn
-    io.open(output_fn, 'w', encoding='utf8', newline='\n').writelines(results)
-    print('{}/{}'.format(len(results), total))
+    streaming.run(smi_tokenizer, input_fn, output_fn, workers=args.workers, chunk_size=args.chunk_size)
 
 
 if __name__ == "__main__":
@@ -45,5 +31,6 @@ if __name__ == "__main__":
     parser.add_argument('fn', type=str)
     parser.add_argument('--workers', type=int, default=1)
     parser.add_argument('--output-fn', type=str, default=None)
+    parser.add_argument('--chunk-size', type=int, default=100000)
     args = parser.parse_args()
     main(args)
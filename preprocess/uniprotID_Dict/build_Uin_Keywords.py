@@ -1,100 +1,230 @@
 #coding:utf-8
-from __future__ import division
-import re
-import csv
-import sys
-import urllib2
-from subprocess import call
-from bs4 import BeautifulSoup  
-
-def getID_Name(uniprotID):
-    page = urllib2.urlopen('https://www.uniprot.org/uniprot/' + uniprotID)   
-    contents = page.read()   
-    soup = BeautifulSoup(contents,"html.parser")
+import os
+import json
+import time
+import socket
+import asyncio
+import argparse
+import urllib.error
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+
+# UniProt REST entry of one accession; a local mock server can stand in for it
+DEFAULT_ENDPOINT = 'https://rest.uniprot.org/uniprotkb/{accession}.json'
+HEADER = 'Uniprot ID\tGene\tUniprotKB Keywords ID\tUniprotKB Keywords Name\tGO Keywords ID\tGO Keywords Name'
+# worth another try after a backoff: rate limited or temporarily unavailable
+RETRY_CODES = {429, 500, 502, 503, 504}
+
+
+class RateLimiter(object):
+    """Start at most `rate` requests per second, spaced evenly."""
+
+    def __init__(self, rate):
+        self.interval = 1.0 / rate if rate > 0 else 0.0
+        self.next = 0.0
+        self.lock = asyncio.Lock()
+
+    async def wait(self):
+        async with self.lock:
+            now = time.monotonic()
+            delay = self.next - now
+            self.next = max(now, self.next) + self.interval
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+
+class UniprotFetcher(object):
+    """Fetch UniProt entries with bounded concurrency, a rate limit and retries.
+
+    Responses are cached on disk as `{cache_dir}/{accession}.json`, so an
+    interrupted run never downloads an entry twice, and concurrent requests
+    of the same accession share one download.
+    """
+
+    def __init__(self, endpoint=DEFAULT_ENDPOINT, cache_dir='uniprot_cache', concurrency=8, rate=10.0,
+                 retries=5, backoff=1.0, timeout=30.0):
+        self.endpoint = endpoint
+        self.cache_dir = cache_dir
+        self.retries = retries
+        self.backoff = backoff
+        self.timeout = timeout
+        self.semaphore = asyncio.Semaphore(concurrency)
+        self.limiter = RateLimiter(rate)
+        # urllib blocks, so every request runs in a thread of its own pool
+        self.executor = ThreadPoolExecutor(max_workers=concurrency)
+        # downloads in flight, by accession
+        self.pending = {}
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def cache_path(self, accession):
+        return os.path.join(self.cache_dir, accession + '.json')
+
+    def download(self, accession):
+        request = urllib.request.Request(self.endpoint.format(accession=accession),
+                                         headers={'Accept': 'application/json'})
+        with urllib.request.urlopen(request, timeout=self.timeout) as page:
+            return page.read()
+
+    async def get(self, accession):
+        """Entry of `accession` as a dict, from the cache when possible."""
+        path = self.cache_path(accession)
+        if os.path.exists(path):
+            with open(path, 'rb') as f:
+                return json.loads(f.read().decode('utf8'))
+        task = self.pending.get(accession)
+        if task is None:
+            task = asyncio.ensure_future(self.fetch(accession))
+            self.pending[accession] = task
+            task.add_done_callback(lambda _: self.pending.pop(accession, None))
+        # a cancelled caller leaves the download to the others waiting for it
+        return await asyncio.shield(task)
+
+    async def fetch(self, accession):
+        """Download the entry of `accession` into the cache."""
+        path = self.cache_path(accession)
+        loop = asyncio.get_event_loop()
+        async with self.semaphore:
+            for attempt in range(self.retries + 1):
+                await self.limiter.wait()
+                try:
+                    contents = await loop.run_in_executor(self.executor, self.download, accession)
+                    break
+                except urllib.error.HTTPError as e:
+                    if e.code not in RETRY_CODES or attempt == self.retries:
+                        raise
+                    retry_after = e.headers.get('Retry-After', '')
+                    delay = float(retry_after) if retry_after.isdigit() else self.backoff * 2 ** attempt
+                except (urllib.error.URLError, socket.timeout, ConnectionError):
+                    if attempt == self.retries:
+                        raise
+                    delay = self.backoff * 2 ** attempt
+                await asyncio.sleep(delay)
+        entry = json.loads(contents.decode('utf8'))
+        # write then rename, so the cache never holds a partial response
+        with open(path + '.tmp', 'wb') as f:
+            f.write(contents)
+        os.replace(path + '.tmp', path)
+        return entry
+
+    async def entry(self, accession):
+        """Entry of `accession`, following a merged (inactive) accession to its successor."""
+        entry = await self.get(accession)
+        merged = entry.get('inactiveReason', {}).get('mergeDemergeTo', [])
+        if entry.get('entryType') == 'Inactive' and merged:
+            entry = await self.get(merged[0])
+        return entry
+
+    def close(self):
+        self.executor.shutdown()
+
+
+def getID_Name(entry):
+    """Gene name, molecular function keywords and molecular function GO terms of an entry."""
     gene = ''
     uniID = []
     uniName = []
     goID = []
     goName = []
-    try:
-        gene = str(soup.find('div', class_='entry-overview-content', id="content-gene").get_text())
-    except:
-        uniprotID = str(soup.find('div', class_='entryEmpty').find('a').get_text())
-        page = urllib2.urlopen('https://www.uniprot.org/uniprot/' + uniprotID)   
-        contents = page.read()   
-        soup = BeautifulSoup(contents,"html.parser")
-        gene = str(soup.find('div', class_='entry-overview-content', id="content-gene").get_text())
-    for tag in soup.find('table', class_='databaseTable'):
-        if 'Molecular function' in tag.get_text():
-            uniKeywords = tag.findAll('a')
-            for term in uniKeywords:
-                match = re.search(r'<a href="/keywords/([\w\W]+)">([\w\W]+)</a>',str(term))
-                uniID.append(match.group(1))
-                uniName.append(match.group(2))
-
-    goTerms = soup.find('ul', class_ = 'noNumbering molecular_function')
-    if goTerms:
-        for tag in goTerms:
-            a = tag.find('a')
-            goName.append(str(a.get_text()))
-            goID.append(re.search(r'(GO:[\w\W]+?)"',str(a)).group(1))
+    genes = entry.get('genes', [])
+    if genes and 'geneName' in genes[0]:
+        gene = genes[0]['geneName']['value']
+    for keyword in entry.get('keywords', []):
+        if keyword.get('category') == 'Molecular function':
+            uniID.append(keyword['id'])
+            uniName.append(keyword['name'])
+    for ref in entry.get('uniProtKBCrossReferences', []):
+        if ref.get('database') != 'GO':
+            continue
+        for prop in ref.get('properties', []):
+            # F: molecular function, P: biological process, C: cellular component
+            if prop['key'] == 'GoTerm' and prop['value'].startswith('F:'):
+                goID.append(ref['id'])
+                goName.append(prop['value'][2:])
     return gene, uniID, uniName, goID, goName
 
-def main():
-    # i = 0
-    # uniID = set()
-    # temp = ''
-    # headers = { 'User-Agent':'Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/58.0.3029.110 Safari/537.36' } 
-    # goRe = r'<tr><td>Molecular function</td><td><span>(.+?)</span>'
-    # keywordRe = r'<property type="term" value="F:(.+)"/>'
-    with open('Uniprot_ID') as f, open('uniID_keywords.tsv','a') as w:
-        # reader = csv.reader(tsvfile, delimiter="\t",quoting=csv.QUOTE_NONE)
-        # header = reader.next()
-        # writer = csv.writer(csvout, dialect='excel-tab')
-        # writer.writerow(header)
-        header = 'Uniprot ID\tGene\tUniprotKB Keywords ID\tUniprotKB Keywords Name\tGO Keywords ID\tGO Keywords Name'
-        # w.write(header + '\n')
-        for line in f:
-            if line.strip() == '':
-                continue
-            if ',' in line:
-                uniID = line.split(',')[0].strip()
-            else:
-                uniID = line.strip()
-            gene, keywordID, keywordName, goID, goName = getID_Name(uniID)
-            if gene == -1:
-                print(uni)
-            uniprot_keywords_ID = '|'.join(term for term in keywordID)
-            uniprot_keywords_name = '|'.join(term for term in keywordName)
-            GO_keywords_ID = '|'.join(term for term in goID)
-            GO_keywords_name = '|'.join(term for term in goName)
-            w.write(line.strip() + '\t' + gene + '\t' + uniprot_keywords_ID + '\t' + uniprot_keywords_name\
-             + '\t' + GO_keywords_ID + '\t' + GO_keywords_name + '\n')
-        #     url = "https://www.uniprot.org/uniprot/" + uniID + '.xml'
-        #     # req = urllib2.Request(url = "http://m.qiushibaike.com/hot/page/1",headers = headers)
-        #     try:
-        #         contents = urllib2.urlopen(url)
-        #     except:
-        #         print line
-        #         contents = ''
-        #         continue
-        #     for row in contents:
-        #         if re.search(keywordRe, row):
-        #             keyword = re.search(keywordRe, row).group(1)
-        #             temp += keyword + ','
-        #     temp = temp.strip(',') + '\n'
-        #     w.write(line + temp)
-        #     temp = ''
-                    
-
-
-    # print count
-    # print noCount
-    # print total
 
+def format_row(line, entry):
+    gene, keywordID, keywordName, goID, goName = getID_Name(entry)
+    return '\t'.join([line, gene, '|'.join(keywordID), '|'.join(keywordName),
+                      '|'.join(goID), '|'.join(goName)]) + '\n'
+
+
+def accession(line):
+    if ',' in line:
+        return line.split(',')[0].strip()
+    return line.strip()
+
+
+def read_done(output):
+    """Lines of Uniprot_ID already in `output`."""
+    done = set()
+    if os.path.exists(output):
+        with open(output) as f:
+            for row in f:
+                done.add(row.split('\t')[0])
+    return done
+
+
+async def fetch_row(fetcher, line):
+    try:
+        return format_row(line, await fetcher.entry(accession(line)))
+    except Exception as e:
+        print('%s: %s' % (accession(line), e))
+        return None
+
+
+async def fetch_all(fetcher, lines, w):
+    tasks = [asyncio.ensure_future(fetch_row(fetcher, line)) for line in lines]
+    count = 0
+    failed = 0
+    # rows are written in input order while later accessions are still being fetched
+    for task in tasks:
+        row = await task
+        if row is None:
+            failed += 1
+            continue
+        w.write(row)
+        w.flush()
+        count += 1
+    return count, failed
+
+
+def main(input_fn='Uniprot_ID', output='uniID_keywords.tsv', **fetcher_args):
+    start = time.time()
+    done = read_done(output)
+    with open(input_fn) as f:
+        lines = [line.strip() for line in f if line.strip() != '']
+    unique = list(dict.fromkeys(lines))
+    todo = [line for line in unique if line not in done]
+    print('%d IDs, %d already in %s, %d to fetch' % (len(unique), len(unique) - len(todo), output, len(todo)))
 
+    async def run():
+        fetcher = UniprotFetcher(**fetcher_args)
+        try:
+            with open(output, 'a') as w:
+                if not done:
+                    w.write(HEADER + '\n')
+                return await fetch_all(fetcher, todo, w)
+        finally:
+            fetcher.close()
 
+    count, failed = asyncio.run(run())
+    # failed IDs are not written, so running the script again retries them
+    print('%d written, %d failed in %.1fs' % (count, failed, time.time() - start))
 
 
 if __name__ == '__main__':
-    main()
\ No newline at end of file
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--input', type=str, default='Uniprot_ID')
+    parser.add_argument('--output', type=str, default='uniID_keywords.tsv')
+    parser.add_argument('--endpoint', type=str, default=DEFAULT_ENDPOINT,
+                        help='URL template of an entry, {accession} is replaced by the UniProt ID')
+    parser.add_argument('--cache-dir', type=str, default='uniprot_cache')
+    parser.add_argument('--concurrency', type=int, default=8, help='requests in flight')
+    parser.add_argument('--rate', type=float, default=10.0, help='requests started per second, 0 for no limit')
+    parser.add_argument('--retries', type=int, default=5)
+    parser.add_argument('--backoff', type=float, default=1.0, help='seconds before the first retry, doubled after each')
+    parser.add_argument('--timeout', type=float, default=30.0)
+    args = parser.parse_args()
+    main(args.input, args.output, endpoint=args.endpoint, cache_dir=args.cache_dir, concurrency=args.concurrency,
+         rate=args.rate, retries=args.retries, backoff=args.backoff, timeout=args.timeout)
@@ -4,39 +4,40 @@ import re
 import pybel
 import csv
 import sys
+import argparse
 from subprocess import call
 
-def main():
+import columnar
+
+def read_tsv(fn):
+    with open(fn) as tsvfile:
+        reader = csv.reader(tsvfile, delimiter="\t",quoting=csv.QUOTE_NONE)
+        header = next(reader)
+        for row in reader:
+            yield row[37], row[28]
+
+
+def read_columnar(fn):
+    # only the sequence and CID columns are read
+    reader = columnar.ColumnarReader(fn)
+    for table in reader.iter_tables([columnar.col(37), columnar.col(28)]):
+        for seq, cid in zip(table[0].to_pylist(), table[1].to_pylist()):
+            yield seq, cid
+
+
+def main(use_columnar=False):
     countP = 0
     countC = 0
-    dropM = 0
     proteinDic = set()
     cidDic = set()
-    with open('BindingDB_All_firststep_noMulti.tsv') as tsvfile, open("uniqueProtein",'w+') as uniqueP, open("uniqueCID",'w+') as uniqueC:
-        reader = csv.reader(tsvfile, delimiter="\t",quoting=csv.QUOTE_NONE)
-        # line = {}
-        # k = ''
-        # writerP = csv.writer(uniqueP, dialect='excel-tab')
-        # writerP = csv.writer(uniqueC, dialect='excel-tab')
-        # writer.writeheader()
-        # print reader.fieldnames
-        header = next(reader)
-        # writerP.writerow(header)
-        # writerC.writerow(header)
-        for row in reader:
-            # total += 1
-            # seq = re.sub(row[37].upper())
-            # if seq == None:
-            #     dropM = 1
-            #     none += 1
-            # elif seq = 'N/A':
-            #     na +=1
-            #     dropM = 1
-            # elif seq == '' or 'X' in seq:
-            #     dropM = 1
-            # if row[]
-            seq = row[37].strip()
-            cid = row[28].strip()
+    if use_columnar:
+        rows = read_columnar('BindingDB_All_firststep_noMulti.parquet')
+    else:
+        rows = read_tsv('BindingDB_All_firststep_noMulti.tsv')
+    with open("uniqueProtein",'w+') as uniqueP, open("uniqueCID",'w+') as uniqueC:
+        for seq, cid in rows:
+            seq = seq.strip()
+            cid = cid.strip()
             if seq not in proteinDic:
                 uniqueP.write(seq + '\n')
                 proteinDic.add(seq)
@@ -47,11 +48,11 @@ def main():
                 countC += 1
     print("cid number: %d" %countC)
     print("protein number: %d" %countP)
-    # print total
-
-
-
 
 
 if __name__ == '__main__':
-    main()
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--columnar', action='store_true', default=False,
+                        help='read BindingDB_All_firststep_noMulti.parquet written by firstStep.py --columnar')
+    args = parser.parse_args()
+    main(args.columnar)
@@ -0,0 +1,483 @@
+#!/usr/bin/env python3 -u
+"""Virtual screening of one target against a compound library, reverse
+screening of one compound against a proteome, or screening of a library
+against a protein panel.
+
+The fixed entity is encoded once. Forward mode (``--target``,
+``--library``) reads one ``SMILES [id]`` per line, canonicalized and
+tokenized in worker processes; reverse mode (``--compound``,
+``--proteome``) reads the proteins of a FASTA file. The [CLS] embeddings
+of known entities are read from the entity catalogs of
+``--molecule-catalog``/``--protein-catalog``. Panel mode (``--panel``,
+``--library``) scores every compound with every panel protein with the
+factorized head, keeping the best per protein. The screened entities are
+encoded in buckets sorted by length, so only their encoder, the kNN
+retrieval and the head run per pair. The ``--top-n`` best scored entities
+are kept in a heap and written to ``--output``, and the time spent in every
+stage is logged.
+"""
+
+import collections
+import contextlib
+import heapq
+import io
+import logging
+import multiprocessing
+import os
+import sys
+import time
+from os import path
+
+import numpy as np
+import torch
+
+sys.path.append(path.join(path.dirname(path.abspath(__file__)), "fairseq"))
+sys.path.append(path.join(path.dirname(path.abspath(__file__)), "preprocess"))
+
+from fairseq import checkpoint_utils, options, utils
+from fairseq.dataclass.utils import convert_namespace_to_omegaconf
+from fairseq.modules.entity_catalog import open_entity_catalogs
+from fairseq.modules.knn_dta_retriever import KNNDTARetriever
+from fairseq.utils import reset_logging
+
+import build_bin
+import streaming
+from evaluate_kNN import add_custom_arguments, combine_predictions, encode_entities
+
+logger = logging.getLogger("knn_dta.screen")
+
+# one-letter residue codes, including the ambiguous and rare ones, gaps and stops
+PROTEIN_ALPHABET = set('ABCDEFGHIKLMNOPQRSTUVWXYZ-*')
+
+
+def add_screen_arguments(parser):
+    group = parser.add_argument_group('Screening')
+    group.add_argument('--target', type=str, default=None,
+                       help='Protein sequence of the target in one-letter codes, or a file holding it (plain or FASTA)')
+    group.add_argument('--library', type=str, default=None,
+                       help='Compounds to screen against --target, one SMILES per line optionally followed by '
+                            'whitespace and an id')
+    group.add_argument('--compound', type=str, default=None, help='SMILES of the compound of reverse screening')
+    group.add_argument('--proteome', type=str, default=None,
+                       help='FASTA file of the proteins to screen against --compound')
+    group.add_argument('--panel', type=str, default=None,
+                       help='FASTA file of proteins (e.g. a kinase panel) to screen --library against, scored '
+                            'with the factorized head')
+    group.add_argument('--molecule-catalog', type=str, default=None,
+                       help='Prefix of an entity catalog of molecule [CLS] embeddings, read before encoding and '
+                            'extended with the new molecules')
+    group.add_argument('--protein-catalog', '--protein-cache', type=str, default=None,
+                       help='Prefix of an entity catalog of protein [CLS] embeddings, read before encoding and '
+                            'extended with the new proteins')
+    group.add_argument('--top-n', type=int, default=1000,
+                       help='Number of best scored entities written, per panel protein with --panel')
+    group.add_argument('--output', type=str, default='screen.tsv')
+    group.add_argument('--bucket-size', type=int, default=4096,
+                       help='Entities sorted by length together before being cut into --entity-batch-size batches')
+    group.add_argument('--workers', type=int, default=4, help='Processes that canonicalize and tokenize the library')
+    group.add_argument('--chunk-size', type=int, default=100000, help='Library lines read ahead by the workers')
+    group.add_argument('--no-canonicalize', action='store_true', default=False,
+                       help='The SMILES are already canonical, only tokenize them')
+    group.add_argument('--keep-atommapnum', action='store_true', default=False)
+    return parser
+
+
+# set in every worker by init_worker
+canonical = False
+
+
+def init_worker(mol_dict_fn, pro_dict_fn, keep_atommapnum, canonical_input):
+    global canonical
+    build_bin.init_worker(mol_dict_fn, pro_dict_fn, keep_atommapnum)
+    canonical = canonical_input
+
+
+def encode_molecule(line):
+    """(line, token ids) of a library line, ids None when the SMILES cannot be canonicalized or tokenized."""
+    fields = line.split(None, 1)
+    smiles = fields[0] if fields else ''
+    if smiles and not canonical:
+        smiles = build_bin.canonicalize(smiles, keep_atommap=build_bin.keep_atommap)
+    return line, build_bin.mol_tokenizer.encode(smiles) if smiles else None
+
+
+def model_input(ids, init_token, max_positions):
+    """Token ids as the task feeds them to the model: `init_token` prepended, truncated to `max_positions`."""
+    ids = ids.astype(np.int64)
+    if init_token is not None:
+        ids = np.concatenate([[init_token], ids])
+    return ids[:max_positions]
+
+
+def read_target(target):
+    """Sequence of `target`, a file (plain or FASTA) or the sequence itself."""
+    if not os.path.exists(target):
+        sequence = ''.join(target.split())
+        unexpected = sorted(set(sequence) - PROTEIN_ALPHABET)
+        if not sequence or unexpected:
+            # e.g. a mistyped path, which would be screened as a protein of unknown residues
+            raise ValueError('--target {} is neither a file nor a protein sequence (unexpected {})'.format(
+                target, ''.join(unexpected) or 'empty sequence'))
+        return sequence
+    with io.open(target, 'r', encoding='utf8') as f:
+        return ''.join(line.strip() for line in f if not line.startswith('>'))
+
+
+def read_fasta(fasta_fn):
+    """(id, sequence) of every record of a FASTA file, the id being the first word of the header."""
+    name, seq = None, []
+    with io.open(fasta_fn, 'r', encoding='utf8') as f:
+        for line in f:
+            line = line.strip()
+            if line.startswith('>'):
+                if name is not None:
+                    yield name, ''.join(seq)
+                name, seq = (line[1:].split(None, 1) or [''])[0], []
+            elif line:
+                seq.append(line)
+    if name is not None:
+        yield name, ''.join(seq)
+
+
+def buckets(results, bucket_size):
+    """Valid (position, item, ids) of `results` of (item, ids), `bucket_size` at a time, and the number of failures.
+
+    A failed item has ids None.
+    """
+    bucket, failed = [], 0
+    for n, (item, ids) in enumerate(results):
+        if ids is None:
+            failed += 1
+            continue
+        bucket.append((n, item, ids))
+        if len(bucket) == bucket_size:
+            yield bucket, failed
+            bucket, failed = [], 0
+    if bucket or failed:
+        yield bucket, failed
+
+
+class StageTimer(object):
+    """Wall time spent in every stage; CUDA is synchronized so that the GPU work is counted in its stage."""
+
+    def __init__(self, use_cuda):
+        self.use_cuda = use_cuda
+        self.totals = collections.OrderedDict()
+        self.nested = []
+
+    @contextlib.contextmanager
+    def __call__(self, stage):
+        """Time `stage`; the time of the stages nested in it is only counted in theirs."""
+        if self.use_cuda:
+            torch.cuda.synchronize()
+        start = time.time()
+        self.nested.append(0.0)
+        try:
+            yield
+        finally:
+            if self.use_cuda:
+                torch.cuda.synchronize()
+            elapsed = time.time() - start
+            self.totals[stage] = self.totals.get(stage, 0.0) + elapsed - self.nested.pop()
+            if self.nested:
+                self.nested[-1] += elapsed
+
+    def summary(self):
+        return ', '.join('{} {:.1f}s'.format(stage, total) for stage, total in self.totals.items())
+
+
+class TopN(object):
+    """The `n` highest scored items pushed so far, ties going to the first pushed."""
+
+    def __init__(self, n):
+        self.n = n
+        self.heap = []
+
+    def push(self, scores, keys, items):
+        """Push `items` scored `scores`; `keys` (e.g. line numbers) increase with the push order."""
+        if len(self.heap) == self.n and self.n > 0:
+            # only what beats the current n-th can enter
+            candidates = np.flatnonzero(scores > self.heap[0][0])
+        else:
+            candidates = np.arange(len(scores))
+        if len(candidates) > self.n:
+            candidates = candidates[np.argsort(-scores[candidates], kind='stable')[:self.n]]
+        for i in candidates:
+            entry = (float(scores[i]), -int(keys[i]), items[i])
+            if len(self.heap) < self.n:
+                heapq.heappush(self.heap, entry)
+            elif entry[:2] > self.heap[0][:2]:
+                heapq.heapreplace(self.heap, entry)
+
+    def sorted(self):
+        """(score, key, item) from the best down."""
+        return [(score, -key, item) for score, key, item in sorted(self.heap, key=lambda e: e[:2], reverse=True)]
+
+
+class Screener(object):
+    """Scores entities of the screened `side` against a fixed entity of the other side.
+
+    The [CLS] embedding of the fixed entity, and its kNN embedding when the
+    entity queries are independent, are computed once by :meth:`fix`.
+    """
+
+    def __init__(self, cfg, task, model, retriever, use_cuda, side, timer, catalogs=(None, None)):
+        self.cfg = cfg
+        self.model = model
+        self.retriever = retriever
+        self.use_cuda = use_cuda
+        self.side = side
+        self.timer = timer
+        self.batch_size = cfg.criterion.entity_batch_size
+        self.encoders = (model.encoder_0, model.encoder_1)
+        self.pads = (task.source_dictionary_0.pad(), task.source_dictionary_1.pad())
+        self.searches = (retriever.search_molecules, retriever.search_proteins)
+        self.head = model.classification_heads['sentence_classification_head']
+        self.param = next(model.parameters())
+        self.catalogs = catalogs
+
+    def encode(self, sequences, side=None):
+        """[CLS] embeddings of token sequences of the screened side, or of `side`.
+
+        The sequences found in the entity catalog of the side are read from it,
+        the others are encoded and added to it.
+        """
+        side = self.side if side is None else side
+        catalog = self.catalogs[side]
+        if catalog is None:
+            return self._encode(sequences, side)
+        with self.timer('catalog'):
+            return catalog.get_or_encode(sequences, lambda missing: self._encode(missing, side),
+                                         device=self.param.device, dtype=self.param.dtype)
+
+    def _encode(self, sequences, side):
+        with self.timer('encode'):
+            return encode_entities(self.encoders[side], sequences, self.pads[side], self.batch_size, self.use_cuda)
+
+    def fix(self, ids):
+        """Encode the fixed entity, token ids of the other side."""
+        fixed_side = 1 - self.side
+        self.fixed_cls = self.encode([ids], fixed_side)
+        self.fixed_knn_cls = None
+        if self.retriever.use_embedding and self.retriever.entity_queries_are_independent:
+            self.fixed_knn_cls = self.searches[fixed_side](self.fixed_cls.detach().float().cpu().numpy())
+
+    def score(self, cls):
+        """Final prediction of the fixed entity with every [CLS] embedding of the screened side."""
+        fixed = self.fixed_cls.expand(len(cls), -1)
+        cls_0, cls_1 = (cls, fixed) if self.side == 0 else (fixed, cls)
+        with self.timer('head'), torch.no_grad():
+            prediction = self.head(torch.cat((cls_0, cls_1), 1).unsqueeze(1))
+        concat = self.retriever.make_query(cls_0, cls_1)
+        knn_cls_0 = knn_cls_1 = None
+        if self.fixed_knn_cls is not None:
+            with self.timer('entity retrieval'):
+                knn_cls = self.searches[self.side](cls.detach().float().cpu().numpy())
+            knn_fixed = self.fixed_knn_cls.expand(len(cls), -1)
+            knn_cls_0, knn_cls_1 = (knn_cls, knn_fixed) if self.side == 0 else (knn_fixed, knn_cls)
+        with self.timer('pair retrieval'):
+            final_prediction = combine_predictions(
+                self.cfg, self.model, self.retriever, prediction, cls_0, cls_1, concat, knn_cls_0, knn_cls_1
+            )
+        return final_prediction.view(-1).float().cpu().numpy()
+
+
+class PanelScreener(Screener):
+    """Scores compounds against every protein of a panel with the factorized head.
+
+    The head projections of every compound and protein are computed once and
+    the pairs are scored tile by tile (``iter_cross_product_scores``). The
+    label-wise retrieval searches every pair, so only the embedding-wise
+    kNN is supported.
+    """
+
+    def __init__(self, cfg, task, model, retriever, use_cuda, timer, catalogs=(None, None)):
+        if retriever.use_label:
+            raise ValueError('Panels need --prediction-mode embedding, the label-wise retrieval searches every pair')
+        if retriever.use_embedding and not retriever.entity_queries_are_independent:
+            raise ValueError('Panels cannot use --sim cosine, whose queries couple the two entities of a pair')
+        super().__init__(cfg, task, model, retriever, use_cuda, 0, timer, catalogs)
+
+    def fix(self, panel_cls):
+        """Set the [CLS] embeddings of the panel proteins."""
+        self.fixed_cls = panel_cls
+        self.fixed_knn_cls = None
+        if self.retriever.use_embedding:
+            self.fixed_knn_cls = self.retriever.search_proteins(panel_cls.detach().float().cpu().numpy())
+
+    def score(self, cls):
+        """float32 [len(cls), panel size] final predictions of every compound with every panel protein."""
+        c = self.cfg.criterion
+        knn_cls = None
+        if self.fixed_knn_cls is not None:
+            with self.timer('entity retrieval'):
+                knn_cls = self.retriever.search_molecules(cls.detach().float().cpu().numpy())
+        with self.timer('head'), torch.no_grad():
+            # as combine_predictions: the plain prediction updated with the one of the blended embeddings
+            scores = 0
+            if knn_cls is None or c.l_update != 1:
+                scores = self.model.cross_product_scores(cls, self.fixed_cls)[..., 0]
+            if knn_cls is not None:
+                blended = self.model.cross_product_scores(
+                    cls, self.fixed_cls, knn_cls_0=knn_cls, knn_cls_1=self.fixed_knn_cls,
+                    knn_embedding_weight_0=c.knn_embedding_weight_0, knn_embedding_weight_1=c.knn_embedding_weight_1,
+                    alpha=c.alpha,
+                )[..., 0]
+                scores = c.l_update * blended + (1 - c.l_update) * scores
+            return scores.float().cpu().numpy()
+
+
+def load_model(cfg, override_args, use_cuda):
+    if override_args is not None:
+        overrides = vars(override_args)
+        overrides.update(eval(getattr(override_args, "model_overrides", "{}")))
+    else:
+        overrides = None
+
+    logger.info("loading model from {}".format(cfg.common_eval.path))
+    models, saved_cfg, task = checkpoint_utils.load_model_ensemble_and_task(
+        [cfg.common_eval.path],
+        arg_overrides=overrides,
+        suffix=cfg.checkpoint.checkpoint_suffix,
+    )
+    model = models[0]
+    model.eval()
+    if cfg.common.fp16:
+        model.half()
+    if use_cuda:
+        model.cuda()
+    return model, saved_cfg, task
+
+
+def main(cfg, args, override_args=None):
+    utils.import_user_module(cfg.common)
+    reset_logging()
+
+    modes = [('forward', args.target, args.library), ('reverse', args.compound, args.proteome),
+             ('panel', args.panel, args.library)]
+    modes = [mode for mode, fixed, screened in modes if fixed is not None and screened is not None]
+    if len(modes) != 1 or sum(a is not None for a in (args.target, args.compound, args.panel)) != 1:
+        raise ValueError('Screen either a --target against a --library, a --compound against a --proteome '
+                         'or a --library against a --panel')
+    mode = modes[0]
+    reverse = mode == 'reverse'
+
+    # the fixed entities and the proteins are tokenized here, the library in the workers, forked before
+    # CUDA is initialized
+    initargs = (os.path.join(args.data, 'input0', 'dict.txt'), os.path.join(args.data, 'input1', 'dict.txt'),
+                args.keep_atommapnum, args.no_canonicalize)
+    init_worker(*initargs)
+    pool = None if reverse else multiprocessing.Pool(args.workers, initializer=init_worker, initargs=initargs)
+
+    use_cuda = torch.cuda.is_available() and not cfg.common.cpu
+    if use_cuda:
+        torch.cuda.set_device(cfg.distributed_training.device_id)
+    model, saved_cfg, task = load_model(cfg, override_args, use_cuda)
+    retriever = KNNDTARetriever(cfg.criterion, cfg.task.data)
+    init_token = getattr(saved_cfg.task, 'init_token', None)
+    max_positions = (model.encoder_0.max_positions(), model.encoder_1.max_positions())
+    timer = StageTimer(use_cuda)
+
+    catalogs = open_entity_catalogs(args.molecule_catalog, args.protein_catalog, cfg.common_eval.path,
+                                    model.args.encoder_embed_dim)
+    for catalog in catalogs:
+        if catalog is not None:
+            logger.info("{} entities in {}".format(len(catalog), catalog.prefix))
+
+    side = 1 if reverse else 0
+    if mode == 'panel':
+        screener = PanelScreener(cfg, task, model, retriever, use_cuda, timer, catalogs)
+    else:
+        screener = Screener(cfg, task, model, retriever, use_cuda, side, timer, catalogs)
+
+    if mode == 'panel':
+        panel = [(record, build_bin.pro_binarizer.encode(record[1])) for record in read_fasta(args.panel) if record[1]]
+        if not panel:
+            raise ValueError('No protein in {}'.format(args.panel))
+        sequences = [model_input(ids, init_token, max_positions[1]) for _, ids in panel]
+        screener.fix(screener.encode(sequences, 1))
+        panel = [name for (name, _), _ in panel]
+        logger.info("{} panel proteins encoded".format(len(panel)))
+    elif reverse:
+        _, ids = encode_molecule(args.compound)
+        if ids is None:
+            raise ValueError('Cannot canonicalize or tokenize {}'.format(args.compound))
+        fixed_ids = model_input(ids, init_token, max_positions[0])
+        screener.fix(fixed_ids)
+        logger.info("compound of {} tokens encoded".format(len(fixed_ids)))
+    else:
+        fixed_ids = model_input(build_bin.pro_binarizer.encode(read_target(args.target)), init_token,
+                                max_positions[1])
+        screener.fix(fixed_ids)
+        logger.info("target of {} tokens encoded".format(len(fixed_ids)))
+
+    if reverse:
+        entities = ((record, build_bin.pro_binarizer.encode(record[1]) if record[1] else None)
+                    for record in read_fasta(args.proteome))
+    else:
+        entities = streaming.imap_ordered(pool, encode_molecule, streaming.read_lines(args.library), args.workers,
+                                          args.chunk_size)
+    name = 'proteins' if reverse else 'compounds'
+    tops = [TopN(args.top_n) for _ in (panel if mode == 'panel' else [None])]
+    total, failed = 0, 0
+    start = last_log = time.time()
+    batches = buckets(entities, args.bucket_size)
+    while True:
+        with timer('read + tokenize'):
+            bucket, bucket_failed = next(batches, (None, 0))
+        if bucket is None:
+            break
+        failed += bucket_failed
+        total += len(bucket) + bucket_failed
+        if not bucket:
+            continue
+        sequences = [model_input(ids, init_token, max_positions[side]) for _, _, ids in bucket]
+        cls = screener.encode(sequences)
+        scores = screener.score(cls).reshape(len(bucket), len(tops))
+        with timer('top-n'):
+            keys, items = [n for n, _, _ in bucket], [(n, item) for n, item, _ in bucket]
+            for p, top in enumerate(tops):
+                top.push(scores[:, p], keys, items)
+        if time.time() - last_log > 60:
+            last_log = time.time()
+            logger.info("{} {} screened, {:.0f}/s".format(total, name, total / (last_log - start)))
+    if pool is not None:
+        pool.close()
+        pool.join()
+
+    with io.open(args.output, 'w', encoding='utf8', newline='\n') as f:
+        if reverse:
+            f.write('rank\trecord\tid\tlength\tprediction\n')
+        else:
+            f.write('{}rank\tline\tid\tsmiles\tprediction\n'.format('protein\t' if mode == 'panel' else ''))
+        for p, top in enumerate(tops):
+            prefix = panel[p] + '\t' if mode == 'panel' else ''
+            for rank, (score, _, (n, item)) in enumerate(top.sorted()):
+                if reverse:
+                    fields = [item[0], len(item[1])]
+                else:
+                    fields = item.split(None, 1)
+                    fields = [fields[1].strip() if len(fields) > 1 else '', fields[0]]
+                f.write('{}{}\t{}\t{}\t{}\t{:.6f}\n'.format(prefix, rank + 1, n, fields[0], fields[1], score))
+    logger.info("{} {} ({} failed) screened in {:.1f}s, top {} written to {}".format(
+        total, name, failed, time.time() - start, min(args.top_n, total - failed), args.output))
+    logger.info("time per stage: {}".format(timer.summary()))
+
+
+def cli_main():
+    parser = options.get_validation_parser()
+    parser = add_custom_arguments(parser)
+    parser = add_screen_arguments(parser)
+    args = options.parse_args_and_arch(parser)
+
+    # only override args that are explicitly given on the command line
+    override_parser = options.get_validation_parser()
+    override_parser = add_custom_arguments(override_parser)
+    override_parser = add_screen_arguments(override_parser)
+    override_args = options.parse_args_and_arch(override_parser, suppress_defaults=True)
+
+    main(convert_namespace_to_omegaconf(args), args, override_args=override_args)
+
+
+if __name__ == "__main__":
+    cli_main()
@@ -0,0 +1,546 @@
+#!/usr/bin/env python3 -u
+"""Serve kNN-DTA affinity predictions over HTTP.
+
+Requests are tokenized in a worker pool and coalesced into micro-batches:
+a batch is run once ``--max-batch-size`` pairs are waiting or the oldest of
+them has waited ``--max-latency-ms``. Every batch encodes its unique
+molecules and proteins once, skipping those found in the entity catalogs
+of ``--molecule-catalog``/``--protein-catalog``, then runs the kNN
+retrieval and the head as ``evaluate_kNN.py`` does.
+
+    POST /predict  {"smiles": ..., "protein": ...} or {"pairs": [{"smiles": ..., "protein": ...}, ...]}
+    GET  /metrics  queue depths, counters and latency histograms (Prometheus text format)
+    GET  /health
+"""
+
+import asyncio
+import bisect
+import collections
+import json
+import logging
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from os import path
+
+import numpy as np
+import torch
+
+sys.path.append(path.join(path.dirname(path.abspath(__file__)), "fairseq"))
+sys.path.append(path.join(path.dirname(path.abspath(__file__)), "preprocess"))
+
+from fairseq import checkpoint_utils, options, utils
+from fairseq.dataclass.utils import convert_namespace_to_omegaconf
+from fairseq.modules.entity_catalog import open_entity_catalogs
+from fairseq.modules.knn_dta_retriever import KNNDTARetriever
+from fairseq.utils import reset_logging
+
+import build_bin
+from evaluate_kNN import add_custom_arguments, combine_predictions, encode_entities
+
+logger = logging.getLogger("knn_dta.serve")
+
+HTTP_REASONS = {200: 'OK', 400: 'Bad Request', 404: 'Not Found', 405: 'Method Not Allowed',
+                413: 'Payload Too Large', 500: 'Internal Server Error', 503: 'Service Unavailable'}
+# how often a client is checked for a disconnect while its request waits
+DISCONNECT_POLL = 0.05
+# 0.5ms to 8s
+LATENCY_BUCKETS = [0.0005 * 2 ** i for i in range(15)]
+
+
+def add_server_arguments(parser):
+    group = parser.add_argument_group('Serving')
+    group.add_argument('--host', type=str, default='127.0.0.1')
+    group.add_argument('--port', type=int, default=8000)
+    group.add_argument('--unix-socket', type=str, default=None,
+                       help='Listen on this Unix socket instead of --host/--port')
+    group.add_argument('--max-batch-size', type=int, default=64,
+                       help='Largest number of pairs run in one micro-batch')
+    group.add_argument('--max-latency-ms', type=float, default=5,
+                       help='Longest time the first pair of a micro-batch waits for more pairs')
+    group.add_argument('--max-queue', type=int, default=4096,
+                       help='Pairs waiting for a batch above which requests are rejected with 503')
+    group.add_argument('--max-request-pairs', type=int, default=10000)
+    group.add_argument('--tokenize-workers', type=int, default=4,
+                       help='Processes that canonicalize and tokenize the requests (0 tokenizes in a thread)')
+    group.add_argument('--tokenize-chunk-size', type=int, default=64,
+                       help='Pairs of a bulk request tokenized per worker task')
+    group.add_argument('--keep-atommapnum', action='store_true', default=False)
+    group.add_argument('--molecule-catalog', type=str, default=None,
+                       help='Prefix of an entity catalog of molecule [CLS] embeddings, read before encoding')
+    group.add_argument('--protein-catalog', type=str, default=None,
+                       help='Prefix of an entity catalog of protein [CLS] embeddings, read before encoding')
+    group.add_argument('--catalog-readonly', action='store_true', default=False,
+                       help='Do not add the entities missing from the catalogs, e.g. when populated offline')
+    group.add_argument('--metrics-log-interval', type=float, default=60,
+                       help='Seconds between two logs of the throughput and latency percentiles (0 disables)')
+    return parser
+
+
+class Histogram(object):
+    """Cumulative histogram in the Prometheus text format."""
+
+    def __init__(self, name, help, buckets):
+        self.name = name
+        self.help = help
+        self.buckets = list(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def quantile(self, q):
+        """Upper bound of the bucket holding the q-quantile, inf when it is above the last bucket."""
+        if self.count == 0:
+            return 0.0
+        rank = q * self.count
+        total = 0
+        for bound, count in zip(self.buckets + [float('inf')], self.counts):
+            total += count
+            if total >= rank:
+                return bound
+        return float('inf')
+
+    def render(self):
+        lines = ['# HELP {} {}'.format(self.name, self.help), '# TYPE {} histogram'.format(self.name)]
+        total = 0
+        for bound, count in zip(self.buckets, self.counts):
+            total += count
+            lines.append('{}_bucket{{le="{:g}"}} {}'.format(self.name, bound, total))
+        lines.append('{}_bucket{{le="+Inf"}} {}'.format(self.name, self.count))
+        lines.append('{}_sum {}'.format(self.name, self.sum))
+        lines.append('{}_count {}'.format(self.name, self.count))
+        return lines
+
+
+class ServerMetrics(object):
+
+    def __init__(self, max_batch_size):
+        self.counters = collections.OrderedDict([
+            ('requests_total', 0), ('pairs_total', 0), ('batches_total', 0),
+            ('invalid_pairs_total', 0), ('rejected_requests_total', 0), ('abandoned_requests_total', 0),
+            ('errors_total', 0),
+        ])
+        # set by the server when rendered
+        self.gauges = collections.OrderedDict([('queue_depth', 0), ('tokenize_pending', 0)])
+        self.request_latency = Histogram(
+            'knn_dta_request_latency_seconds', 'Time from reading a /predict request to writing its response',
+            LATENCY_BUCKETS)
+        self.queue_wait = Histogram(
+            'knn_dta_queue_wait_seconds', 'Time a tokenized pair waits for its micro-batch', LATENCY_BUCKETS)
+        self.batch_latency = Histogram(
+            'knn_dta_batch_latency_seconds', 'Time to encode, search and predict one micro-batch', LATENCY_BUCKETS)
+        batch_buckets = [1]
+        while batch_buckets[-1] < max_batch_size:
+            batch_buckets.append(min(batch_buckets[-1] * 2, max_batch_size))
+        self.batch_size = Histogram('knn_dta_batch_size', 'Pairs per micro-batch', batch_buckets)
+
+    def histograms(self):
+        return [self.request_latency, self.queue_wait, self.batch_latency, self.batch_size]
+
+    def render(self):
+        lines = []
+        for name, value in self.counters.items():
+            lines += ['# TYPE knn_dta_{} counter'.format(name), 'knn_dta_{} {}'.format(name, value)]
+        for name, value in self.gauges.items():
+            lines += ['# TYPE knn_dta_{} gauge'.format(name), 'knn_dta_{} {}'.format(name, value)]
+        for histogram in self.histograms():
+            lines += histogram.render()
+        return '\n'.join(lines) + '\n'
+
+
+def tokenize_pairs(rows, init_token, max_positions):
+    """Token ids of (smiles, protein) rows as the task feeds them to the model, None for a pair that fails.
+
+    Runs in the tokenizer workers set up by ``build_bin.init_worker``.
+    """
+    results = []
+    for smiles, protein in rows:
+        res = build_bin.encode_pair((smiles, protein, None))
+        if res is None:
+            results.append(None)
+            continue
+        pair = []
+        for side, ids in enumerate(res[:2]):
+            ids = ids.numpy().astype(np.int64)
+            if init_token is not None:
+                ids = np.concatenate([[init_token], ids])
+            # as --shorten-method truncate
+            pair.append(ids[:max_positions[side]])
+        results.append(tuple(pair))
+    return results
+
+
+class Predictor(object):
+    """Runs micro-batches of tokenized pairs through the encoders, the retrieval and the head."""
+
+    def __init__(self, cfg, task, model, retriever, use_cuda, catalogs=(None, None)):
+        self.cfg = cfg
+        self.model = model
+        self.retriever = retriever
+        self.use_cuda = use_cuda
+        self.encoders = (model.encoder_0, model.encoder_1)
+        self.pads = (task.source_dictionary_0.pad(), task.source_dictionary_1.pad())
+        self.head = model.classification_heads['sentence_classification_head']
+        self.catalogs = catalogs
+
+    def __call__(self, pairs):
+        """Prediction and datastore neighbours of every pair of token ids."""
+        cls = []
+        with torch.no_grad():
+            for side in range(2):
+                # the pairs of a batch often share a target (or a compound), which is encoded once
+                unique = {}
+                rows = [unique.setdefault(pair[side].tobytes(), len(unique)) for pair in pairs]
+                sequences = [np.frombuffer(key, dtype=np.int64) for key in unique]
+                table = encode_entities(self.encoders[side], sequences, self.pads[side], len(sequences), self.use_cuda,
+                                        self.catalogs[side])
+                cls.append(table[torch.tensor(rows, device=table.device)])
+            prediction = self.head(torch.cat((cls[0], cls[1]), 1).unsqueeze(1))
+            concat = self.retriever.make_query(cls[0], cls[1])
+            prediction, neighbours = combine_predictions(
+                self.cfg, self.model, self.retriever, prediction, cls[0], cls[1], concat, return_neighbours=True
+            )
+        prediction = prediction.view(-1).float().cpu().tolist()
+        neighbours = {name: np.asarray(rows).tolist() for name, rows in neighbours.items()}
+        results = []
+        for i, value in enumerate(prediction):
+            result = {'prediction': value}
+            for name, rows in neighbours.items():
+                result[name] = rows[i]
+            results.append(result)
+        return results
+
+
+class Overloaded(Exception):
+    pass
+
+
+class MicroBatcher(object):
+    """Coalesce single pairs into micro-batches for *predict*.
+
+    A batch is dispatched once *max_batch_size* pairs are pending or the
+    oldest pending pair has waited *max_latency* seconds. Batches run one
+    at a time in a dedicated thread, so the event loop keeps accepting and
+    queueing requests meanwhile; pairs that queued up during a batch are
+    dispatched right after it without waiting further.
+    """
+
+    def __init__(self, predict, max_batch_size, max_latency, max_queue, metrics):
+        self.predict = predict
+        self.max_batch_size = max_batch_size
+        self.max_latency = max_latency
+        self.max_queue = max_queue
+        self.metrics = metrics
+        self.pending = collections.deque()
+        self.arrived = asyncio.Event()
+        # the model is not thread safe, every batch runs in this single thread
+        self.executor = ThreadPoolExecutor(max_workers=1)
+
+    def __len__(self):
+        return len(self.pending)
+
+    def submit(self, pairs):
+        """Queue tokenized pairs and return a future of the result of each."""
+        if len(self.pending) + len(pairs) > self.max_queue:
+            raise Overloaded('{} pairs pending'.format(len(self.pending)))
+        loop = asyncio.get_event_loop()
+        now = time.monotonic()
+        futures = []
+        for pair in pairs:
+            future = loop.create_future()
+            self.pending.append((now, pair, future))
+            futures.append(future)
+        self.arrived.set()
+        return futures
+
+    async def run(self):
+        loop = asyncio.get_event_loop()
+        while True:
+            if not self.pending:
+                self.arrived.clear()
+                await self.arrived.wait()
+                continue
+            deadline = self.pending[0][0] + self.max_latency
+            while len(self.pending) < self.max_batch_size:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                self.arrived.clear()
+                try:
+                    await asyncio.wait_for(self.arrived.wait(), timeout)
+                except asyncio.TimeoutError:
+                    break
+            batch = [self.pending.popleft() for _ in range(min(len(self.pending), self.max_batch_size))]
+            # the pairs of requests cancelled meanwhile, e.g. by a disconnect, are skipped
+            batch = [item for item in batch if not item[2].done()]
+            if not batch:
+                continue
+            start = time.monotonic()
+            for enqueued, _, _ in batch:
+                self.metrics.queue_wait.observe(start - enqueued)
+            try:
+                results = await loop.run_in_executor(self.executor, self.predict, [pair for _, pair, _ in batch])
+            except Exception as e:
+                logger.exception('batch of {} pairs failed'.format(len(batch)))
+                self.metrics.counters['errors_total'] += 1
+                for _, _, future in batch:
+                    if not future.done():
+                        future.set_exception(e)
+                continue
+            self.metrics.batch_latency.observe(time.monotonic() - start)
+            self.metrics.batch_size.observe(len(batch))
+            self.metrics.counters['batches_total'] += 1
+            for (_, _, future), result in zip(batch, results):
+                if not future.done():
+                    future.set_result(result)
+
+
+class Server(object):
+    """Minimal HTTP/1.1 server with keep-alive over asyncio streams."""
+
+    def __init__(self, args, batcher, tokenizer_pool, init_token, max_positions, metrics):
+        self.args = args
+        self.batcher = batcher
+        self.tokenizer_pool = tokenizer_pool
+        self.init_token = init_token
+        self.max_positions = max_positions
+        self.metrics = metrics
+        self.tokenize_pending = 0
+
+    async def tokenize(self, rows):
+        loop = asyncio.get_event_loop()
+        chunk_size = self.args.tokenize_chunk_size
+        self.tokenize_pending += len(rows)
+        try:
+            chunks = await asyncio.gather(*[
+                loop.run_in_executor(self.tokenizer_pool, tokenize_pairs, rows[i:i + chunk_size],
+                                     self.init_token, self.max_positions)
+                for i in range(0, len(rows), chunk_size)
+            ])
+        finally:
+            self.tokenize_pending -= len(rows)
+        return [pair for chunk in chunks for pair in chunk]
+
+    async def predict(self, body):
+        try:
+            request = json.loads(body.decode('utf8'))
+        except ValueError:
+            return 400, {'error': 'the body is not valid JSON'}
+        single = isinstance(request, dict) and 'pairs' not in request
+        items = [request] if single else request.get('pairs') if isinstance(request, dict) else None
+        if not isinstance(items, list) or not all(
+                isinstance(item, dict) and isinstance(item.get('smiles'), str) and isinstance(item.get('protein'), str)
+                for item in items):
+            return 400, {'error': 'expected {"smiles": ..., "protein": ...} or {"pairs": [...]} with string values'}
+        if len(items) > self.args.max_request_pairs:
+            return 413, {'error': 'more than {} pairs'.format(self.args.max_request_pairs)}
+        if len(items) + len(self.batcher) > self.batcher.max_queue:
+            self.metrics.counters['rejected_requests_total'] += 1
+            return 503, {'error': 'overloaded, retry later'}
+
+        pairs = await self.tokenize([(item['smiles'].strip(), item['protein'].strip()) for item in items])
+        valid = [i for i, pair in enumerate(pairs) if pair is not None]
+        self.metrics.counters['pairs_total'] += len(items)
+        self.metrics.counters['invalid_pairs_total'] += len(items) - len(valid)
+        try:
+            futures = self.batcher.submit([pairs[i] for i in valid])
+        except Overloaded:
+            self.metrics.counters['rejected_requests_total'] += 1
+            return 503, {'error': 'overloaded, retry later'}
+        try:
+            outputs = await asyncio.gather(*futures)
+        except asyncio.CancelledError:
+            for future in futures:
+                future.cancel()
+            raise
+        except Exception:
+            return 500, {'error': 'prediction failed'}
+
+        results = [{'error': 'cannot canonicalize or tokenize the pair'}] * len(items)
+        for i, output in zip(valid, outputs):
+            results[i] = output
+        if single:
+            return (200 if valid else 400), results[0]
+        return 200, {'results': results}
+
+    async def dispatch(self, method, target, body):
+        route = target.split('?', 1)[0]
+        if route == '/predict':
+            if method != 'POST':
+                return 405, {'error': 'use POST'}
+            start = time.monotonic()
+            self.metrics.counters['requests_total'] += 1
+            status, payload = await self.predict(body)
+            self.metrics.request_latency.observe(time.monotonic() - start)
+            return status, payload
+        if route == '/metrics' and method == 'GET':
+            self.metrics.gauges['queue_depth'] = len(self.batcher)
+            self.metrics.gauges['tokenize_pending'] = self.tokenize_pending
+            return 200, self.metrics.render()
+        if route == '/health' and method == 'GET':
+            return 200, {'status': 'ok'}
+        return 404, {'error': 'unknown route {} {}'.format(method, route)}
+
+    async def dispatch_watched(self, reader, writer, method, target, body):
+        """Like :meth:`dispatch`, cancelled when the client disconnects meanwhile so that its pairs are not run."""
+        task = asyncio.ensure_future(self.dispatch(method, target, body))
+        try:
+            while not task.done():
+                await asyncio.wait([task], timeout=DISCONNECT_POLL)
+                # at_eof: the client closed its side and sent nothing more
+                if not task.done() and (reader.at_eof() or writer.transport.is_closing()):
+                    self.metrics.counters['abandoned_requests_total'] += 1
+                    raise ConnectionResetError('client disconnected')
+            return task.result()
+        finally:
+            if not task.done():
+                task.cancel()
+
+    async def handle(self, reader, writer):
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                method, target, version = request_line.decode('latin-1').split()
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b'\r\n', b'\n', b''):
+                        break
+                    name, _, value = line.decode('latin-1').partition(':')
+                    headers[name.strip().lower()] = value.strip()
+                length = int(headers.get('content-length', 0))
+                if length > self.args.max_request_pairs * 4096:
+                    status, payload = 413, {'error': 'body too large'}
+                    keep_alive = False
+                else:
+                    body = await reader.readexactly(length)
+                    status, payload = await self.dispatch_watched(reader, writer, method, target, body)
+                    keep_alive = version == 'HTTP/1.1' and headers.get('connection', '').lower() != 'close'
+                if isinstance(payload, str):
+                    content_type, data = 'text/plain; version=0.0.4', payload.encode('utf8')
+                else:
+                    content_type, data = 'application/json', json.dumps(payload).encode('utf8')
+                writer.write('HTTP/1.1 {} {}\r\nContent-Type: {}\r\nContent-Length: {}\r\nConnection: {}\r\n\r\n'.format(
+                    status, HTTP_REASONS[status], content_type, len(data), 'keep-alive' if keep_alive else 'close'
+                ).encode('latin-1') + data)
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except (asyncio.IncompleteReadError, ConnectionError, ValueError):
+            pass
+        finally:
+            writer.close()
+
+    async def log_metrics(self, interval):
+        last_pairs, last_time = 0, time.monotonic()
+        while True:
+            await asyncio.sleep(interval)
+            now, pairs = time.monotonic(), self.metrics.counters['pairs_total']
+            logger.info('{:.1f} pairs/s, {} pending, request p50={:g}s p99={:g}s, batch p99={:g}s, '
+                        'mean batch size {:.1f}'.format(
+                            (pairs - last_pairs) / (now - last_time), len(self.batcher),
+                            self.metrics.request_latency.quantile(0.5), self.metrics.request_latency.quantile(0.99),
+                            self.metrics.batch_latency.quantile(0.99),
+                            self.metrics.batch_size.sum / max(self.metrics.batch_size.count, 1)))
+            last_pairs, last_time = pairs, now
+
+
+async def serve(args, predictor, tokenizer_pool, init_token, max_positions):
+    metrics = ServerMetrics(args.max_batch_size)
+    batcher = MicroBatcher(predictor, args.max_batch_size, args.max_latency_ms / 1000, args.max_queue, metrics)
+    server = Server(args, batcher, tokenizer_pool, init_token, max_positions, metrics)
+    tasks = [asyncio.ensure_future(batcher.run())]
+    if args.metrics_log_interval > 0:
+        tasks.append(asyncio.ensure_future(server.log_metrics(args.metrics_log_interval)))
+    if args.unix_socket:
+        listener = await asyncio.start_unix_server(server.handle, path=args.unix_socket)
+        logger.info('listening on {}'.format(args.unix_socket))
+    else:
+        listener = await asyncio.start_server(server.handle, args.host, args.port)
+        logger.info('listening on http://{}:{}'.format(args.host, args.port))
+    try:
+        await listener.serve_forever()
+    finally:
+        for task in tasks:
+            task.cancel()
+
+
+def main(cfg, args, override_args=None):
+    utils.import_user_module(cfg.common)
+    reset_logging()
+
+    # the tokenizers are forked before CUDA is initialized
+    mol_dict_fn = os.path.join(args.data, 'input0', 'dict.txt')
+    pro_dict_fn = os.path.join(args.data, 'input1', 'dict.txt')
+    if args.tokenize_workers > 0:
+        tokenizer_pool = ProcessPoolExecutor(
+            args.tokenize_workers, initializer=build_bin.init_worker,
+            initargs=(mol_dict_fn, pro_dict_fn, args.keep_atommapnum),
+        )
+        for future in [tokenizer_pool.submit(tokenize_pairs, [], None, (0, 0)) for _ in range(args.tokenize_workers)]:
+            future.result()
+    else:
+        build_bin.init_worker(mol_dict_fn, pro_dict_fn, args.keep_atommapnum)
+        tokenizer_pool = ThreadPoolExecutor(max_workers=1)
+
+    use_cuda = torch.cuda.is_available() and not cfg.common.cpu
+    if use_cuda:
+        torch.cuda.set_device(cfg.distributed_training.device_id)
+
+    if override_args is not None:
+        overrides = vars(override_args)
+        overrides.update(eval(getattr(override_args, "model_overrides", "{}")))
+    else:
+        overrides = None
+
+    logger.info("loading model from {}".format(cfg.common_eval.path))
+    models, saved_cfg, task = checkpoint_utils.load_model_ensemble_and_task(
+        [cfg.common_eval.path],
+        arg_overrides=overrides,
+        suffix=cfg.checkpoint.checkpoint_suffix,
+    )
+    model = models[0]
+    model.eval()
+    if cfg.common.fp16:
+        model.half()
+    if use_cuda:
+        model.cuda()
+    retriever = KNNDTARetriever(cfg.criterion, cfg.task.data)
+
+    catalogs = open_entity_catalogs(args.molecule_catalog, args.protein_catalog, cfg.common_eval.path,
+                                    model.args.encoder_embed_dim, readonly=args.catalog_readonly)
+    for catalog in catalogs:
+        if catalog is not None:
+            logger.info("{} entities in {}".format(len(catalog), catalog.prefix))
+
+    predictor = Predictor(cfg, task, model, retriever, use_cuda, catalogs)
+    max_positions = (model.encoder_0.max_positions(), model.encoder_1.max_positions())
+    init_token = getattr(saved_cfg.task, 'init_token', None)
+    asyncio.run(serve(args, predictor, tokenizer_pool, init_token, max_positions))
+
+
+def cli_main():
+    parser = options.get_validation_parser()
+    parser = add_custom_arguments(parser)
+    parser = add_server_arguments(parser)
+    args = options.parse_args_and_arch(parser)
+
+    # only override args that are explicitly given on the command line
+    override_parser = options.get_validation_parser()
+    override_parser = add_custom_arguments(override_parser)
+    override_parser = add_server_arguments(override_parser)
+    override_args = options.parse_args_and_arch(override_parser, suppress_defaults=True)
+
+    main(convert_namespace_to_omegaconf(args), args, override_args=override_args)
+
+
+if __name__ == "__main__":
+    cli_main()